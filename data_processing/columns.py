@@ -0,0 +1,355 @@
+"""
+Contains typed columns of property values, used by CompactGraph and by snapshots to store the
+properties of nodes and edges without a Python object per node or edge:
+
+- ArrayColumn: integers, floats or booleans in a typed array, with a presence array.
+- CodedColumn: values with few distinct values, as int32 codes into a list of those values.
+- HeapColumn: any other values, each JSON-encoded into one byte array, with offsets.
+
+Columns are built by ColumnBuilder, one value at a time, which picks the type of column from
+the values it is given. Every column can be saved to .npy files and loaded memory-mapped.
+"""
+
+import json
+from array import array
+import numpy as np
+
+# Code used for a value which is missing (e.g. an edge without a 'state' property)
+MISSING_CODE = -1
+
+# The maximum number of distinct values of a CodedColumn. Columns with more distinct values
+# (e.g. uuids) are stored as a HeapColumn
+MAX_CODED_VALUES = 1024
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def load_array(path):
+    """
+    Loads a .npy array memory-mapped. Empty arrays, which cannot be memory-mapped, are read.
+
+    :param path: The path of the .npy file
+    :return: A NumPy ndarray (a memmap unless empty)
+    """
+
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+
+class Column:
+    """
+    A column of values, one per row, with None for rows which do not have a value.
+    """
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def get(self, index):
+        raise NotImplementedError
+
+    def get_all(self):
+        """
+        :return: A list of the value of every row
+        """
+
+        return [self.get(index) for index in range(len(self))]
+
+    def mask(self, predicate):
+        """
+        :param predicate: A function taking a value and returning True if it matches
+        :return: A 1D boolean ndarray which is True for the rows with a matching value
+        """
+
+        return np.asarray([value is not None and bool(predicate(value))
+                           for value in self.get_all()], dtype=bool)
+
+
+class ArrayColumn(Column):
+    """
+    A column of integers, floats or booleans.
+    """
+
+    kind = 'array'
+
+    def __init__(self, values, present):
+        """
+        Initialises the ArrayColumn object.
+
+        :param values: A 1D int64, float64 or bool ndarray
+        :param present: A 1D bool ndarray which is True for the rows with a value
+        """
+
+        self.values = values
+        self.present = present
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, index):
+        if not self.present[index]:
+            return None
+        return self.values[index].item()
+
+    def get_all(self):
+        return [value if present else None
+                for value, present in zip(self.values.tolist(), self.present.tolist())]
+
+    def take(self, indices):
+        return ArrayColumn(self.values[indices], self.present[indices])
+
+    def save(self, prefix):
+        np.save(prefix + '.npy', np.asarray(self.values))
+        np.save(prefix + '.present.npy', np.asarray(self.present))
+        return {'kind': self.kind}
+
+    @staticmethod
+    def load(prefix, spec):
+        return ArrayColumn(load_array(prefix + '.npy'), load_array(prefix + '.present.npy'))
+
+
+class CodedColumn(Column):
+    """
+    A column of values with few distinct values, stored as codes into a list of those values.
+    """
+
+    kind = 'coded'
+
+    def __init__(self, codes, names):
+        """
+        Initialises the CodedColumn object.
+
+        :param codes: A 1D int32 ndarray of codes into names, MISSING_CODE for rows without
+        a value
+        :param names: A list of the distinct values
+        """
+
+        self.codes = codes
+        self.names = names
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, index):
+        code = self.codes[index]
+        if code == MISSING_CODE:
+            return None
+        value = self.names[code]
+        # Values are shared by all the rows with them, so lists are copied
+        return list(value) if isinstance(value, list) else value
+
+    def mask(self, predicate):
+        matching = [code for code, value in enumerate(self.names) if predicate(value)]
+        return np.isin(self.codes, matching)
+
+    def take(self, indices):
+        return CodedColumn(self.codes[indices], self.names)
+
+    def save(self, prefix):
+        np.save(prefix + '.npy', np.asarray(self.codes))
+        return {'kind': self.kind, 'names': self.names}
+
+    @staticmethod
+    def load(prefix, spec):
+        return CodedColumn(load_array(prefix + '.npy'), spec['names'])
+
+
+class HeapColumn(Column):
+    """
+    A column of JSON-serialisable values, each stored JSON-encoded in one byte array. Row i is
+    data[offsets[i]:offsets[i+1]], which is empty for rows without a value.
+    """
+
+    kind = 'heap'
+
+    def __init__(self, offsets, data):
+        """
+        Initialises the HeapColumn object.
+
+        :param offsets: A 1D int64 ndarray of length rows + 1
+        :param data: A 1D uint8 ndarray
+        """
+
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, index):
+        start, end = self.offsets[index], self.offsets[index+1]
+        if start == end:
+            return None
+        return json.loads(bytes(self.data[start:end]).decode('utf-8'))
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return HeapColumn(offsets, np.asarray(self.data)[positions])
+
+    def save(self, prefix):
+        np.save(prefix + '.npy', np.asarray(self.data))
+        np.save(prefix + '.offsets.npy', np.asarray(self.offsets))
+        return {'kind': self.kind}
+
+    @staticmethod
+    def load(prefix, spec):
+        return HeapColumn(load_array(prefix + '.offsets.npy'), load_array(prefix + '.npy'))
+
+
+COLUMN_TYPES = {column_type.kind: column_type
+                for column_type in (ArrayColumn, CodedColumn, HeapColumn)}
+
+
+def load_column(prefix, spec):
+    """
+    Loads a column saved with its save() method, memory-mapped.
+
+    :param prefix: The path the column was saved to, without extension
+    :param spec: The Dictionary returned by save()
+    :return: A Column object
+    """
+
+    return COLUMN_TYPES[spec['kind']].load(prefix, spec)
+
+
+def value_kind(value):
+    """
+    :param value: A property value, not None
+    :return: 'bool', 'int' or 'float' for the values an ArrayColumn can store, otherwise
+    'other'
+    """
+
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if _INT64_MIN <= value <= _INT64_MAX else 'other'
+    if isinstance(value, float):
+        return 'float'
+    return 'other'
+
+
+_TYPECODES = {'bool': 'b', 'int': 'q', 'float': 'd'}
+_DTYPES = {'bool': bool, 'int': np.int64, 'float': np.float64}
+
+
+class ColumnBuilder:
+    """
+    Builds a column from values added one at a time, keeping them in typed arrays. The values
+    are stored in an ArrayColumn while they are all integers (or all floats, or all booleans),
+    then in a CodedColumn while they have at most max_coded distinct values, then in a
+    HeapColumn. Integers and floats are never mixed in one array, so large integers (e.g.
+    nanosecond timestamps) are never rounded.
+    """
+
+    def __init__(self, max_coded=MAX_CODED_VALUES):
+        """
+        Initialises the ColumnBuilder object.
+
+        :param max_coded: The maximum number of distinct values of a CodedColumn
+        """
+
+        self.max_coded = max_coded
+        self.kind = None
+        self.count = 0
+        self.present = array('b')
+        self.numbers = None
+        self.codes = array('i')
+        self.names = []
+        self._code_of = {}
+        self.offsets = array('q', [0])
+        self.data = bytearray()
+
+    def __len__(self):
+        return self.count
+
+    def _values(self):
+        if self.kind in _TYPECODES:
+            return [value if present else None
+                    for value, present in zip(self.numbers, self.present)]
+        if self.kind == 'coded':
+            return [None if code == MISSING_CODE else self.names[code] for code in self.codes]
+        return [None] * self.count
+
+    def _convert(self, kind):
+        values = self._values()
+        self.__init__(self.max_coded)
+        self.kind = kind
+        if kind in _TYPECODES:
+            self.numbers = array(_TYPECODES[kind])
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        """
+        Adds the value of the next row.
+
+        :param value: A JSON-serialisable value, or None if the row has no value
+        :return: nothing
+        """
+
+        if value is not None:
+            kind = value_kind(value)
+            if self.kind is None:
+                self._convert(kind if kind in _TYPECODES else 'coded')
+            elif self.kind in _TYPECODES and kind != self.kind:
+                self._convert('coded')
+
+        self.count += 1
+        if self.kind in _TYPECODES:
+            self.present.append(value is not None)
+            self.numbers.append(value if value is not None else 0)
+        elif self.kind == 'coded':
+            if value is None:
+                self.codes.append(MISSING_CODE)
+                return
+            key = json.dumps(value, sort_keys=True)
+            code = self._code_of.get(key)
+            if code is None:
+                if len(self.names) == self.max_coded:
+                    self._convert('heap')
+                    self.append(value)
+                    return
+                code = len(self.names)
+                self._code_of[key] = code
+                # A copy, so later changes to the value do not change the column
+                self.names.append(json.loads(key))
+            self.codes.append(code)
+        elif self.kind == 'heap':
+            if value is not None:
+                self.data.extend(json.dumps(value, sort_keys=True).encode('utf-8'))
+            self.offsets.append(len(self.data))
+
+    def finish(self):
+        """
+        :return: A Column object of the values added
+        """
+
+        if self.kind in _TYPECODES:
+            return ArrayColumn(np.asarray(self.numbers, dtype=_DTYPES[self.kind]),
+                               np.asarray(self.present, dtype=bool))
+        if self.kind == 'heap':
+            return HeapColumn(np.asarray(self.offsets, dtype=np.int64),
+                              np.frombuffer(bytes(self.data), dtype=np.uint8))
+        if self.kind is None:
+            return CodedColumn(np.full(self.count, MISSING_CODE, dtype=np.int32), [])
+        return CodedColumn(np.asarray(self.codes, dtype=np.int32), self.names)
+
+
+def build_column(values, max_coded=MAX_CODED_VALUES):
+    """
+    :param values: An iterable of JSON-serialisable values, None for rows without a value
+    :param max_coded: See ColumnBuilder
+    :return: A Column object
+    """
+
+    builder = ColumnBuilder(max_coded)
+    for value in values:
+        builder.append(value)
+    return builder.finish()
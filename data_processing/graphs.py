@@ -2,6 +2,11 @@
 Contains graph representation(s).
 """
 
+from collections.abc import Mapping, MutableMapping
+import numpy as np
+from data_processing.columns import MISSING_CODE, build_column
+from data_processing.records import LocalNode, LocalEdge
+
 
 class Graph:
     """
@@ -22,3 +27,785 @@ class Graph:
         self.edges = edges
         self.incoming_edges = incoming_edges
         self.outgoing_edges = outgoing_edges
+
+    def remove_nodes(self, node_ids):
+        """
+        Removes a set of nodes and every edge incident to any of them in a single pass over
+        the edges, then rebuilds the incoming and outgoing edge maps once.
+
+        :param node_ids: An iterable (e.g. a set) of node ids
+        :return: The number of edges removed
+        """
+
+        removed = set(node_ids)
+        if not removed:
+            return 0
+
+        for node_id in removed:
+            self.nodes.pop(node_id, None)
+
+        incident = [edge_id for edge_id, edge in self.edges.items()
+                    if edge.start in removed or edge.end in removed]
+        return self.remove_edges(incident)
+
+    def remove_edges(self, edge_ids):
+        """
+        Removes a set of edges, then rebuilds the incoming and outgoing edge maps once.
+
+        :param edge_ids: An iterable of edge ids
+        :return: The number of edges removed
+        """
+
+        removed = 0
+        for edge_id in edge_ids:
+            if self.edges.pop(edge_id, None) is not None:
+                removed += 1
+
+        if removed > 0:
+            self.rebuild_adjacency()
+        return removed
+
+    def rebuild_adjacency(self):
+        """
+        Rebuilds the incoming and outgoing edge maps from the edges. The existing Dictionaries
+        are updated in place.
+
+        :return: nothing
+        """
+
+        incoming_edges, outgoing_edges = build_in_out_edges(self.edges)
+        self.incoming_edges.clear()
+        self.incoming_edges.update(incoming_edges)
+        self.outgoing_edges.clear()
+        self.outgoing_edges.update(outgoing_edges)
+
+
+def build_in_out_edges(edges):
+    """
+    Given a Dictionary of edge_id -> edge, builds two
+    dictionaries of node_id -> edge (incoming or outgoing edges from that node).
+
+    :param edges: A Dictionary of edge_id -> edge
+    :return: (incoming_edges, outgoing_edges), a tuple of Dictionaries of node_id to
+    list of incoming/outgoing edges to/from that node
+    """
+
+    incoming_edges = {}
+    outgoing_edges = {}
+
+    # Build maps which store all incoming and outgoing edges for every node
+    for edge_id in edges.keys():
+        edge = edges[edge_id]
+        if not incoming_edges.__contains__(edge.end):
+            incoming_edges[edge.end] = []
+        incoming_edges[edge.end].append(edge)
+
+        if not outgoing_edges.__contains__(edge.start):
+            outgoing_edges[edge.start] = []
+        outgoing_edges[edge.start].append(edge)
+
+    for edge_dict in [incoming_edges, outgoing_edges]:
+        for edge_id in edge_dict:
+            edges = edge_dict[edge_id]
+            edge_dict[edge_id] = sorted(edges, key=lambda x: x.id)
+
+    return incoming_edges, outgoing_edges
+
+
+class EntityPool:
+    """
+    A flyweight pool of the nodes and edges of one query result. Overlapping records of a
+    result share nodes and edges (e.g. a hub process in hundreds of matches), so each distinct
+    node and edge is stored here once, and the Graph of every record refers to it by index
+    through a PooledNode or PooledEdge.
+
+    The pooled labels and properties are never modified. Changes made through a PooledNode or
+    PooledEdge are kept on that object only (copy-on-write), so every Graph can be cleaned or
+    edited (e.g. by synthesise_training_data) without affecting the others.
+    """
+
+    def __init__(self):
+        """
+        Initialises an empty EntityPool.
+        """
+
+        self._node_index = {}
+        self.node_ids = []
+        self.node_labels = []
+        self.node_properties = []
+
+        self._edge_index = {}
+        self.edge_ids = []
+        self.edge_starts = []
+        self.edge_ends = []
+        self.edge_types = []
+        self.edge_properties = []
+
+    def node_count(self):
+        return len(self.node_ids)
+
+    def edge_count(self):
+        return len(self.edge_ids)
+
+    def node(self, node):
+        """
+        Adds a node to the pool if it is not already pooled.
+
+        :param node: A neo4j Node (or any object with id, labels and properties)
+        :return: A new PooledNode referring to the pooled node
+        """
+
+        index = self._node_index.get(node.id)
+        if index is None:
+            index = len(self.node_ids)
+            self._node_index[node.id] = index
+            self.node_ids.append(node.id)
+            self.node_labels.append(frozenset(getattr(node, 'labels', ())))
+            self.node_properties.append(dict(node.properties))
+
+        return PooledNode(self, index)
+
+    def edge(self, edge):
+        """
+        Adds an edge to the pool if it is not already pooled.
+
+        :param edge: A neo4j Relationship (or any object with id, start, end, type and properties)
+        :return: A new PooledEdge referring to the pooled edge
+        """
+
+        index = self._edge_index.get(edge.id)
+        if index is None:
+            index = len(self.edge_ids)
+            self._edge_index[edge.id] = index
+            self.edge_ids.append(edge.id)
+            self.edge_starts.append(edge.start)
+            self.edge_ends.append(edge.end)
+            self.edge_types.append(edge.type)
+            self.edge_properties.append(dict(getattr(edge, 'properties', {})))
+
+        return PooledEdge(self, index)
+
+
+class CopyOnWriteDict(MutableMapping):
+    """
+    A Dictionary which reads from a shared base Dictionary until it is first modified, at which
+    point it copies the base and modifies the copy.
+    """
+
+    def __init__(self, base):
+        self._base = base
+        self._own = None
+
+    def _current(self):
+        return self._base if self._own is None else self._own
+
+    def _writable(self):
+        if self._own is None:
+            self._own = dict(self._base)
+        return self._own
+
+    def __getitem__(self, key):
+        return self._current()[key]
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+
+    def __contains__(self, key):
+        return key in self._current()
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+    def __repr__(self):
+        return repr(self._current())
+
+
+class PooledNode:
+    """
+    A node of one Graph which refers to a node stored in an EntityPool. Assigning labels or
+    modifying properties only affects this object.
+    """
+
+    __slots__ = ('_pool', '_index', '_labels', '_properties')
+
+    def __init__(self, pool, index):
+        self._pool = pool
+        self._index = index
+        self._labels = None
+        self._properties = None
+
+    @property
+    def id(self):
+        return self._pool.node_ids[self._index]
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            return self._pool.node_labels[self._index]
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = labels
+
+    @property
+    def properties(self):
+        if self._properties is None:
+            self._properties = CopyOnWriteDict(self._pool.node_properties[self._index])
+        return self._properties
+
+
+class PooledEdge:
+    """
+    An edge of one Graph which refers to an edge stored in an EntityPool. Assigning the start,
+    end or type or modifying properties only affects this object.
+    """
+
+    __slots__ = ('_pool', '_index', '_start', '_end', '_type', '_properties')
+
+    def __init__(self, pool, index):
+        self._pool = pool
+        self._index = index
+        self._start = None
+        self._end = None
+        self._type = None
+        self._properties = None
+
+    @property
+    def id(self):
+        return self._pool.edge_ids[self._index]
+
+    @property
+    def start(self):
+        if self._start is None:
+            return self._pool.edge_starts[self._index]
+        return self._start
+
+    @start.setter
+    def start(self, start):
+        self._start = start
+
+    @property
+    def end(self):
+        if self._end is None:
+            return self._pool.edge_ends[self._index]
+        return self._end
+
+    @end.setter
+    def end(self, end):
+        self._end = end
+
+    @property
+    def type(self):
+        if self._type is None:
+            return self._pool.edge_types[self._index]
+        return self._type
+
+    @type.setter
+    def type(self, edge_type):
+        self._type = edge_type
+
+    @property
+    def properties(self):
+        if self._properties is None:
+            self._properties = CopyOnWriteDict(self._pool.edge_properties[self._index])
+        return self._properties
+
+
+class CompactGraph:
+    """
+    An array-backed, read-only Graph. Node and edge ids are remapped to dense indices (in
+    ascending id order), labels, edge types and states are stored as small integer codes,
+    properties are stored in typed columns (see columns.py), and the incoming and outgoing
+    adjacency of every node is stored in CSR form:
+
+    the incoming edges of the node with index i are in_edges[in_indptr[i]:in_indptr[i+1]],
+    and the nodes at the other end of those edges are in_indices[in_indptr[i]:in_indptr[i+1]].
+    Within a row, edges are ordered by edge id, as they are in build_in_out_edges.
+
+    No object is kept per node or edge: node() and edge() build a LocalNode or LocalEdge from
+    the columns on every call, so the objects returned can be modified without changing the
+    graph. Code on a hot path should use the index arrays directly.
+
+    The nodes, edges, incoming_edges and outgoing_edges attributes are read-only Mappings
+    with the same keys and values as those of a Graph, so code which only reads a Graph
+    can be given a CompactGraph instead. Each lookup in them is a binary search over the ids.
+    Use to_graph() to get a Graph which can be mutated.
+    """
+
+    def __init__(self, node_ids, node_labels, label_sets, edge_ids, edge_start, edge_end,
+                 edge_type, edge_state, type_names, state_names, node_columns=None,
+                 edge_columns=None, csr=None):
+        """
+        Initialises the CompactGraph object. Use to_compact_graph() to build one from a Graph.
+
+        :param node_ids: A sorted 1D ndarray of node ids. The index of an id is the node index
+        :param node_labels: A 1D int16 ndarray of the label set code of every node
+        :param label_sets: A list of lists of labels. The label set code of a node indexes it
+        :param edge_ids: A sorted 1D ndarray of edge ids. The index of an id is the edge index
+        :param edge_start: A 1D int32 ndarray of the start node index of every edge
+        :param edge_end: A 1D int32 ndarray of the end node index of every edge
+        :param edge_type: A 1D int16 ndarray of the type code of every edge
+        :param edge_state: A 1D int16 ndarray of the state code of every edge, MISSING_CODE if none
+        :param type_names: A list of edge types. The type code of an edge indexes this list
+        :param state_names: A list of edge states. The state code of an edge indexes this list
+        :param node_columns: A Dictionary of property name -> Column of the node properties
+        :param edge_columns: A Dictionary of property name -> Column of the edge properties,
+        except 'state'
+        :param csr: An optional tuple of the arrays (in_indptr, in_indices, in_edges,
+        out_indptr, out_indices, out_edges), built from edge_start and edge_end if not given
+        """
+
+        self.node_ids = node_ids
+        self.node_labels = node_labels
+        self.label_sets = label_sets
+        self.edge_ids = edge_ids
+        self.edge_start = edge_start
+        self.edge_end = edge_end
+        self.edge_type = edge_type
+        self.edge_state = edge_state
+        self.type_names = type_names
+        self.state_names = state_names
+        self.node_columns = node_columns if node_columns is not None else {}
+        self.edge_columns = edge_columns if edge_columns is not None else {}
+        self._property_store = None
+
+        if csr is None:
+            node_count = len(node_ids)
+            csr = build_csr(edge_end, edge_start, node_count) + \
+                build_csr(edge_start, edge_end, node_count)
+        self.in_indptr, self.in_indices, self.in_edges = csr[:3]
+        self.out_indptr, self.out_indices, self.out_edges = csr[3:]
+
+        self.nodes = _NodeMapping(self)
+        self.edges = _EdgeMapping(self)
+        self.incoming_edges = _AdjacencyMapping(self, True)
+        self.outgoing_edges = _AdjacencyMapping(self, False)
+
+    def node_count(self):
+        """
+        :return: The number of nodes
+        """
+
+        return len(self.node_ids)
+
+    def edge_count(self):
+        """
+        :return: The number of edges
+        """
+
+        return len(self.edge_ids)
+
+    def node(self, index):
+        """
+        Builds the node with the given node index.
+
+        :param index: An integer node index
+        :return: A LocalNode
+        """
+
+        index = int(index)
+        properties = {}
+        for name, column in self.node_columns.items():
+            value = column.get(index)
+            if value is not None:
+                properties[name] = value
+
+        return LocalNode(int(self.node_ids[index]), set(self.label_sets[self.node_labels[index]]),
+                         properties)
+
+    def edge(self, index):
+        """
+        Builds the edge with the given edge index.
+
+        :param index: An integer edge index
+        :return: A LocalEdge
+        """
+
+        index = int(index)
+        properties = {}
+        for name, column in self.edge_columns.items():
+            value = column.get(index)
+            if value is not None:
+                properties[name] = value
+        state = self.edge_state[index]
+        if state != MISSING_CODE:
+            properties['state'] = self.state_names[state]
+
+        return LocalEdge(int(self.edge_ids[index]), int(self.node_ids[self.edge_start[index]]),
+                         int(self.node_ids[self.edge_end[index]]),
+                         self.type_names[self.edge_type[index]], properties)
+
+    def edge_values(self, name):
+        """
+        Reads one property of every edge from its column, without building the edges.
+
+        :param name: An edge property name
+        :return: A list of the value of every edge, in edge index order, None for edges
+        without the property
+        """
+
+        if name == 'state':
+            return [self.state_names[code] if code != MISSING_CODE else None
+                    for code in self.edge_state.tolist()]
+        if name not in self.edge_columns:
+            return [None] * self.edge_count()
+        return self.edge_columns[name].get_all()
+
+    def node_values(self, name):
+        """
+        Reads one property of every node from its column, without building the nodes.
+
+        :param name: A node property name
+        :return: A list of the value of every node, in node index order, None for nodes
+        without the property
+        """
+
+        if name not in self.node_columns:
+            return [None] * self.node_count()
+        return self.node_columns[name].get_all()
+
+    def index_of(self, node_id):
+        """
+        Returns the node index of a node id, or -1 if the node is not in the graph.
+
+        :param node_id: A node id
+        :return: An integer
+        """
+
+        index = int(np.searchsorted(self.node_ids, node_id))
+        if index < len(self.node_ids) and self.node_ids[index] == node_id:
+            return index
+        return -1
+
+    def indices_of(self, node_ids):
+        """
+        Vectorised index_of.
+
+        :param node_ids: A 1D ndarray (or list) of node ids
+        :return: A 1D int64 ndarray of node indices, -1 for ids not in the graph
+        """
+
+        return lookup_indices(self.node_ids, np.asarray(node_ids, dtype=np.int64))
+
+    def get_property_store(self):
+        """
+        Returns the columnar store of the HASH_PROPERTIES of every node, indexed by node index.
+        The store is built on first use.
+
+        :return: A PropertyStore object
+        """
+
+        if self._property_store is None:
+            from data_processing.property_store import build_property_store
+            self._property_store = build_property_store(self.nodes.values())
+        return self._property_store
+
+    def remove_nodes(self, nodes):
+        """
+        Builds a CompactGraph without the given nodes and every edge incident to them.
+        The arrays and columns are filtered with masks in one pass; this graph is not modified.
+
+        :param nodes: A boolean ndarray of length node_count() which is True for nodes to
+        remove, or an iterable of node ids
+        :return: A new CompactGraph object
+        """
+
+        if isinstance(nodes, np.ndarray) and nodes.dtype == bool:
+            removed = nodes
+        else:
+            removed = np.zeros(len(self.node_ids), dtype=bool)
+            indices = self.indices_of(np.fromiter(nodes, dtype=np.int64))
+            removed[indices[indices >= 0]] = True
+
+        keep_nodes = ~removed
+        keep_edges = keep_nodes[self.edge_start] & keep_nodes[self.edge_end]
+        new_index = np.cumsum(keep_nodes, dtype=np.int64) - 1
+
+        kept_nodes = np.flatnonzero(keep_nodes)
+        kept_edges = np.flatnonzero(keep_edges)
+        return CompactGraph(
+            self.node_ids[kept_nodes],
+            self.node_labels[kept_nodes],
+            self.label_sets,
+            self.edge_ids[kept_edges],
+            new_index[self.edge_start[kept_edges]].astype(np.int32),
+            new_index[self.edge_end[kept_edges]].astype(np.int32),
+            self.edge_type[kept_edges],
+            self.edge_state[kept_edges],
+            self.type_names,
+            self.state_names,
+            {name: column.take(kept_nodes) for name, column in self.node_columns.items()},
+            {name: column.take(kept_edges) for name, column in self.edge_columns.items()})
+
+    def in_degree(self):
+        return np.diff(self.in_indptr)
+
+    def out_degree(self):
+        return np.diff(self.out_indptr)
+
+    def to_graph(self):
+        """
+        Builds a mutable Graph with the same nodes and edges.
+
+        :return: A Graph object
+        """
+
+        nodes = {int(node_id): self.node(idx) for idx, node_id in enumerate(self.node_ids)}
+        edges = {int(edge_id): self.edge(idx) for idx, edge_id in enumerate(self.edge_ids)}
+        incoming_edges, outgoing_edges = build_in_out_edges(edges)
+        return Graph(nodes, edges, incoming_edges, outgoing_edges)
+
+
+class _NodeMapping(Mapping):
+    """
+    Read-only node_id -> node view of a CompactGraph.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, node_id):
+        index = self._graph.index_of(node_id)
+        if index < 0:
+            raise KeyError(node_id)
+        return self._graph.node(index)
+
+    def __contains__(self, node_id):
+        return self._graph.index_of(node_id) >= 0
+
+    def __iter__(self):
+        return (int(node_id) for node_id in self._graph.node_ids)
+
+    def __len__(self):
+        return len(self._graph.node_ids)
+
+    def values(self):
+        return [self._graph.node(idx) for idx in range(len(self._graph.node_ids))]
+
+
+class _EdgeMapping(Mapping):
+    """
+    Read-only edge_id -> edge view of a CompactGraph.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def _index(self, edge_id):
+        return int(lookup_indices(self._graph.edge_ids, np.asarray([edge_id]))[0])
+
+    def __getitem__(self, edge_id):
+        index = self._index(edge_id)
+        if index < 0:
+            raise KeyError(edge_id)
+        return self._graph.edge(index)
+
+    def __contains__(self, edge_id):
+        return self._index(edge_id) >= 0
+
+    def __iter__(self):
+        return (int(edge_id) for edge_id in self._graph.edge_ids)
+
+    def __len__(self):
+        return len(self._graph.edge_ids)
+
+    def values(self):
+        return [self._graph.edge(idx) for idx in range(len(self._graph.edge_ids))]
+
+
+class _AdjacencyMapping(Mapping):
+    """
+    Read-only node_id -> list of incoming/outgoing edges view of a CompactGraph. Like the
+    dictionaries built by build_in_out_edges, only nodes with at least one such edge are keys.
+    """
+
+    def __init__(self, graph, is_incoming):
+        self._graph = graph
+        if is_incoming:
+            self._indptr = graph.in_indptr
+            self._edge_indices = graph.in_edges
+        else:
+            self._indptr = graph.out_indptr
+            self._edge_indices = graph.out_edges
+
+    def _row(self, node_id):
+        index = self._graph.index_of(node_id)
+        if index < 0 or self._indptr[index] == self._indptr[index+1]:
+            return None
+        return self._edge_indices[self._indptr[index]:self._indptr[index+1]]
+
+    def __getitem__(self, node_id):
+        row = self._row(node_id)
+        if row is None:
+            raise KeyError(node_id)
+        return [self._graph.edge(idx) for idx in row]
+
+    def __contains__(self, node_id):
+        return self._row(node_id) is not None
+
+    def __iter__(self):
+        has_edges = np.flatnonzero(np.diff(self._indptr))
+        return (int(node_id) for node_id in self._graph.node_ids[has_edges])
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self._indptr)))
+
+
+def lookup_indices(sorted_ids, ids):
+    """
+    Finds the position of every id in a sorted array of unique ids.
+
+    :param sorted_ids: A sorted 1D ndarray of unique ids
+    :param ids: A 1D ndarray of ids to look up
+    :return: A 1D int64 ndarray of positions, -1 for ids which are not in sorted_ids
+    """
+
+    positions = np.searchsorted(sorted_ids, ids)
+    positions = np.minimum(positions, max(len(sorted_ids)-1, 0))
+    if len(sorted_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+
+    found = sorted_ids[positions] == ids
+    return np.where(found, positions, -1).astype(np.int64)
+
+
+def gather_rows(indptr, values, rows):
+    """
+    Reads several rows of a CSR array at once.
+
+    :param indptr: The 1D row pointer ndarray of the CSR array
+    :param values: The 1D ndarray of values of the CSR array (e.g. in_indices or in_edges)
+    :param rows: A 1D integer ndarray of row numbers
+    :return: A 1D ndarray of the values of the rows, concatenated in the order of rows
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = indptr[rows].astype(np.int64)
+    lengths = indptr[rows + 1].astype(np.int64) - starts
+    total = int(lengths.sum())
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return values[np.repeat(starts, lengths) + np.arange(total) - offsets]
+
+
+def build_csr(rows, columns, row_count):
+    """
+    Builds a CSR representation of a set of (row, column) pairs, one pair per edge. Edges keep
+    their relative order within each row.
+
+    :param rows: A 1D integer ndarray of the row (node index) of every edge
+    :param columns: A 1D integer ndarray of the column (other node index) of every edge
+    :param row_count: The number of rows
+    :return: A tuple of 1D ndarrays (indptr, indices, edge_indices)
+    """
+
+    order = np.argsort(rows, kind='stable').astype(np.int32)
+    counts = np.bincount(rows, minlength=row_count)
+    indptr = np.zeros(row_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, columns[order].astype(np.int32), order
+
+
+def encode_values(values):
+    """
+    Dictionary-encodes a list of hashable values into small integer codes. None is encoded
+    as MISSING_CODE.
+
+    :param values: A list of values
+    :return: A tuple (codes, names). codes is a 1D int16 ndarray, names is a list of the
+    distinct values such that names[codes[i]] == values[i]
+    """
+
+    code_of = {}
+    names = []
+    codes = np.empty(len(values), dtype=np.int16)
+
+    for idx, value in enumerate(values):
+        if value is None:
+            codes[idx] = MISSING_CODE
+            continue
+        if value not in code_of:
+            code_of[value] = len(names)
+            names.append(value)
+        codes[idx] = code_of[value]
+
+    return codes, names
+
+
+def property_names(entities, exclude=()):
+    """
+    :param entities: An iterable of nodes or edges
+    :param exclude: Property names to leave out
+    :return: A sorted list of the property names used by any of the entities
+    """
+
+    names = set()
+    for entity in entities:
+        names.update(getattr(entity, 'properties', {}))
+    return sorted(names.difference(exclude))
+
+
+def build_property_columns(entities, names):
+    """
+    :param entities: A list of nodes or edges
+    :param names: A list of property names
+    :return: A Dictionary of property name -> Column, row i of which is the value of entities[i]
+    """
+
+    return {name: build_column(getattr(entity, 'properties', {}).get(name)
+                               for entity in entities)
+            for name in names}
+
+
+def to_compact_graph(graph, node_properties=None, edge_properties=None):
+    """
+    Builds a CompactGraph from a Graph. The properties are copied into columns, so the
+    CompactGraph does not refer to the node and edge objects of the Graph.
+
+    :param graph: A Graph object
+    :param node_properties: The node properties stored. Defaults to all of them
+    :param edge_properties: The edge properties stored besides 'state', which is always
+    stored as edge_state. Defaults to all of them
+    :return: A CompactGraph object
+    """
+
+    node_ids = np.asarray(sorted(graph.nodes.keys()), dtype=np.int64)
+    node_objects = [graph.nodes[node_id] for node_id in node_ids.tolist()]
+
+    edge_ids = np.asarray(sorted(graph.edges.keys()), dtype=np.int64)
+    edge_objects = [graph.edges[edge_id] for edge_id in edge_ids.tolist()]
+
+    starts = np.asarray([edge.start for edge in edge_objects], dtype=np.int64)
+    ends = np.asarray([edge.end for edge in edge_objects], dtype=np.int64)
+    edge_start = lookup_indices(node_ids, starts)
+    edge_end = lookup_indices(node_ids, ends)
+
+    dangling = np.flatnonzero((edge_start < 0) | (edge_end < 0))
+    if len(dangling) > 0:
+        edge = edge_objects[dangling[0]]
+        raise ValueError("Edge %s (%s -> %s) references a node which is not in the graph"
+                         % (edge.id, edge.start, edge.end))
+
+    node_labels, label_sets = encode_values(
+        [tuple(sorted(getattr(node, 'labels', ()))) for node in node_objects])
+    edge_type, type_names = encode_values([edge.type for edge in edge_objects])
+    edge_state, state_names = encode_values(
+        [getattr(edge, 'properties', {}).get('state') for edge in edge_objects])
+
+    if node_properties is None:
+        node_properties = property_names(node_objects)
+    if edge_properties is None:
+        edge_properties = property_names(edge_objects)
+    edge_properties = [name for name in edge_properties if name != 'state']
+
+    return CompactGraph(node_ids, node_labels, [list(labels) for labels in label_sets],
+                        edge_ids, edge_start.astype(np.int32), edge_end.astype(np.int32),
+                        edge_type, edge_state, type_names, state_names,
+                        build_property_columns(node_objects, node_properties),
+                        build_property_columns(edge_objects, edge_properties))
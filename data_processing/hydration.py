@@ -0,0 +1,109 @@
+"""
+Contains functions for a two-phase fetch of training data. The pattern queries first fetch only
+the structure of the matches (ids, labels, edge types and states, and the node properties the
+cleaning reads), so the graphs can be built, cleaned and balanced. The other node properties
+are then fetched by id, in batches, only for the graphs that are kept.
+"""
+
+import patchy_san.parameters as params
+from data_processing.projection import BASE_NODE_PROPERTIES, project_query
+
+# The number of node ids per hydration query
+DEFAULT_BATCH_SIZE = 1000
+
+
+def structure_query(query):
+    """
+    Rewrites a pattern query to fetch only the structure of its matches, see project_query.
+
+    :param query: A String whose RETURN clause only names path variables
+    :return: A String
+    """
+
+    return project_query(query, BASE_NODE_PROPERTIES)
+
+
+def hydrated_properties():
+    """
+    :return: A list of the node properties not fetched by structure_query which the pipeline
+    reads
+    """
+
+    return [name for name in params.HASH_PROPERTIES if name not in BASE_NODE_PROPERTIES]
+
+
+class PropertyHydrator:
+    """
+    Fetches the remaining properties of the nodes of graphs built from structure_query results.
+    Fetched properties are cached by node id, so nodes shared by several graphs (or seen again
+    in a later call) are only fetched once.
+    """
+
+    def __init__(self, run_query, properties=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Initialises the PropertyHydrator object.
+
+        :param run_query: A function (query, parameters) -> result, e.g.
+        neo4j_interface_fns.execute_query
+        :param properties: The node properties to fetch. Defaults to hydrated_properties()
+        :param batch_size: The number of node ids per query
+        """
+
+        self.run_query = run_query
+        self.properties = hydrated_properties() if properties is None else properties
+        self.batch_size = batch_size
+        self.cache = {}
+        self.queries = 0
+
+    def query(self):
+        return """
+    UNWIND $ids AS node_id
+    MATCH (n) WHERE Id(n) = node_id
+    RETURN node_id, n{%s} AS properties
+    """ % ', '.join('.' + name for name in self.properties)
+
+    def fetch(self, node_ids):
+        """
+        Fetches the properties of the nodes not in the cache yet. No query is run if there are
+        no properties to fetch.
+
+        :param node_ids: An iterable of node ids
+        :return: The number of nodes fetched
+        """
+
+        missing = sorted(set(node_ids).difference(self.cache))
+        if not self.properties:
+            # There is nothing to fetch (and n{} is not a valid projection)
+            self.cache.update((node_id, {}) for node_id in missing)
+            return 0
+
+        query = self.query()
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start+self.batch_size]
+            for node_id in batch:
+                self.cache[node_id] = {}
+
+            for record in self.run_query(query, {'ids': batch}):
+                self.cache[record['node_id']] = {name: value for name, value
+                                                 in record['properties'].items()
+                                                 if value is not None}
+            self.queries += 1
+
+        return len(missing)
+
+    def hydrate(self, graph_list):
+        """
+        Adds the fetched properties to the nodes of every graph.
+
+        :param graph_list: A list of Graph objects
+        :return: nothing
+        """
+
+        self.fetch(node_id for graph in graph_list for node_id in graph.nodes)
+
+        for graph in graph_list:
+            for node_id, node in graph.nodes.items():
+                properties = self.cache[node_id]
+                if properties:
+                    node.properties.update(properties)
@@ -0,0 +1,198 @@
+"""
+Contains functions to extract the neighbourhood of a node breadth first, bounded by a maximum
+depth and a maximum number of nodes, instead of by enumerating paths. Each step expands a whole
+frontier at once, so the work grows with the size of the neighbourhood rather than with the
+number of paths through it.
+
+It also contains functions to extract the union of all the paths between two nodes, as the
+nodes reachable from the first node which can also reach the second.
+
+The expansion is given as a function from a frontier (a list of node ids) to the ids of their
+neighbours, so the same search runs against the database (neo4j_interface_fns) or against a
+Graph or CompactGraph in memory.
+"""
+
+import numpy as np
+from data_processing.graphs import gather_rows
+from data_processing.preprocessing import get_graph_from_entities
+
+DIRECTIONS = ('in', 'out', 'both')
+
+
+def bounded_bfs(expand, start_ids, max_depth, max_nodes):
+    """
+    Visits nodes breadth first from a set of start nodes. Each level is expanded with one call
+    to expand. When a level would take the number of nodes above max_nodes, its nodes with the
+    lowest ids are kept.
+
+    :param expand: A function taking a list of node ids and returning an iterable of the ids
+    of their neighbours (repeats allowed)
+    :param start_ids: A list of node ids
+    :param max_depth: The maximum number of steps from a start node, or None for no limit
+    :param max_nodes: The maximum number of nodes visited, including the start nodes, or None
+    for no limit
+    :return: A list of the node ids visited, in the order visited
+    """
+
+    if max_depth is None:
+        max_depth = float('inf')
+    if max_nodes is None:
+        max_nodes = float('inf')
+
+    visited = set()
+    order = []
+    for node_id in start_ids:
+        if node_id not in visited and len(order) < max_nodes:
+            visited.add(node_id)
+            order.append(node_id)
+
+    frontier = list(order)
+    depth = 0
+
+    while frontier and depth < max_depth and len(order) < max_nodes:
+        new_ids = sorted(set(node_id for node_id in expand(frontier) if node_id not in visited))
+        if len(order) + len(new_ids) > max_nodes:
+            new_ids = new_ids[:int(max_nodes) - len(order)]
+
+        visited.update(new_ids)
+        order.extend(new_ids)
+        frontier = new_ids
+        depth += 1
+
+    return order
+
+
+def graph_expander(graph, direction='in'):
+    """
+    Creates an expand function for bounded_bfs which follows the edges of a graph in memory.
+
+    :param graph: A Graph or CompactGraph object
+    :param direction: 'in' to follow edges backwards (to the nodes with edges pointing to the
+    frontier), 'out' to follow them forwards, or 'both'
+    :return: A function taking a list of node ids and returning a list of node ids
+    """
+
+    if direction not in DIRECTIONS:
+        raise ValueError("direction must be one of %s, not %s" % (DIRECTIONS, direction))
+
+    if hasattr(graph, 'in_indptr'):
+        return csr_expander(graph, direction)
+
+    def expand(frontier):
+        neighbours = []
+        for node_id in frontier:
+            if direction != 'out':
+                neighbours.extend(edge.start for edge in graph.incoming_edges.get(node_id, []))
+            if direction != 'in':
+                neighbours.extend(edge.end for edge in graph.outgoing_edges.get(node_id, []))
+        return neighbours
+
+    return expand
+
+
+def csr_expander(graph, direction='in'):
+    """
+    graph_expander for a CompactGraph: the frontier is expanded by reading the CSR rows of all
+    its nodes at once, without building node or edge objects.
+
+    :param graph: A CompactGraph object
+    :param direction: 'in', 'out' or 'both', see graph_expander
+    :return: A function taking a list of node ids and returning a list of node ids
+    """
+
+    rows = []
+    if direction != 'out':
+        rows.append((graph.in_indptr, graph.in_indices))
+    if direction != 'in':
+        rows.append((graph.out_indptr, graph.out_indices))
+
+    def expand(frontier):
+        indices = graph.indices_of(frontier)
+        indices = indices[indices >= 0]
+        neighbours = [gather_rows(indptr, row_values, indices) for indptr, row_values in rows]
+        return graph.node_ids[np.concatenate(neighbours)].tolist()
+
+    return expand
+
+
+def induced_subgraph(graph, node_ids):
+    """
+    Builds the subgraph of a graph made of the given nodes and every edge between them.
+
+    :param graph: A Graph or CompactGraph object
+    :param node_ids: An iterable of node ids of the graph
+    :return: A Graph object sharing the node and edge objects of graph. For a CompactGraph,
+    the nodes and edges are built for the subgraph only
+    """
+
+    if hasattr(graph, 'out_indptr'):
+        node_ids = sorted(set(node_ids))
+        indices = graph.indices_of(node_ids)
+        if np.any(indices < 0):
+            raise KeyError(node_ids[int(np.flatnonzero(indices < 0)[0])])
+        edge_indices = gather_rows(graph.out_indptr, graph.out_edges, indices)
+        edge_indices = np.sort(edge_indices[np.isin(graph.edge_end[edge_indices], indices)])
+        return get_graph_from_entities([graph.node(index) for index in indices.tolist()],
+                                       [graph.edge(index) for index in edge_indices.tolist()])
+
+    node_ids = set(node_ids)
+    edges = [edge for node_id in node_ids for edge in graph.outgoing_edges.get(node_id, [])
+             if edge.end in node_ids]
+    return get_graph_from_entities([graph.nodes[node_id] for node_id in node_ids], edges)
+
+
+def get_local_neighbourhood(graph, start_id, max_depth, max_nodes, direction='in'):
+    """
+    In-memory version of neo4j_interface_fns.get_neighborhood_bounded.
+
+    :param graph: A Graph or CompactGraph object
+    :param start_id: The id of the start node
+    :param max_depth: The maximum number of steps from the start node
+    :param max_nodes: The maximum number of nodes in the neighbourhood
+    :param direction: 'in', 'out' or 'both', see graph_expander
+    :return: A Graph object of the neighbourhood and every edge between its nodes
+    """
+
+    node_ids = bounded_bfs(graph_expander(graph, direction), [start_id], max_depth, max_nodes)
+    return induced_subgraph(graph, node_ids)
+
+
+def path_union_ids(forward, backward, root_id, end_id, max_depth=None):
+    """
+    Finds the nodes on a path from a root node to an end node: the nodes reachable from the
+    root (one forward sweep) which can also reach the end (one backward sweep, which only
+    visits nodes found by the forward sweep). No paths are enumerated.
+
+    :param forward: An expand function following edges forwards, see bounded_bfs
+    :param backward: An expand function following edges backwards
+    :param root_id: The id of the root node
+    :param end_id: The id of the end node
+    :param max_depth: The maximum number of steps of each sweep, or None for no limit
+    :return: A set of node ids, empty if the end is not reachable from the root
+    """
+
+    reachable = set(bounded_bfs(forward, [root_id], max_depth, None))
+    if end_id not in reachable:
+        return set()
+
+    def backward_within(frontier):
+        return [node_id for node_id in backward(frontier) if node_id in reachable]
+
+    return set(bounded_bfs(backward_within, [end_id], max_depth, None))
+
+
+def get_local_path_union(graph, root_id, end_id, max_depth=None):
+    """
+    In-memory version of neo4j_interface_fns.get_path_union.
+
+    :param graph: A Graph or CompactGraph object
+    :param root_id: The id of the root node
+    :param end_id: The id of the end node
+    :param max_depth: The maximum number of steps of each sweep, or None for no limit
+    :return: A Graph object of the nodes on a path from the root to the end, and the edges
+    between them
+    """
+
+    node_ids = path_union_ids(graph_expander(graph, 'out'), graph_expander(graph, 'in'),
+                              root_id, end_id, max_depth)
+    return induced_subgraph(graph, node_ids)
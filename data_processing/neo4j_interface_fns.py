@@ -1,10 +1,238 @@
 """
 This module contains functions to extract data from a neo4j database.
 
+All queries go through one shared driver, managed by a DriverManager, which pools connections
+instead of opening a new driver (and Bolt handshake) per query. Call configure_driver() to
+change the database location, credentials or pool size, and close_driver() when done.
+
+If a query cache has been enabled with query_cache.configure_query_cache(), execute_query
+returns cached results where possible, so repeated experiments do not query the database.
+
 Dependencies: neo4j-driver
 """
 
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from neo4j.v1 import GraphDatabase, basic_auth
+from data_processing.query_cache import get_query_cache
+from data_processing import pagination
+from data_processing.neighbourhood import bounded_bfs, path_union_ids
+from data_processing.preprocessing import get_graph_from_entities
+from data_processing.records import LocalNode, LocalEdge, encode_result, decode_result
+from data_processing.snapshot import SnapshotWriter
+
+DEFAULT_URI = "bolt://localhost:7687"
+DEFAULT_USER = "neo4j"
+DEFAULT_PASSWORD = "neo4j"
+DEFAULT_POOL_SIZE = 16
+
+# The number of node or edge ids per query of export_snapshot
+EXPORT_BATCH_SIZE = 10000
+
+# Queries returning the ids of the neighbours of a frontier of nodes, by direction (see
+# neighbourhood.graph_expander)
+NEIGHBOUR_QUERIES = {
+    'in': """
+    UNWIND $ids AS node_id
+    MATCH (n)<-[]-(m) WHERE Id(n) = node_id
+    RETURN DISTINCT Id(m) AS neighbour
+    """,
+    'out': """
+    UNWIND $ids AS node_id
+    MATCH (n)-[]->(m) WHERE Id(n) = node_id
+    RETURN DISTINCT Id(m) AS neighbour
+    """,
+    'both': """
+    UNWIND $ids AS node_id
+    MATCH (n)-[]-(m) WHERE Id(n) = node_id
+    RETURN DISTINCT Id(m) AS neighbour
+    """,
+}
+
+
+class DriverManager:
+    """
+    Owns a neo4j driver shared by all the query helpers. At most pool_size sessions are open
+    at once; callers wanting a session wait for a free slot. The number of sessions acquired
+    and the total and maximum time spent waiting are kept, to help size the pool.
+
+    Slots are reentrant per thread: a session opened while the same thread already holds one
+    (e.g. a query run while the records of another are read) reuses the open session instead
+    of waiting for a second slot, which would deadlock once every slot is held by such a
+    thread.
+    """
+
+    def __init__(self, uri=DEFAULT_URI, user=DEFAULT_USER, password=DEFAULT_PASSWORD,
+                 pool_size=DEFAULT_POOL_SIZE):
+        """
+        Initialises the DriverManager object. The driver itself is created on first use.
+
+        :param uri: The Bolt URI of the database
+        :param user: The user name
+        :param password: The password
+        :param pool_size: The maximum number of connections (and open sessions)
+        """
+
+        self.uri = uri
+        self.pool_size = pool_size
+        self._auth = basic_auth(user, password)
+        self._driver = None
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def driver(self):
+        """
+        :return: The shared neo4j Driver, created if necessary
+        """
+
+        with self._lock:
+            if self._driver is None:
+                self._driver = GraphDatabase.driver(
+                    self.uri, auth=self._auth, max_connection_pool_size=self.pool_size)
+            return self._driver
+
+    @contextmanager
+    def session(self):
+        """
+        A context manager which waits for a free slot in the pool, then opens a session on the
+        shared driver. The session is closed and the slot freed on exit. If the thread already
+        holds a session, that session is yielded again without taking another slot.
+
+        :return: A neo4j Session
+        """
+
+        held = getattr(self._local, 'session', None)
+        if held is not None:
+            yield held
+            return
+
+        start = time.time()
+        self._slots.acquire()
+        waited = time.time() - start
+
+        with self._lock:
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        try:
+            db_session = self.driver().session()
+            self._local.session = db_session
+            try:
+                yield db_session
+            finally:
+                self._local.session = None
+                db_session.close()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """
+        :return: A Dictionary with the number of sessions acquired and the total, mean and
+        maximum time (seconds) spent waiting for a free slot
+        """
+
+        with self._lock:
+            return {
+                'acquired': self.acquired,
+                'total_wait': self.total_wait,
+                'mean_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+    def close(self):
+        """
+        Closes the driver and all its pooled connections.
+
+        :return: nothing
+        """
+
+        with self._lock:
+            if self._driver is not None:
+                self._driver.close()
+                self._driver = None
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def configure_driver(uri=DEFAULT_URI, user=DEFAULT_USER, password=DEFAULT_PASSWORD,
+                     pool_size=DEFAULT_POOL_SIZE):
+    """
+    Replaces the shared driver with one for the given database and pool size. The previous
+    driver, if any, is closed.
+
+    :param uri: The Bolt URI of the database
+    :param user: The user name
+    :param password: The password
+    :param pool_size: The maximum number of connections (and open sessions)
+    :return: The new DriverManager
+    """
+
+    global _manager
+
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close()
+        _manager = DriverManager(uri, user, password, pool_size)
+        return _manager
+
+
+def get_driver_manager():
+    """
+    :return: The shared DriverManager, created with the default settings if necessary
+    """
+
+    global _manager
+
+    with _manager_lock:
+        if _manager is None:
+            _manager = DriverManager()
+        return _manager
+
+
+def session():
+    """
+    A context manager for a session on the shared driver, e.g.
+
+    with session() as db_session:
+        results = db_session.run(query)
+
+    :return: A context manager yielding a neo4j Session
+    """
+
+    return get_driver_manager().session()
+
+
+def pool_stats():
+    """
+    :return: The statistics of the shared DriverManager, see DriverManager.stats
+    """
+
+    return get_driver_manager().stats()
+
+
+def close_driver():
+    """
+    Closes the shared driver. A new one is created by the next query.
+
+    :return: nothing
+    """
+
+    global _manager
+
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close()
+            _manager = None
 
 
 def get_subgraph_paths(root_id, end_id):
@@ -12,21 +240,23 @@ def get_subgraph_paths(root_id, end_id):
     Queries the neo4j database for all paths starting from a root node and ending
     at an end node
 
+    Every path is enumerated, so this can be very slow on large graphs; get_path_union
+    returns the same nodes and edges as a Graph without enumerating paths.
+
     :param root_id: The database Id of the root node
     :param end_id: The database Id of the end node
     :return: A BoltStatementResult object describing all paths between root node
     specified by root_id, and end node specified by end_id.
     """
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=basic_auth("neo4j", "neo4j"))
-    session = driver.session()
 
     query = """
     MATCH path=(n)-[r*]->(m)
     WHERE Id(n) = $id1 AND Id(m) = $id2
     RETURN path
     """
-    results = session.run(query, {"id1": root_id, "id2": end_id})
-    session.close()
+
+    with session() as db_session:
+        results = db_session.run(query, {"id1": root_id, "id2": end_id})
     return results
 
 
@@ -36,12 +266,13 @@ def get_neighborhood(start_id, k):
     all nodes with edges pointing to the start node, all nodes with edges pointing to these
     nodes until neighborhood has size k. Similar idea to the bacon number.
 
+    Every path is enumerated, so this can be very slow on large graphs; see
+    get_neighborhood_bounded.
+
     :param start_id: The Id of start node
     :param k: Neighborhood size
     :return: A BoltStatementResult object describing all paths in the neighborhood
     """
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=basic_auth("neo4j", "neo4j"))
-    session = driver.session()
 
     query = """
     MATCH path=(n)-[r*]->(m) WHERE
@@ -49,22 +280,267 @@ def get_neighborhood(start_id, k):
     RETURN path
     LIMIT $num
     """
-    results = session.run(query, {"id": start_id, "num": k})
-    session.close()
+
+    with session() as db_session:
+        results = db_session.run(query, {"id": start_id, "num": k})
     return results
 
 
-def execute_query(query):
+def expand_frontier(frontier, direction='in'):
+    """
+    Fetches the ids of the neighbours of a frontier of nodes with one query.
+
+    :param frontier: A list of node ids
+    :param direction: 'in', 'out' or 'both', see neighbourhood.graph_expander
+    :return: A list of node ids
+    """
+
+    results = execute_query(NEIGHBOUR_QUERIES[direction], {'ids': list(frontier)})
+    return [record['neighbour'] for record in results]
+
+
+def get_graph_by_ids(node_ids):
     """
-    Executes a given query.
+    Fetches a set of nodes and every edge between them.
+
+    :param node_ids: A list of node ids
+    :return: A Graph object
+    """
+
+    node_query = """
+    MATCH (n) WHERE Id(n) IN $ids
+    RETURN n
+    """
+
+    edge_query = """
+    MATCH (n)-[r]->(m) WHERE Id(n) IN $ids AND Id(m) IN $ids
+    RETURN r
+    """
+
+    node_ids = list(node_ids)
+    node_results, edge_results = execute_queries([(node_query, {'ids': node_ids}),
+                                                  (edge_query, {'ids': node_ids})])
+    return get_graph_from_entities((record['n'] for record in node_results),
+                                   (record['r'] for record in edge_results))
+
+
+def get_neighborhood_bounded(start_id, max_depth, max_nodes, direction='in'):
+    """
+    Bounded replacement for get_neighborhood. The neighbourhood is expanded breadth first, one
+    query per level, until it is max_depth steps deep or holds max_nodes nodes. Its nodes and
+    the edges between them are then fetched once each, however many paths join them.
+
+    :param start_id: The Id of the start node
+    :param max_depth: The maximum number of steps from the start node
+    :param max_nodes: The maximum number of nodes in the neighbourhood
+    :param direction: 'in' (the default, as get_neighborhood) for the nodes with paths to the
+    start node, 'out' for the nodes reachable from it, or 'both'
+    :return: A Graph object
+    """
+
+    node_ids = bounded_bfs(lambda frontier: expand_frontier(frontier, direction), [start_id],
+                           max_depth, max_nodes)
+    return get_graph_by_ids(node_ids)
+
+
+def get_path_union(root_id, end_id, max_depth=None):
+    """
+    Fetches the union of all paths from a root node to an end node: the nodes reachable from
+    the root which can also reach the end, and the edges between them (see
+    neighbourhood.path_union_ids). Each sweep runs one query per level, so the cost grows with
+    the size of the subgraph rather than the number of paths.
+
+    :param root_id: The database Id of the root node
+    :param end_id: The database Id of the end node
+    :param max_depth: The maximum number of steps of each sweep, or None for no limit
+    :return: A Graph object, empty if there is no path
+    """
+
+    node_ids = path_union_ids(lambda frontier: expand_frontier(frontier, 'out'),
+                              lambda frontier: expand_frontier(frontier, 'in'),
+                              root_id, end_id, max_depth)
+    return get_graph_by_ids(sorted(node_ids))
+
+
+def execute_query(query, parameters=None, use_cache=True):
+    """
+    Executes a given query. If the query cache is enabled, the result is looked up in the
+    cache first, and stored in it if the database had to be queried.
 
     :param query: A String representing the query to be executed
-    :return: A BoltStatementResult object
+    :param parameters: An optional Dictionary of query parameters
+    :param use_cache: Whether the query cache (if enabled) may be used
+    :return: A BoltStatementResult object, or a LocalResult object if the cache is used
     """
 
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=basic_auth("neo4j", "neo4j"))
-    session = driver.session()
+    cache = get_query_cache() if use_cache else None
+    if cache is not None:
+        cached = cache.get(query, parameters)
+        if cached is not None:
+            return cached
+
+    with session() as db_session:
+        results = db_session.run(query, parameters or {})
 
-    results = session.run(query)
-    session.close()
+    if cache is not None:
+        return cache.put(query, parameters, results)
     return results
+
+
+def stream_query(query, parameters=None):
+    """
+    Executes a query and yields its records as the driver receives them. The session is held
+    open until every record has been read (or the generator is closed), so the result is never
+    buffered as a whole, unlike a result returned by execute_query. The query cache is not
+    used.
+
+    :param query: A String representing the query to be executed
+    :param parameters: An optional Dictionary of query parameters
+    :return: A generator of Records
+    """
+
+    with session() as db_session:
+        for record in db_session.run(query, parameters or {}):
+            yield record
+
+
+def iter_queries(queries, workers=None):
+    """
+    Executes several queries concurrently, each in its own pooled session, and yields their
+    results in the same order as the queries. Each result is yielded as soon as it and all
+    results before it are ready, so the total time is roughly that of the slowest query.
+
+    Identical queries (with identical parameters) are only run once. The records of their
+    result are fetched, and each repeat is given its own LocalResult with the same records.
+
+    :param queries: A list of queries. Each is a String, or a tuple of (String, Dictionary of
+    parameters)
+    :param workers: The number of queries run at once. Defaults to the number of distinct
+    queries, capped at the pool size of the shared driver
+    :return: A generator of BoltStatementResult (or LocalResult) objects
+    """
+
+    if not queries:
+        return
+
+    queries = [query if isinstance(query, tuple) else (query, None) for query in queries]
+    keys = [json.dumps([query, parameters or {}], sort_keys=True, default=str)
+            for query, parameters in queries]
+    counts = {}
+    for key in keys:
+        counts[key] = counts.get(key, 0) + 1
+
+    if workers is None:
+        workers = min(len(counts), get_driver_manager().pool_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for key, (query, parameters) in zip(keys, queries):
+            if key not in futures:
+                futures[key] = executor.submit(execute_query, query, parameters)
+
+        encoded = {}
+        for key in keys:
+            if counts[key] == 1:
+                yield futures[key].result()
+                continue
+
+            if key not in encoded:
+                encoded[key] = encode_result(futures[key].result())
+            yield decode_result(encoded[key])
+
+
+def execute_queries(queries, workers=None):
+    """
+    Executes several queries concurrently, see iter_queries.
+
+    :param queries: A list of queries. Each is a String, or a tuple of (String, Dictionary of
+    parameters)
+    :param workers: The number of queries run at once
+    :return: A list of BoltStatementResult objects, in the same order as the queries
+    """
+
+    return list(iter_queries(queries, workers))
+
+
+def fetch_paginated(query, anchor, spool_dir, page_size=pagination.DEFAULT_PAGE_SIZE,
+                    max_page_bytes=pagination.DEFAULT_MAX_PAGE_BYTES, max_matches=None):
+    """
+    Fetches every match of a pattern query, page by page, into a spool directory (see
+    pagination.spool_pages). If spool_dir holds an unfinished fetch of the same query, the
+    fetch resumes after its last complete page. The queries are run with stream_query, so the
+    records of a page are spooled as they arrive rather than buffered by the driver or the
+    query cache.
+
+    :param query: A pattern query. Any LIMIT is dropped
+    :param anchor: The name of the node variable of the query to paginate on
+    :param spool_dir: The directory the pages are written to
+    :param page_size: The number of anchor nodes per page
+    :param max_page_bytes: The maximum size of the records held in memory, see
+    pagination.DEFAULT_MAX_PAGE_BYTES
+    :param max_matches: The maximum number of matches fetched, or None for all of them
+    :return: A SpooledResult object
+    """
+
+    for _ in pagination.spool_pages(stream_query, query, anchor, spool_dir, page_size,
+                                    max_page_bytes, max_matches):
+        pass
+    return pagination.SpooledResult(spool_dir)
+
+
+def export_snapshot(directory, batch_size=EXPORT_BATCH_SIZE, node_properties=None,
+                    edge_properties=None):
+    """
+    Exports every node and edge of the database to a local snapshot (see
+    snapshot.SnapshotWriter), which an OfflineStore can serve queries from without the
+    database. Nodes and edges are fetched in batches of consecutive ids, up to the largest id,
+    and each batch looks its entities up by id rather than scanning the whole store again.
+
+    :param directory: The directory to write the snapshot to
+    :param batch_size: The number of node or edge ids per query
+    :param node_properties: See SnapshotWriter
+    :param edge_properties: See SnapshotWriter
+    :return: The directory of the snapshot
+    """
+
+    writer = SnapshotWriter(directory, node_properties, edge_properties)
+
+    def projection(variable, names):
+        # n{} is not a valid projection
+        if not names:
+            return '{}'
+        return '%s{%s}' % (variable, ', '.join('.' + name for name in names))
+
+    node_query = """
+    UNWIND range($start, $end) AS node_id
+    MATCH (n) WHERE Id(n) = node_id
+    RETURN Id(n) AS id, labels(n) AS labels, %s AS properties
+    """ % projection('n', writer.node_properties)
+
+    edge_query = """
+    UNWIND range($start, $end) AS edge_id
+    MATCH (a)-[r]->(b) WHERE Id(r) = edge_id
+    RETURN Id(r) AS id, Id(a) AS start, Id(b) AS end, type(r) AS type, %s AS properties
+    """ % projection('r', writer.edge_properties + ['state'])
+
+    def make_node(record, properties):
+        return LocalNode(record['id'], set(record['labels']), properties)
+
+    def make_edge(record, properties):
+        return LocalEdge(record['id'], record['start'], record['end'], record['type'],
+                         properties)
+
+    for max_query, query, make, add in [
+            ("MATCH (n) RETURN max(Id(n)) AS max_id", node_query, make_node, writer.add_node),
+            ("MATCH ()-[r]->() RETURN max(Id(r)) AS max_id", edge_query, make_edge,
+             writer.add_edge)]:
+        max_id = list(execute_query(max_query, use_cache=False))[0]['max_id']
+        if max_id is None:
+            continue
+
+        for first in range(0, max_id + 1, batch_size):
+            for record in stream_query(query, {'start': first, 'end': first + batch_size - 1}):
+                add(make(record, {name: value for name, value in record['properties'].items()
+                                  if value is not None}))
+
+    return writer.close()
@@ -0,0 +1,285 @@
+"""
+Contains functions to fetch every match of a pattern query page by page, instead of in one
+result capped by LIMIT. Pages use keyset pagination on the database id of an anchor node of the
+pattern: each page is the matches of the next page_size anchors with an id above the last one
+fetched, so no match is fetched twice or skipped, however many matches an anchor has.
+
+The anchors of a page are found by a scan of the anchor's label alone, and the pattern is only
+matched from the anchors of the page, so fetching every page matches the pattern once in total.
+
+Each page is spooled to files while its records stream in, so a page larger than the memory
+ceiling is split over several files rather than held in memory. A checkpoint holding the last
+anchor id is saved after every page, so an interrupted fetch resumes after the last complete
+page. SpooledResult reads the files back one at a time, so the number of matches is limited by
+disk space rather than memory.
+"""
+
+import json
+import os
+import re
+from data_processing.records import encode_chunks, decode_result, write_encoded, read_encoded
+
+# The number of anchor nodes per page
+DEFAULT_PAGE_SIZE = 500
+
+# The maximum size (pickled, uncompressed, in bytes) of the records held in memory while a page
+# is fetched. A page larger than this is spooled to several files, and halves the page size of
+# the following pages
+DEFAULT_MAX_PAGE_BYTES = 64 * 2**20
+
+CHECKPOINT_FILE = 'checkpoint.json'
+PAGE_PREFIX = 'page_'
+PAGE_SUFFIX = '.page'
+
+# The clauses which end the WHERE clause of a MATCH clause
+_CLAUSE = re.compile(r'\b(OPTIONAL\s+MATCH|MATCH|WITH|UNWIND|CALL|RETURN|UNION)\b', re.IGNORECASE)
+_WHERE = re.compile(r'\bWHERE\b', re.IGNORECASE)
+_RETURN = re.compile(r'\bRETURN\b', re.IGNORECASE)
+_LIMIT = re.compile(r'\s+LIMIT\s+\S+\s*$', re.IGNORECASE)
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_STRING_OPERATOR = re.compile(r'\b(STARTS|ENDS)\s+$', re.IGNORECASE)
+
+
+def split_query(query):
+    """
+    Splits a query into the part before its last RETURN clause, and the RETURN clause without
+    any trailing LIMIT.
+
+    :param query: A String
+    :return: A tuple (match_part, return_part)
+    """
+
+    returns = list(_RETURN.finditer(query))
+    if not returns:
+        raise ValueError("The query has no RETURN clause")
+
+    start = returns[-1].start()
+    return query[:start].rstrip(), _LIMIT.sub('', query[start:].rstrip())
+
+
+def find_clauses(query):
+    """
+    Finds the clause keywords of a query, ignoring String literals, property names and the
+    STARTS WITH and ENDS WITH operators.
+
+    :param query: A String
+    :return: A list of tuples (start, end, keyword), keyword in upper case with single spaces
+    """
+
+    masked = _STRING.sub(lambda string: ' ' * len(string.group()), query)
+
+    clauses = []
+    for clause in _CLAUSE.finditer(masked):
+        start = clause.start()
+        keyword = ' '.join(clause.group().upper().split())
+        if start > 0 and masked[start-1] == '.':
+            continue
+        if keyword == 'WITH' and _STRING_OPERATOR.search(masked[:start]):
+            continue
+        clauses.append((start, clause.end(), keyword))
+    return clauses
+
+
+def add_condition(match_part, condition):
+    """
+    Adds a condition to the WHERE clause of the last MATCH clause (not OPTIONAL MATCH) of a
+    query, or adds a WHERE clause to it if it has none. The WHERE clause ends at the next
+    clause (e.g. WITH or OPTIONAL MATCH), which is left as it is.
+
+    :param match_part: The part of a query before its RETURN clause
+    :param condition: A String, e.g. 'Id(node1) > $after'
+    :return: A String
+    """
+
+    clauses = find_clauses(match_part)
+    matches = [clause for clause in clauses if clause[2] == 'MATCH']
+    if not matches:
+        return '%s\nWHERE %s' % (match_part, condition)
+
+    last_match = matches[-1]
+    following = [clause[0] for clause in clauses if clause[0] > last_match[0]]
+    end = following[0] if following else len(match_part)
+
+    masked = _STRING.sub(lambda string: ' ' * len(string.group()), match_part)
+    wheres = list(_WHERE.finditer(masked, last_match[1], end))
+
+    if not wheres:
+        head = match_part[:end].rstrip()
+        separator = match_part[len(head):end] or ('\n' if following else '')
+        return '%s\nWHERE %s%s%s' % (head, condition, separator, match_part[end:])
+
+    where = wheres[0]
+    predicate = match_part[where.end():end]
+    separator = predicate[len(predicate.rstrip()):] or ('\n' if following else '')
+    return '%sWHERE (%s) AND %s%s%s' % (match_part[:where.start()], predicate.strip(),
+                                        condition, separator, match_part[end:])
+
+
+def anchor_label(query, anchor):
+    """
+    :param query: A pattern query
+    :param anchor: The name of a node variable of the query
+    :return: The first label given to the node variable in the query, or None if it has none
+    """
+
+    label = re.search(r'\(\s*%s\s*:\s*(\w+|`[^`]+`)' % re.escape(anchor), query)
+    return None if label is None else label.group(1)
+
+
+def keyset_queries(query, anchor):
+    """
+    Rewrites a pattern query into the two queries run for each page: one fetching the ids of
+    the next page of anchor nodes, and one fetching the matches of those anchors.
+
+    The anchor query only scans the nodes with the anchor's label (or every node if the query
+    does not give it a label), so some anchors of a page may have no matches. The pattern is
+    only matched by the page query, from the anchors of the page.
+
+    :param query: A pattern query, e.g. from fetch_training_data. Any LIMIT is dropped
+    :param anchor: The name of the node variable of the query to paginate on
+    :return: A tuple (anchor_query, page_query). anchor_query takes the parameters $after and
+    $page_size and returns anchor_id; page_query takes the parameter $anchor_ids
+    """
+
+    match_part, return_part = split_query(query)
+    label = anchor_label(match_part, anchor)
+
+    anchor_query = 'MATCH (%s%s)\nWHERE Id(%s) > $after\n' \
+                   'RETURN Id(%s) AS anchor_id ORDER BY anchor_id LIMIT $page_size' \
+                   % (anchor, '' if label is None else ':' + label, anchor, anchor)
+    page_query = '%s\n%s' % (add_condition(match_part, 'Id(%s) IN $anchor_ids' % anchor),
+                             return_part)
+    return anchor_query, page_query
+
+
+def page_path(spool_dir, page):
+    return os.path.join(spool_dir, '%s%06d%s' % (PAGE_PREFIX, page, PAGE_SUFFIX))
+
+
+def load_checkpoint(spool_dir):
+    """
+    :param spool_dir: The directory a paginated fetch spools to
+    :return: The Dictionary saved by save_checkpoint, or None if there is no checkpoint
+    """
+
+    path = os.path.join(spool_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(spool_dir, state):
+    """
+    Saves the state of a paginated fetch, replacing the previous checkpoint atomically.
+
+    :param spool_dir: The directory a paginated fetch spools to
+    :param state: A Dictionary
+    :return: nothing
+    """
+
+    path = os.path.join(spool_dir, CHECKPOINT_FILE)
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(state, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def spool_pages(run_query, query, anchor, spool_dir, page_size=DEFAULT_PAGE_SIZE,
+                max_page_bytes=DEFAULT_MAX_PAGE_BYTES, max_matches=None):
+    """
+    Fetches the matches of a pattern query page by page into spool_dir, resuming from the
+    checkpoint in spool_dir if there is one. The records of a page are written to a new file
+    whenever max_page_bytes of them have been read, so a page may be spooled to several files.
+    Each file is yielded once its page has been spooled and checkpointed, so it can be streamed
+    into the graph builder while the fetch continues.
+
+    :param run_query: A function (query, parameters) -> iterable of records. The records of
+    a page are only held in memory up to max_page_bytes if it streams them, e.g.
+    neo4j_interface_fns.stream_query
+    :param query: A pattern query, see keyset_queries
+    :param anchor: The name of the node variable of the query to paginate on
+    :param spool_dir: The directory the pages and the checkpoint are written to
+    :param page_size: The number of anchor nodes per page
+    :param max_page_bytes: The maximum size of the records held in memory, see
+    DEFAULT_MAX_PAGE_BYTES. A page larger than this halves the page size of the later pages
+    :param max_matches: The maximum number of matches fetched, or None for all of them
+    :return: A generator of LocalResult objects, one per file written by this call
+    """
+
+    os.makedirs(spool_dir, exist_ok=True)
+    anchor_query, page_query = keyset_queries(query, anchor)
+
+    state = load_checkpoint(spool_dir)
+    if state is None:
+        state = {'query': page_query, 'after': -1, 'pages': 0, 'matches': 0,
+                 'page_size': page_size, 'done': False}
+    elif state['query'] != page_query:
+        raise ValueError("%s holds the pages of a different query" % spool_dir)
+
+    while not state['done']:
+        anchor_results = run_query(anchor_query, {'after': state['after'],
+                                                  'page_size': state['page_size']})
+        anchor_ids = [record['anchor_id'] for record in anchor_results]
+
+        if not anchor_ids:
+            state['done'] = True
+            save_checkpoint(spool_dir, state)
+            break
+
+        # Files of a page which was interrupted before its checkpoint are overwritten
+        paths = []
+        matches = 0
+        remaining = None if max_matches is None else max_matches - state['matches']
+        page_results = run_query(page_query, {'anchor_ids': anchor_ids})
+        for encoded in encode_chunks(page_results, max_page_bytes, remaining):
+            paths.append(page_path(spool_dir, state['pages'] + len(paths)))
+            write_encoded(paths[-1], encoded)
+            matches += len(encoded['records'])
+        if hasattr(page_results, 'close'):
+            # Frees the session of a streamed result which was not read to the end
+            page_results.close()
+
+        state['pages'] += len(paths)
+        state['matches'] += matches
+        state['after'] = anchor_ids[-1]
+        state['done'] = len(anchor_ids) < state['page_size'] or \
+            (max_matches is not None and state['matches'] >= max_matches)
+        if len(paths) > 1:
+            state['page_size'] = max(1, state['page_size'] // 2)
+
+        save_checkpoint(spool_dir, state)
+        for path in paths:
+            yield decode_result(read_encoded(path))
+
+
+class SpooledResult:
+    """
+    The matches spooled to a directory by spool_pages, which can be used in place of a
+    BoltStatementResult. Iterating reads one file into memory at a time.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+
+    def page_paths(self):
+        """
+        :return: A list of the paths of the files, in the order they were fetched
+        """
+
+        state = load_checkpoint(self.spool_dir)
+        pages = state['pages'] if state is not None else 0
+        return [page_path(self.spool_dir, page) for page in range(pages)]
+
+    def pages(self):
+        """
+        :return: A generator of LocalResult objects, one per file
+        """
+
+        for path in self.page_paths():
+            yield decode_result(read_encoded(path))
+
+    def __iter__(self):
+        for page in self.pages():
+            for record in page:
+                yield record
@@ -0,0 +1,78 @@
+"""
+Contains functions to process a list of items (e.g. training graphs) in a pool of worker
+processes. The workers are forked, so they inherit the items and any shared-memory output
+arrays instead of having them pickled, and only the index range of each shard is sent to them.
+
+Forking is only available on POSIX platforms.
+"""
+
+import multiprocessing
+import numpy as np
+
+# State inherited by the forked workers. Only set while run_sharded is running.
+_SHARED_STATE = {}
+
+
+def shard_ranges(count, workers):
+    """
+    Splits range(count) into at most `workers` contiguous shards of nearly equal size.
+
+    :param count: The number of items
+    :param workers: The number of shards wanted
+    :return: A list of tuples (start, end)
+    """
+
+    workers = max(1, min(workers, count))
+    bounds = np.linspace(0, count, workers + 1).astype(int).tolist()
+    return [(bounds[idx], bounds[idx+1]) for idx in range(workers) if bounds[idx] < bounds[idx+1]]
+
+
+def shared_array(shape, dtype=np.float64):
+    """
+    Allocates a zeroed ndarray in shared memory. Writes made to it by forked workers are seen
+    by the parent process.
+
+    :param shape: A tuple
+    :param dtype: A NumPy dtype
+    :return: An ndarray backed by a multiprocessing.RawArray
+    """
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = multiprocessing.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+def _run_shard(bounds):
+    start, end = bounds
+    return _SHARED_STATE['fn'](_SHARED_STATE['items'], start, end, _SHARED_STATE['shared'])
+
+
+def run_sharded(fn, items, workers, shared=None):
+    """
+    Calls fn(items, start, end, shared) for contiguous shards of items, each in a worker of a
+    pool of forked processes. Exceptions raised by fn are raised again in the caller.
+
+    :param fn: A function which processes items[start:end]. Its return value is pickled back
+    :param items: A list of items
+    :param workers: The number of worker processes
+    :param shared: Any object (e.g. a tuple of arrays from shared_array) given to every call
+    :return: A list of the return values of fn, in shard order
+    """
+
+    global _SHARED_STATE
+
+    if workers < 1:
+        raise ValueError("The number of workers must be at least 1, not %s" % workers)
+
+    shards = shard_ranges(len(items), workers)
+    if not shards:
+        return []
+
+    context = multiprocessing.get_context('fork')
+    _SHARED_STATE = {'fn': fn, 'items': items, 'shared': shared}
+    try:
+        with context.Pool(len(shards)) as pool:
+            return pool.map(_run_shard, shards, chunksize=1)
+    finally:
+        _SHARED_STATE = {}
@@ -0,0 +1,378 @@
+"""
+Contains an in-process subgraph pattern matcher over the CSR arrays of a CompactGraph (e.g. a
+SnapshotGraph), to find the matches of the fetch_training_data patterns without Neo4j.
+
+Matches follow the semantics of Cypher MATCH clauses: the pattern edges of one MATCH clause
+are matched by different graph edges, while edges of different clauses (see
+Pattern.new_clause) may match the same graph edge. Pattern nodes may match the same graph node
+unless they are declared distinct. Candidates for each pattern node are first filtered by label
+and by degree, then one pattern edge is matched at a time, backtracking, starting from the
+pattern node with the fewest candidates.
+"""
+
+import numpy as np
+from data_processing.records import LocalPath
+from data_processing.parallel import run_sharded
+
+
+class Pattern:
+    """
+    A small pattern of named nodes and directed edges, with predicates on both. Like a Cypher
+    query, a pattern is made of one or more MATCH clauses; edge_clauses holds the clause of
+    every edge.
+    """
+
+    def __init__(self):
+        self.node_names = []
+        self.node_labels = {}
+        self.node_predicates = {}
+        self.edges = []
+        self.edge_clauses = []
+        self.clause_count = 1
+        self.different = []
+
+    def node(self, name, labels=(), predicate=None):
+        """
+        Adds a node to the pattern, or sets the constraints of a node already added.
+
+        :param name: The name of the node
+        :param labels: The labels a matching node must have
+        :param predicate: An optional function taking a node and returning True if it matches
+        :return: nothing
+        """
+
+        if name not in self.node_labels:
+            self.node_names.append(name)
+        self.node_labels[name] = set(labels)
+        self.node_predicates[name] = predicate
+
+    def edge(self, start, end, types=None, states=None, predicate=None):
+        """
+        Adds a directed edge to the pattern. Nodes not added yet are added without constraints.
+
+        :param start: The name of the start node
+        :param end: The name of the end node
+        :param types: An optional list of the types a matching edge may have
+        :param states: An optional list of the 'state' properties a matching edge may have
+        :param predicate: An optional function taking an edge and returning True if it matches
+        :return: nothing
+        """
+
+        for name in (start, end):
+            if name not in self.node_labels:
+                self.node(name)
+        self.edges.append((start, end, types, states, predicate))
+        self.edge_clauses.append(self.clause_count - 1)
+
+    def new_clause(self):
+        """
+        Starts a new MATCH clause. Edges added from now on may match the same graph edges as
+        edges added before, as with the separate MATCH clauses of a Cypher query.
+
+        :return: nothing
+        """
+
+        self.clause_count += 1
+
+    def distinct(self, *names):
+        """
+        Requires the given pattern nodes to match different graph nodes.
+
+        :param names: Names of nodes of the pattern
+        :return: nothing
+        """
+
+        for idx, first in enumerate(names):
+            for second in names[idx+1:]:
+                self.different.append((first, second))
+
+
+def tree_pattern(edges, labels=None):
+    """
+    Builds a Pattern from a list of edges, e.g. the star and tree shapes of fetch_training_data.
+
+    :param edges: A list of tuples (start name, end name)
+    :param labels: An optional Dictionary of node name -> list of labels
+    :return: A Pattern object
+    """
+
+    pattern = Pattern()
+    for start, end in edges:
+        pattern.edge(start, end)
+    for name, node_labels in (labels or {}).items():
+        pattern.node(name, node_labels)
+    return pattern
+
+
+def _codes(names, allowed):
+    if allowed is None:
+        return None
+    return set(code for code, name in enumerate(names) if name in allowed)
+
+
+class Matcher:
+    """
+    Finds the matches of a Pattern in a CompactGraph.
+    """
+
+    def __init__(self, graph, pattern):
+        """
+        Initialises the Matcher object, computing the candidates of every pattern node and the
+        order the pattern edges are matched in.
+
+        :param graph: A CompactGraph object
+        :param pattern: A Pattern object
+        """
+
+        self.graph = graph
+        self.pattern = pattern
+        self.candidates = {name: self._candidate_mask(name) for name in pattern.node_names}
+        self.type_codes = [_codes(graph.type_names, edge[2]) for edge in pattern.edges]
+        self.state_codes = [_codes(graph.state_names, edge[3]) for edge in pattern.edges]
+        self.root, self.plan = self._plan()
+        self._node_checks = {}
+        self._edge_checks = {}
+
+    def _label_mask(self, labels):
+        graph = self.graph
+        codes = [code for code, label_set in enumerate(graph.label_sets)
+                 if labels.issubset(label_set)]
+        return np.isin(graph.node_labels, codes)
+
+    def _candidate_mask(self, name):
+        graph = self.graph
+        # Edges of different clauses may match the same graph edge, so the degree a node needs
+        # is that of the clause with the most edges at it
+        in_counts = [0] * self.pattern.clause_count
+        out_counts = [0] * self.pattern.clause_count
+        for edge, clause in zip(self.pattern.edges, self.pattern.edge_clauses):
+            in_counts[clause] += edge[1] == name
+            out_counts[clause] += edge[0] == name
+        in_count, out_count = max(in_counts), max(out_counts)
+
+        mask = (graph.in_degree() >= in_count) & (graph.out_degree() >= out_count)
+        if self.pattern.node_labels[name]:
+            mask &= self._label_mask(self.pattern.node_labels[name])
+        return mask
+
+    def _plan(self):
+        """
+        Orders the pattern edges so that each one touches a pattern node already matched.
+        Edges between two matched nodes come first, as they prune the most.
+
+        :return: A tuple (root, plan). root is the name of the first pattern node matched,
+        plan is a list of tuples (edge number, kind), kind being 'out' if the start node is
+        matched first, 'in' if the end node is, or 'close' if both are
+        """
+
+        names = self.pattern.node_names
+        counts = [np.count_nonzero(self.candidates[name]) for name in names]
+        root = names[int(np.argmin(counts))]
+
+        placed = {root}
+        remaining = list(range(len(self.pattern.edges)))
+        plan = []
+
+        while remaining:
+            step = None
+            for edge_no in remaining:
+                start, end = self.pattern.edges[edge_no][:2]
+                if start in placed and end in placed:
+                    step = (edge_no, 'close')
+                    break
+                if step is None and start in placed:
+                    step = (edge_no, 'out')
+                elif step is None and end in placed:
+                    step = (edge_no, 'in')
+
+            if step is None:
+                raise ValueError("The pattern must be connected")
+
+            remaining.remove(step[0])
+            placed.update(self.pattern.edges[step[0]][:2])
+            plan.append(step)
+
+        if len(placed) != len(names):
+            raise ValueError("The pattern must be connected")
+        return root, plan
+
+    def _node_ok(self, name, index):
+        if not self.candidates[name][index]:
+            return False
+
+        predicate = self.pattern.node_predicates[name]
+        if predicate is None:
+            return True
+
+        key = (name, index)
+        result = self._node_checks.get(key)
+        if result is None:
+            result = bool(predicate(self.graph.node(index)))
+            self._node_checks[key] = result
+        return result
+
+    def _edge_ok(self, edge_no, index):
+        graph = self.graph
+        type_codes = self.type_codes[edge_no]
+        if type_codes is not None and graph.edge_type[index] not in type_codes:
+            return False
+        state_codes = self.state_codes[edge_no]
+        if state_codes is not None and graph.edge_state[index] not in state_codes:
+            return False
+
+        predicate = self.pattern.edges[edge_no][4]
+        if predicate is None:
+            return True
+
+        key = (edge_no, index)
+        result = self._edge_checks.get(key)
+        if result is None:
+            result = bool(predicate(graph.edge(index)))
+            self._edge_checks[key] = result
+        return result
+
+    def _distinct_ok(self, name, index, assignment):
+        for first, second in self.pattern.different:
+            other = second if first == name else first if second == name else None
+            if other is not None and assignment.get(other) == index:
+                return False
+        return True
+
+    def root_candidates(self, seed=None, shard=None):
+        """
+        :param seed: If given, the candidates are shuffled with this seed
+        :param shard: An optional tuple (index, count): only every count-th candidate,
+        starting from index, is returned
+        :return: A 1D ndarray of the node indices the root pattern node is matched to
+        """
+
+        roots = np.flatnonzero(self.candidates[self.root])
+        if seed is not None:
+            roots = roots[np.random.RandomState(seed).permutation(len(roots))]
+        if shard is not None:
+            roots = roots[shard[0]::shard[1]]
+        return roots
+
+    def iter_matches(self, limit=None, seed=None, shard=None):
+        """
+        Enumerates the matches of the pattern.
+
+        :param limit: The maximum number of matches, or None for all of them
+        :param seed: If given, the matches are found in an order randomised by this seed
+        :param shard: An optional tuple (index, count), see root_candidates
+        :return: A generator of tuples (node indices, edge indices), in the order of
+        pattern.node_names and pattern.edges
+        """
+
+        found = 0
+        for root_index in self.root_candidates(seed, shard).tolist():
+            if not self._node_ok(self.root, root_index):
+                continue
+
+            assignment = {self.root: root_index}
+            edges = [None] * len(self.pattern.edges)
+            for match in self._search(0, assignment, edges, set()):
+                yield match
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def _search(self, step, assignment, edges, used):
+        if step == len(self.plan):
+            yield tuple(assignment[name] for name in self.pattern.node_names), tuple(edges)
+            return
+
+        graph = self.graph
+        edge_no, kind = self.plan[step]
+        start, end = self.pattern.edges[edge_no][:2]
+
+        if kind == 'in':
+            indptr, neighbours, edge_indices = graph.in_indptr, graph.in_indices, graph.in_edges
+            node, other = assignment[end], start
+        else:
+            indptr, neighbours, edge_indices = graph.out_indptr, graph.out_indices, graph.out_edges
+            node, other = assignment[start], end
+
+        for pos in range(indptr[node], indptr[node+1]):
+            edge_index = int(edge_indices[pos])
+            neighbour = int(neighbours[pos])
+
+            # Only the edges of one MATCH clause must be different
+            used_key = (self.pattern.edge_clauses[edge_no], edge_index)
+            if used_key in used or not self._edge_ok(edge_no, edge_index):
+                continue
+
+            if kind == 'close':
+                if neighbour != assignment[other]:
+                    continue
+            elif not self._node_ok(other, neighbour) or \
+                    not self._distinct_ok(other, neighbour, assignment):
+                continue
+
+            used.add(used_key)
+            edges[edge_no] = edge_index
+            if kind != 'close':
+                assignment[other] = neighbour
+
+            for match in self._search(step + 1, assignment, edges, used):
+                yield match
+
+            if kind != 'close':
+                del assignment[other]
+            used.remove(used_key)
+
+
+def _match_shard(shards, start, end, shared):
+    graph, pattern, limit, seed, count = shared
+    matcher = Matcher(graph, pattern)
+    matches = []
+    for shard in shards[start:end]:
+        remaining = None if limit is None else limit - len(matches)
+        if remaining is not None and remaining <= 0:
+            break
+        matches.extend(matcher.iter_matches(remaining, seed, (shard, count)))
+    return matches
+
+
+def find_matches(graph, pattern, limit=None, seed=None, workers=None):
+    """
+    Finds the matches of a pattern, optionally in a pool of forked worker processes, each
+    searching from a different share of the root candidates.
+
+    The matches are returned as a list, which holds at most limit matches. With workers, each
+    worker finds at most limit matches, and the result is the first limit matches of the
+    workers in worker order. It is therefore ordered differently from the serial result, and
+    with a limit it may hold different matches.
+
+    :param graph: A CompactGraph object
+    :param pattern: A Pattern object
+    :param limit: The maximum number of matches, or None for all of them
+    :param seed: If given, the matches are found in an order randomised by this seed
+    :param workers: The number of worker processes, or None to search in this process
+    :return: A list of tuples (node indices, edge indices), see Matcher.iter_matches
+    """
+
+    if workers is None:
+        return list(Matcher(graph, pattern).iter_matches(limit, seed))
+
+    results = run_sharded(_match_shard, list(range(workers)), workers,
+                          (graph, pattern, limit, seed, workers))
+    matches = [match for result in results for match in result]
+    return matches if limit is None else matches[:limit]
+
+
+def iter_match_records(graph, matches):
+    """
+    Converts matches into records which can be used in place of the records of a query
+    result, e.g. by preprocessing.iter_graphs_by_result. Each record holds one path-like
+    LocalPath with the nodes and edges of the match.
+
+    :param graph: The CompactGraph the matches were found in
+    :param matches: An iterable of tuples (node indices, edge indices)
+    :return: A generator of Dictionaries
+    """
+
+    for node_indices, edge_indices in matches:
+        nodes = [graph.node(index) for index in sorted(set(node_indices))]
+        edges = [graph.edge(index) for index in edge_indices]
+        yield {'match': LocalPath(nodes, edges)}
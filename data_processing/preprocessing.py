@@ -2,9 +2,12 @@
 This module contains functions to pre-process(clean) graph data from Neo4j into a convenient form.
 """
 
-import sys
+import numpy as np
 import patchy_san.parameters as params
 import data_processing.graphs as graphs
+from data_processing.graphs import build_in_out_edges
+from data_processing.uuid_index import UuidIndex
+from data_processing.parallel import run_sharded
 
 VERSION_TYPES = ['GLOB_OBJ_PREV', 'META_PREV', 'PROC_OBJ_PREV']
 
@@ -12,7 +15,7 @@ VERSION_TYPES = ['GLOB_OBJ_PREV', 'META_PREV', 'PROC_OBJ_PREV']
 def get_graph(results):
     """
     Builds a graph object from a BoltStatementResult object which is the
-    raw result of a neo4j query.
+    raw result of a neo4j query. Records are consumed one at a time.
 
     :param results: A BoltStatementResult object describing all paths in the query
     :return: A Graph object
@@ -21,188 +24,313 @@ def get_graph(results):
     nodes = {}
     edges = {}
 
-    for result in results.data():
-        for path_name in result:
-            for node in result[path_name].nodes:
-                nodes[node.id] = node
-            for edge in result[path_name].relationships:
-                edges[edge.id] = edge
+    for record in results:
+        add_paths(record.values(), nodes, edges)
 
     incoming_edges, outgoing_edges = build_in_out_edges(edges)
     return graphs.Graph(nodes, edges, incoming_edges, outgoing_edges)
 
 
-def get_graphs_by_result(results):
+def get_graph_from_entities(nodes, edges):
     """
-    Builds a list of Graphs for every result in the provided
-    BoltStatementResult. Also cleans the data. If the result does not lose any nodes as a result
-    of the cleaning (the result is clean) then the nodes and edges which represent it are added
-    to the list of tuples.
+    Builds a graph object from separate collections of nodes and edges (e.g. the results of
+    queries returning nodes and relationships rather than paths). Repeated nodes and edges are
+    added once.
+
+    :param nodes: An iterable of nodes
+    :param edges: An iterable of edges. Both ends of every edge must be in nodes
+    :return: A Graph object
+    """
+
+    node_dict = {}
+    edge_dict = {}
+
+    for node in nodes:
+        node_dict.setdefault(node.id, node)
+    for edge in edges:
+        edge_dict.setdefault(edge.id, edge)
+
+    incoming_edges, outgoing_edges = build_in_out_edges(edge_dict)
+    return graphs.Graph(node_dict, edge_dict, incoming_edges, outgoing_edges)
+
+
+def add_paths(paths, nodes, edges, pool=None):
+    """
+    Adds the nodes and edges of every path to the Dictionaries of node_id -> node and
+    edge_id -> edge.
+
+    :param paths: An iterable of paths (e.g. the values of one record)
+    :param nodes: A Dictionary of node_id -> node
+    :param edges: A Dictionary of edge_id -> edge
+    :param pool: An optional EntityPool. If given, the pooled PooledNodes and PooledEdges are
+    added instead of the nodes and edges themselves
+    :return: nothing
+    """
+
+    for path in paths:
+        for node in path.nodes:
+            if node.id not in nodes:
+                nodes[node.id] = node if pool is None else pool.node(node)
+        for edge in path.relationships:
+            if edge.id not in edges:
+                edges[edge.id] = edge if pool is None else pool.edge(edge)
+
+
+def iter_graphs_by_result(results, pool=None, uuid_index=None, structure_only=False):
+    """
+    Generator version of get_graphs_by_result. Records are consumed from the
+    BoltStatementResult one at a time, and each Graph is built, cleaned and yielded before
+    the next record is read, so the Graphs are never materialised as a whole. The records are
+    only read as they arrive if the result is streamed, e.g. by neo4j_interface_fns.stream_query;
+    a result returned by execute_query has already been buffered.
+    The number of deleted results is printed once the result has been exhausted.
+
+    Nodes and edges shared by several records are stored once in an EntityPool, and each
+    Graph holds copy-on-write PooledNodes and PooledEdges referring to them.
 
     :param results: A BoltStatementResult object describing all paths in the query
-    :return: A list of Graphs
+    :param pool: An optional EntityPool to share between results. A new pool is used for
+    this result by default
+    :param uuid_index: An optional UuidIndex, shared by all graphs of the dataset, which is
+    updated and used to rename symlinked files when cleaning
+    :param structure_only: If True, only clean_graph_structure is applied when cleaning, e.g.
+    because the names of the nodes have not been fetched yet
+    :return: A generator of Graphs
     """
-    result_list = []
+
     deleted = 0
+    if pool is None:
+        pool = graphs.EntityPool()
 
-    for subgraph_dict in results.data():
+    for record in results:
         nodes = {}
         edges = {}
-        for path in subgraph_dict:
-            for node in subgraph_dict[path].nodes:
-                nodes[node.id] = node
-            for edge in subgraph_dict[path].relationships:
-                edges[edge.id] = edge
+        add_paths(record.values(), nodes, edges, pool)
 
         node_count = len(nodes)
         incoming_edges, outgoing_edges = build_in_out_edges(edges)
         graph = graphs.Graph(nodes, edges, incoming_edges, outgoing_edges)
 
         if params.CLEAN_TRAIN_DATA:
-            clean_data(graph)
+            if structure_only:
+                clean_graph_structure(graph)
+            else:
+                clean_data(graph, uuid_index)
 
         if node_count == len(nodes):
-            result_list.append(graph)
+            yield graph
         else:
             deleted += 1
     print("Deleted: " + str(deleted))
-    return result_list
 
 
-def consolidate_node_versions(graph):
+def get_graphs_by_result(results, workers=None, uuid_index=None):
     """
-    Given a Dictionary of node_id -> node and a Dictionary of edge_id -> edge,
-    for all adjacent edges and nodes (node1)-[edge]->(node2) where
-    type(edge) is a previous version type, removes edge and node2.
-    All outgoing and incoming edges to node2 are glued to node1.
+    Builds a list of Graphs for every result in the provided
+    BoltStatementResult. Also cleans the data. If the result does not lose any nodes as a result
+    of the cleaning (the result is clean) then the nodes and edges which represent it are added
+    to the list of tuples.
 
-    Note: This may produce a graph where more than one edge of the same type may exist between
-    2 nodes. Currently this is not a problem because the adjacency matrix produced from
-    the set of edges and nodes cannot contain duplicated edges.
+    :param results: A BoltStatementResult object describing all paths in the query
+    :param workers: If given, the graphs are cleaned by this many worker processes (see
+    clean_graphs). The output is the same as the serial path
+    :param uuid_index: An optional UuidIndex used to rename symlinked files, see
+    iter_graphs_by_result
+    :return: A list of Graphs
+    """
 
-    :param graph: A Graph object
-    :return: nothing
+    if workers is None or not params.CLEAN_TRAIN_DATA:
+        return list(iter_graphs_by_result(results, uuid_index=uuid_index))
+
+    pool = graphs.EntityPool()
+    graph_list = []
+    for record in results:
+        nodes = {}
+        edges = {}
+        add_paths(record.values(), nodes, edges, pool)
+        incoming_edges, outgoing_edges = build_in_out_edges(edges)
+        graph_list.append(graphs.Graph(nodes, edges, incoming_edges, outgoing_edges))
+
+    clean_list = clean_graphs(graph_list, workers, uuid_index)
+    print("Deleted: " + str(len(graph_list) - len(clean_list)))
+    return clean_list
+
+
+def _clean_structure_shard(graph_list, start, end, _):
     """
-    nodes = graph.nodes
-    edges = graph.edges
-    incoming_edges = graph.incoming_edges
-    outgoing_edges = graph.outgoing_edges
-
-    # Glue incoming and outgoing edges from the old node to the master node
-    for edge_id in list(edges.keys()):
-        edge = edges[edge_id]
-        if edge.type in VERSION_TYPES:
-            # Remove the older node version
-            removed_node_id = edge.end
-            master_node_id = edge.start
-
-            if removed_node_id in outgoing_edges.keys():
-                for outgoing_edge in outgoing_edges[removed_node_id]:
-                    outgoing_edge.start = master_node_id
-                    # The key master_node_id should definitely exist
-                    # This assumes that there are no nodes connected by two edges in
-                    # both directions
-                    outgoing_edges[master_node_id] += [outgoing_edge]
-                    outgoing_edges.pop(removed_node_id)
-
-            if removed_node_id in incoming_edges.keys():
-                for incoming_edge in incoming_edges[removed_node_id]:
-                    if incoming_edge.start is not master_node_id:
-                        incoming_edge.end = master_node_id
-                        # The key master_node_id may not exist
-                        if master_node_id not in incoming_edges:
-                            incoming_edges[master_node_id] = []
-                            incoming_edges[master_node_id] += [incoming_edge]
-                            incoming_edges.pop(removed_node_id)
-
-                nodes.pop(removed_node_id)
-                edges.pop(edge_id)
-
-
-def build_in_out_edges(edges):
-    """
-    Given a Dictionary of edge_id -> edge, builds two
-    dictionaries of node_id -> edge (incoming or outgoing edges from that node).
+    Cleans the structure of graph_list[start:end] in a worker process and describes the
+    outcome of each, so only the changes are pickled back to the parent.
 
-    :param edges: A Dictionary of edge_id -> edge
-    :return: (incoming_edges, outgoing_edges), a tuple of Dictionaries of node_id to
-    list of incoming/outgoing edges to/from that node
+    :return: A list of tuples (kept node ids, Dictionary of kept edge_id -> (start, end))
     """
 
-    incoming_edges = {}
-    outgoing_edges = {}
+    outcomes = []
+    for graph in graph_list[start:end]:
+        clean_graph_structure(graph)
+        edge_ends = {edge_id: (edge.start, edge.end) for edge_id, edge in graph.edges.items()}
+        outcomes.append((list(graph.nodes.keys()), edge_ends))
+    return outcomes
 
-    # Build maps which store all incoming and outgoing edges for every node
-    for edge_id in edges.keys():
-        edge = edges[edge_id]
-        if not incoming_edges.__contains__(edge.end):
-            incoming_edges[edge.end] = []
-        incoming_edges[edge.end].append(edge)
 
-        if not outgoing_edges.__contains__(edge.start):
-            outgoing_edges[edge.start] = []
-        outgoing_edges[edge.start].append(edge)
+def clean_graphs(graph_list, workers=None, uuid_index=None):
+    """
+    Cleans a list of graphs and returns those which did not lose any nodes, in order.
 
-    for edge_dict in [incoming_edges, outgoing_edges]:
-        for edge_id in edge_dict:
-            edges = edge_dict[edge_id]
-            edge_dict[edge_id] = sorted(edges, key=lambda x: x.id)
+    With workers, the structural cleaning (clean_graph_structure) is sharded across a pool of
+    forked worker processes. Each worker sends back only the ids of the surviving nodes and
+    edges and the new edge endpoints, which are applied to the graphs here, and symlinked files
+    are then renamed here in order, so the result is the same as cleaning serially.
 
-    return incoming_edges, outgoing_edges
+    :param graph_list: A list of Graph objects
+    :param workers: The number of worker processes, or None to clean in this process
+    :param uuid_index: An optional UuidIndex used to rename symlinked files
+    :return: A list of the clean Graphs
+    """
 
+    node_counts = [len(graph.nodes) for graph in graph_list]
 
-def remove_anomalous_nodes_edges(graph):
+    if workers is None:
+        for graph in graph_list:
+            clean_graph_structure(graph)
+    else:
+        shard_outcomes = run_sharded(_clean_structure_shard, graph_list, workers)
+        outcomes = [outcome for shard in shard_outcomes for outcome in shard]
+
+        for graph, (node_ids, edge_ends) in zip(graph_list, outcomes):
+            kept_nodes = set(node_ids)
+            for node_id in list(graph.nodes.keys()):
+                if node_id not in kept_nodes:
+                    graph.nodes.pop(node_id)
+
+            for edge_id, edge in list(graph.edges.items()):
+                if edge_id not in edge_ends:
+                    graph.edges.pop(edge_id)
+                elif (edge.start, edge.end) != edge_ends[edge_id]:
+                    edge.start, edge.end = edge_ends[edge_id]
+            graph.rebuild_adjacency()
+
+    clean_list = []
+    for graph, node_count in zip(graph_list, node_counts):
+        rename_symlinked_files_timestamp(graph, uuid_index)
+        if node_count == len(graph.nodes):
+            clean_list.append(graph)
+
+    return clean_list
+
+
+def consolidate_node_versions(graph):
     """
-    Removes all nodes from the Dictionaries of node_id -> node and edge_id -> edge
-    where node.anomalous = true. This is an artefact of the provenance capture process
-    and should not be included.
+    For all adjacent edges and nodes (node1)-[edge]->(node2) where type(edge) is a previous
+    version type, removes edge and node2. All outgoing and incoming edges to node2 are
+    glued to node1.
 
-    Also removes nodes which do not have a timestamp, as this is also anomalous.
+    Whole version chains are collapsed at once: the version edges are grouped into connected
+    components with union-find, and every component is collapsed into its master node,
+    which is the newest version (a node which is not the previous version of any other node,
+    or the node with the smallest id if there is more than one or none). All other edges
+    are then relabelled in a single vectorised pass, and the edge maps are rebuilt once.
+    Edges between two versions of the same node are removed along with the version edges.
+
+    Note: This may produce a graph where more than one edge of the same type may exist between
+    2 nodes. Currently this is not a problem because the adjacency matrix produced from
+    the set of edges and nodes cannot contain duplicated edges.
 
     :param graph: A Graph object
-    :return: nothing
+    :return: A tuple (collapsed_nodes, collapsed_edges) of the number of nodes and edges removed
     """
 
-    for node_id in list(graph.nodes.keys()):
-        node_prop = graph.nodes[node_id].properties
-        if node_prop.__contains__('anomalous') and node_prop['anomalous'] or \
-                'timestamp' not in node_prop:
-            pop_related_edges(graph, node_id, True)
-            pop_related_edges(graph, node_id, False)
-            graph.nodes.pop(node_id)
+    nodes = graph.nodes
+    edges = graph.edges
+    edge_list = list(edges.values())
+    is_version = np.asarray([edge.type in VERSION_TYPES for edge in edge_list], dtype=bool)
+
+    if not is_version.any():
+        return 0, 0
+
+    starts = np.asarray([edge.start for edge in edge_list], dtype=np.int64)
+    ends = np.asarray([edge.end for edge in edge_list], dtype=np.int64)
+    ids = np.unique(np.concatenate([np.asarray(list(nodes.keys()), dtype=np.int64), starts, ends]))
+    start_idx = graphs.lookup_indices(ids, starts)
+    end_idx = graphs.lookup_indices(ids, ends)
+
+    # Union-find over the version edges, with path halving
+    parent = list(range(len(ids)))
+    for start, end in zip(start_idx[is_version].tolist(), end_idx[is_version].tolist()):
+        while parent[start] != start:
+            parent[start] = parent[parent[start]]
+            start = parent[start]
+        while parent[end] != end:
+            parent[end] = parent[parent[end]]
+            end = parent[end]
+        if start != end:
+            parent[max(start, end)] = min(start, end)
+
+    # Flatten every tree so that each node points straight at its component's root
+    root = np.asarray(parent, dtype=np.int64)
+    while True:
+        next_root = root[root]
+        if np.array_equal(next_root, root):
+            break
+        root = next_root
+
+    # The master of a component is its first node which is not an older version,
+    # ordering by id (ids are sorted, so index order is id order)
+    is_old = np.zeros(len(ids), dtype=bool)
+    is_old[end_idx[is_version]] = True
+    order = np.lexsort((np.arange(len(ids)), is_old, root))
+    component_roots, first = np.unique(root[order], return_index=True)
+    master_of_root = np.arange(len(ids))
+    master_of_root[component_roots] = order[first]
+    master = master_of_root[root]
+
+    new_start_idx = master[start_idx]
+    new_end_idx = master[end_idx]
+    collapsed = master != np.arange(len(ids))
+    internal = (new_start_idx == new_end_idx) & (collapsed[start_idx] | collapsed[end_idx])
+    removed_edges = is_version | internal
+
+    new_starts = ids[new_start_idx]
+    new_ends = ids[new_end_idx]
+    relabelled = ~removed_edges & ((new_starts != starts) | (new_ends != ends))
+    for idx in np.flatnonzero(relabelled).tolist():
+        edge_list[idx].start = int(new_starts[idx])
+        edge_list[idx].end = int(new_ends[idx])
+
+    for idx in np.flatnonzero(removed_edges).tolist():
+        edges.pop(edge_list[idx].id)
+
+    collapsed_nodes = 0
+    for node_id in ids[collapsed].tolist():
+        if nodes.pop(node_id, None) is not None:
+            collapsed_nodes += 1
+
+    graph.rebuild_adjacency()
+
+    return collapsed_nodes, int(np.count_nonzero(removed_edges))
 
 
-def pop_related_edges(graph, node_id, is_incoming):
+def remove_anomalous_nodes_edges(graph):
     """
-    Pops every edge_id -> edge mapping in a Dictionary where either the start or the
-    end of the edge has node_id. Also removes mapping from node_id -> edge from the given
-    node_edge_dict if it exists.
+    Removes all nodes from the Dictionaries of node_id -> node and edge_id -> edge
+    where node.anomalous = true. This is an artefact of the provenance capture process
+    and should not be included.
+
+    Also removes nodes which do not have a timestamp, as this is also anomalous.
+    All anomalous nodes and their edges are removed in one pass by Graph.remove_nodes.
 
     :param graph: A Graph object
-    :param node_id: An Integer id number of a node of which all related edges will be deleted
     :return: nothing
     """
 
-    if is_incoming:
-        node_edge_dict = graph.incoming_edges
-    else:
-        node_edge_dict = graph.outgoing_edges
-
-    if node_id in node_edge_dict:
-        for edge in node_edge_dict[node_id]:
-            if is_incoming:
-                other_id = edge.start
-                new_outgoing_edges = [edg for edg in graph.outgoing_edges[other_id] if edge.id != edg.id]
-                graph.outgoing_edges[other_id] = new_outgoing_edges
+    anomalous = set()
 
-            else:
-                other_id = edge.end
-                new_incoming_edges = [edg for edg in graph.incoming_edges[other_id] if edge.id != edg.id]
-                graph.incoming_edges[other_id] = new_incoming_edges
+    for node_id, node in graph.nodes.items():
+        node_prop = node.properties
+        if node_prop.__contains__('anomalous') and node_prop['anomalous'] or \
+                'timestamp' not in node_prop:
+            anomalous.add(node_id)
 
-            if edge.id in node_edge_dict:
-                graph.edges.pop(edge.id)
-        node_edge_dict.pop(node_id)
+    graph.remove_nodes(anomalous)
 
 
 def group_nodes_by_uuid(graph):
@@ -227,7 +355,7 @@ def group_nodes_by_uuid(graph):
     return uuid_to_nodes
 
 
-def rename_symlinked_files_timestamp(graph):
+def rename_symlinked_files_timestamp(graph, uuid_index=None):
     """
     For all file nodes with the same uuid, renames them with the name of the node
     with the smallest timestamp (oldest node). Nodes with no name are not renamed.
@@ -235,57 +363,104 @@ def rename_symlinked_files_timestamp(graph):
     If multiple nodes have the same timestamp, a name is selected arbitrarily.
 
     :param graph: A Graph object
+    :param uuid_index: An optional UuidIndex shared by all graphs of a dataset. It is updated
+    with the nodes of this graph before renaming, so the oldest name of every uuid across all
+    graphs seen so far is used. By default a UuidIndex of this graph alone is used
     :return: Nothing
     """
 
-    uuid_to_nodes = group_nodes_by_uuid(graph)
+    if uuid_index is None:
+        uuid_index = UuidIndex()
 
-    for uuid, nodes_set in uuid_to_nodes.items():
-        if len(nodes_set) > 1:
-            timestamp = sys.maxsize
-            smallest_ts_node = None
+    uuid_index.update(graph)
+    uuid_index.rename(graph)
 
-            for node in nodes_set:
-                node_prop = node.properties
-                if 'timestamp' in node_prop and 'name' in node_prop \
-                        and node_prop['timestamp'] < timestamp:
-                    timestamp = node_prop['timestamp']
-                    smallest_ts_node = node
 
-            if smallest_ts_node is not None:
-                for node in nodes_set:
-                    if 'name' in node.properties:
-                        # TODO: Decide what to do for multiple names
-                        node.properties['name'] = smallest_ts_node.properties['name']
+def timestamp_ranks(timestamps):
+    """
+    Ranks timestamps without converting them to floats, so large integer (e.g. nanosecond)
+    timestamps which differ are never ranked equal. Numbers rank before other values (e.g.
+    Strings), which are compared as Strings.
 
+    :param timestamps: A list of timestamps, None for edges without one
+    :return: A 1D int64 ndarray of the rank of every timestamp, 0 for None
+    """
+
+    present = [timestamp for timestamp in timestamps if timestamp is not None]
+    if all(isinstance(timestamp, int) and -2**63 <= timestamp < 2**63 for timestamp in present):
+        return np.asarray([0 if timestamp is None else timestamp for timestamp in timestamps],
+                          dtype=np.int64)
+
+    def sort_key(timestamp):
+        if isinstance(timestamp, (int, float)):
+            return 0, timestamp
+        return 1, str(timestamp)
 
-def remove_duplicate_edges(graph):
+    rank_of = {}
+    for timestamp in sorted(set(present), key=sort_key):
+        rank_of[timestamp] = len(rank_of)
+    return np.asarray([0 if timestamp is None else rank_of[timestamp]
+                       for timestamp in timestamps], dtype=np.int64)
+
+
+def remove_duplicate_edges(graph, keep=None):
     """
-    Checks every node's incoming and outgoing edges, and if two edges have the same
-    start (for incoming edges) or end (for outgoing edges) nodes, they are removed.
+    Removes parallel edges: of all edges with the same start node, end node and type, only
+    one is kept. Parallel edges of different types are all kept. Parallel edges mostly exist
+    because of the node version consolidation step above, which glues the edges of past
+    versions of a node onto the newest version.
 
-    This method assumes that two edges between the same 2 nodes will always be of the same type,
-    and therefore can be removed. I believe that this is a valid assumption due to the
-    nature of the provenance data. Edges between the same 2 nodes only exist because of
-    the node version consolidation step above, which deletes nodes representing past versions.
-    If nodes representing past versions have a common neighbor, then the edge type between them
-    and the neighbor are all the same.
+    Each edge's (start, end, type) is packed into a single integer key, and the edge to keep
+    for each key is found with one sort and unique pass rather than by scanning the outgoing
+    edges of every node.
 
     :param graph: A Graph object
-    :return: nothing
+    :param keep: 'earliest' to keep the edge with the smallest timestamp, or 'latest' to keep
+    the one with the largest. Edges without a timestamp lose to edges with one, and ties are
+    broken by the lowest edge id. Defaults to DUPLICATE_EDGE_KEEP in patchy_san.parameters
+    :return: The number of edges removed
     """
 
-    edges = graph.edges
-    outgoing_edges = graph.outgoing_edges
+    if keep is None:
+        keep = params.DUPLICATE_EDGE_KEEP
+    if keep not in ('earliest', 'latest'):
+        raise ValueError("keep must be 'earliest' or 'latest', not %s" % keep)
+
+    edge_list = list(graph.edges.values())
+    if len(edge_list) < 2:
+        return 0
+
+    edge_ids = np.asarray([edge.id for edge in edge_list], dtype=np.int64)
+    starts = np.asarray([edge.start for edge in edge_list], dtype=np.int64)
+    ends = np.asarray([edge.end for edge in edge_list], dtype=np.int64)
+    type_codes, type_names = graphs.encode_values([edge.type for edge in edge_list])
+
+    endpoints, endpoint_idx = np.unique(np.concatenate([starts, ends]), return_inverse=True)
+    start_idx = endpoint_idx[:len(edge_list)].astype(np.int64)
+    end_idx = endpoint_idx[len(edge_list):].astype(np.int64)
+    type_idx = type_codes.astype(np.int64) + 1
+    endpoint_count = len(endpoints)
+    type_count = len(type_names) + 1
+
+    if endpoint_count * endpoint_count * type_count < 2**62:
+        keys = (start_idx * endpoint_count + end_idx) * type_count + type_idx
+    else:
+        _, keys = np.unique(np.stack([start_idx, end_idx, type_idx], axis=1), axis=0,
+                            return_inverse=True)
+        keys = keys.reshape(-1)
 
-    for node_id in outgoing_edges.keys():
-        edge_end_ids = set()
-        for edge in outgoing_edges[node_id]:
-            if edge.end not in edge_end_ids:
-                edge_end_ids.add(edge.end)
-            else:
-                outgoing_edges[node_id].remove(edge)
-                edges.pop(edge.id)
+    timestamps = [getattr(edge, 'properties', {}).get('timestamp') for edge in edge_list]
+    missing = np.asarray([timestamp is None for timestamp in timestamps], dtype=bool)
+    ranks = timestamp_ranks(timestamps)
+    if keep == 'latest':
+        ranks = -ranks
+
+    order = np.lexsort((edge_ids, ranks, missing, keys))
+    _, first = np.unique(keys[order], return_index=True)
+    kept = np.zeros(len(edge_list), dtype=bool)
+    kept[order[first]] = True
+
+    return graph.remove_edges(edge_ids[~kept].tolist())
 
 
 def clean_data_raw(results):
@@ -302,11 +477,27 @@ def clean_data_raw(results):
     return clean_data(graph)
 
 
-def clean_data(graph):
+def clean_data(graph, uuid_index=None):
     """
     Cleans the data by removing anomalous nodes,
     consolidating node versions and renaming symlinked files.
 
+    :param graph: A Graph object
+    :param uuid_index: An optional UuidIndex used to rename symlinked files consistently
+    across graphs
+    :return: Nothing
+    """
+
+    clean_graph_structure(graph)
+    rename_symlinked_files_timestamp(graph, uuid_index)
+
+
+def clean_graph_structure(graph):
+    """
+    The part of clean_data which only changes which nodes and edges a graph has (and where
+    edges point): consolidating node versions, removing duplicate edges and removing
+    anomalous nodes.
+
     :param graph: A Graph object
     :return: Nothing
     """
@@ -314,4 +505,3 @@ def clean_data(graph):
     consolidate_node_versions(graph)
     remove_duplicate_edges(graph)
     remove_anomalous_nodes_edges(graph)
-    rename_symlinked_files_timestamp(graph)
@@ -0,0 +1,135 @@
+"""
+Contains functions to rewrite pattern queries so that, instead of whole path objects with every
+property of every node and relationship, they return compact projections of the paths: lists
+of ids, labels and only the properties the pipeline reads. Also contains the decoder which turns
+the projections back into paths (of LocalNodes and LocalEdges) for the graph builder.
+"""
+
+import re
+import patchy_san.parameters as params
+from data_processing.records import LocalNode, LocalEdge, LocalPath
+
+# Node properties read when cleaning the data, besides params.HASH_PROPERTIES
+BASE_NODE_PROPERTIES = ['timestamp', 'uuid', 'anomalous']
+
+# Edge properties read when cleaning the data, besides params.EDGE_PROPERTIES
+BASE_EDGE_PROPERTIES = ['timestamp']
+
+NODES_SUFFIX = '_nodes'
+EDGES_SUFFIX = '_edges'
+
+_RETURN = re.compile(r'\bRETURN\s+(.*?)(\s+LIMIT\s+\S+)?\s*$', re.IGNORECASE | re.DOTALL)
+_VARIABLE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def projected_properties(base, extra):
+    names = []
+    for name in base + extra:
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def project_query(query, node_properties=None, edge_properties=None):
+    """
+    Rewrites the RETURN clause of a pattern query returning path variables, e.g.
+    'RETURN path1, path2 LIMIT 1000', so that each path p is returned as two lists: p_nodes,
+    of [id, labels, {properties}] per node, and p_edges, of [id, start id, end id, type,
+    {properties}] per edge.
+
+    :param query: A String whose RETURN clause only names path variables
+    :param node_properties: The node properties to return. Defaults to the ones the pipeline
+    reads (BASE_NODE_PROPERTIES and params.HASH_PROPERTIES)
+    :param edge_properties: The edge properties to return. Defaults to BASE_EDGE_PROPERTIES and
+    params.EDGE_PROPERTIES
+    :return: A String
+    """
+
+    if node_properties is None:
+        node_properties = projected_properties(BASE_NODE_PROPERTIES, params.HASH_PROPERTIES)
+    if edge_properties is None:
+        edge_properties = projected_properties(BASE_EDGE_PROPERTIES, params.EDGE_PROPERTIES)
+
+    returns = list(_RETURN.finditer(query))
+    if not returns:
+        raise ValueError("The query has no RETURN clause")
+    clause = returns[-1]
+
+    variables = [variable.strip() for variable in clause.group(1).split(',')]
+    for variable in variables:
+        if not _VARIABLE.match(variable):
+            raise ValueError("Only path variables can be projected, not '%s'" % variable)
+
+    node_map = ', '.join('.' + name for name in node_properties)
+    edge_map = ', '.join('.' + name for name in edge_properties)
+
+    columns = []
+    for variable in variables:
+        columns.append('[n IN nodes(%s) | [Id(n), labels(n), n{%s}]] AS %s%s'
+                       % (variable, node_map, variable, NODES_SUFFIX))
+        columns.append('[r IN relationships(%s) | [Id(r), Id(startNode(r)), Id(endNode(r)), '
+                       'type(r), r{%s}]] AS %s%s' % (variable, edge_map, variable, EDGES_SUFFIX))
+
+    return '%sRETURN %s%s' % (query[:clause.start()], ',\n    '.join(columns),
+                              clause.group(2) or '')
+
+
+def decode_projected_record(record, nodes, edges):
+    """
+    Converts a record of a query rewritten by project_query back into paths.
+
+    :param record: A record (Dictionary-like) with the columns p_nodes and p_edges for each
+    path variable p
+    :param nodes: A Dictionary of node_id -> LocalNode already decoded, which is updated. Nodes
+    appearing in several paths are decoded once
+    :param edges: A Dictionary of edge_id -> LocalEdge already decoded, which is updated
+    :return: A Dictionary of path variable -> LocalPath
+    """
+
+    paths = {}
+
+    for key in record.keys():
+        if not key.endswith(NODES_SUFFIX):
+            continue
+        variable = key[:-len(NODES_SUFFIX)]
+
+        path_nodes = []
+        for node_id, labels, properties in record[key]:
+            node = nodes.get(node_id)
+            if node is None:
+                node = LocalNode(node_id, set(labels),
+                                 {name: value for name, value in properties.items()
+                                  if value is not None})
+                nodes[node_id] = node
+            path_nodes.append(node)
+
+        path_edges = []
+        for edge_id, start, end, edge_type, properties in record[variable + EDGES_SUFFIX]:
+            edge = edges.get(edge_id)
+            if edge is None:
+                edge = LocalEdge(edge_id, start, end, edge_type,
+                                 {name: value for name, value in properties.items()
+                                  if value is not None})
+                edges[edge_id] = edge
+            path_edges.append(edge)
+
+        paths[variable] = LocalPath(path_nodes, path_edges)
+
+    return paths
+
+
+class ProjectedResult:
+    """
+    Wraps the result of a query rewritten by project_query so that it can be used in place of
+    the result of the original query: iterating yields records of path variable -> LocalPath.
+    Records are decoded one at a time.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def __iter__(self):
+        nodes = {}
+        edges = {}
+        for record in self.results:
+            yield decode_projected_record(record, nodes, edges)
@@ -0,0 +1,176 @@
+"""
+Contains a columnar store for node properties. Every property is a dictionary-encoded column
+of int32 codes into a string table shared by all columns, with a presence bitmap recording
+which nodes have the property.
+"""
+
+import numpy as np
+from data_processing.graphs import MISSING_CODE
+
+
+class StringTable:
+    """
+    A table of distinct property values. Each value is stored once and referred to by its
+    integer code. A table may be shared by many PropertyStores (e.g. all graphs in a dataset).
+    """
+
+    def __init__(self, values=None):
+        """
+        Initialises the StringTable object.
+
+        :param values: An optional list of distinct values to start with
+        """
+
+        self.values = []
+        self._code_of = {}
+
+        for value in values or []:
+            self.encode(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        """
+        Returns the code of a value, adding it to the table if it has not been seen before.
+
+        :param value: A hashable value
+        :return: An integer code
+        """
+
+        code = self._code_of.get(value)
+        if code is None:
+            code = len(self.values)
+            self._code_of[value] = code
+            self.values.append(value)
+        return code
+
+
+class PropertyStore:
+    """
+    Stores a set of node properties column by column. Row i of every column belongs to the
+    node with index i in the list of nodes the store was built from.
+    """
+
+    def __init__(self, node_count, properties, codes, presence, table):
+        """
+        Initialises the PropertyStore object. Use build_property_store() to build one.
+
+        :param node_count: The number of nodes (rows)
+        :param properties: A list of property names
+        :param codes: A Dictionary of property -> 1D int32 ndarray of codes into table,
+        MISSING_CODE where the node does not have the property
+        :param presence: A Dictionary of property -> bitmap (ndarray of packed bits) with bit i
+        set if node i has the property
+        :param table: A StringTable
+        """
+
+        self.node_count = node_count
+        self.properties = properties
+        self.codes = codes
+        self.presence = presence
+        self.table = table
+
+    def has(self, prop):
+        """
+        Unpacks the presence bitmap of a property.
+
+        :param prop: A property name
+        :return: A 1D boolean ndarray of length node_count
+        """
+
+        return np.unpackbits(self.presence[prop], count=self.node_count).astype(bool)
+
+    def get(self, prop, index):
+        """
+        Returns the value of a property for one node, or None if the node does not have it.
+
+        :param prop: A property name
+        :param index: The row of the node
+        :return: The property value or None
+        """
+
+        code = self.codes[prop][index]
+        if code == MISSING_CODE:
+            return None
+        return self.table.values[code]
+
+    def map_unique(self, prop, fn):
+        """
+        Applies fn to every distinct value of a property, calling it once per distinct value
+        rather than once per node.
+
+        :param prop: A property name
+        :param fn: A function which takes a property value
+        :return: A list of length node_count with fn(value) for every node which has the
+        property, and None for every node which does not
+        """
+
+        codes = self.codes[prop]
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        results = [None if code == MISSING_CODE else fn(self.table.values[code])
+                   for code in unique_codes.tolist()]
+        return [results[idx] for idx in inverse.reshape(-1).tolist()]
+
+    def nbytes(self):
+        """
+        :return: The number of bytes used by the code columns and presence bitmaps
+        """
+
+        return sum(column.nbytes for column in self.codes.values()) + \
+            sum(bitmap.nbytes for bitmap in self.presence.values())
+
+
+def normalise_value(prop, value):
+    """
+    Converts a raw property value into the value that is stored. Like compute_hash, only the
+    first item of a name is used: the first of a node's names, or the first character of a
+    String name. Empty lists count as missing values.
+
+    :param prop: A property name
+    :param value: The raw property value
+    :return: A hashable value, or None if the value counts as missing
+    """
+
+    if prop == 'name' and isinstance(value, (list, tuple, str)):
+        return value[0] if len(value) > 0 else None
+    if isinstance(value, list):
+        if value == []:
+            return None
+        return tuple(value)
+    return value
+
+
+def build_property_store(nodes, properties=None, table=None):
+    """
+    Builds a PropertyStore for a list of nodes.
+
+    :param nodes: A list of nodes. Row i of the store describes nodes[i]
+    :param properties: A list of property names. Defaults to HASH_PROPERTIES
+    :param table: An optional StringTable to share with other stores
+    :return: A PropertyStore object
+    """
+
+    if properties is None:
+        from patchy_san.parameters import HASH_PROPERTIES
+        properties = HASH_PROPERTIES
+
+    if table is None:
+        table = StringTable()
+
+    node_count = len(nodes)
+    codes = {}
+    presence = {}
+
+    for prop in properties:
+        column = np.full(node_count, MISSING_CODE, dtype=np.int32)
+        for idx, node in enumerate(nodes):
+            value = node.properties.get(prop)
+            value = None if value is None else normalise_value(prop, value)
+            if value is not None:
+                column[idx] = table.encode(value)
+
+        codes[prop] = column
+        presence[prop] = np.packbits(column != MISSING_CODE)
+
+    return PropertyStore(node_count, list(properties), codes, presence, table)
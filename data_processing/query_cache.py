@@ -0,0 +1,232 @@
+"""
+Contains an on-disk cache of query results, used by neo4j_interface_fns.execute_query so that
+repeated experiments do not query the database again for identical results.
+
+Each entry is keyed by a hash of the normalised query text, its parameters and a tag naming the
+database snapshot, and holds the result in the compact form of records.encode_result, pickled
+and compressed. The cache is disabled until configure_query_cache() is called.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from data_processing.records import encode_result, decode_result, write_encoded, read_encoded
+
+ENTRY_SUFFIX = '.qc'
+
+
+class QueryCache:
+    """
+    A content-addressed cache of query results in a directory. Entries older than ttl seconds
+    are treated as missing, and the least recently used entries are evicted once the entries
+    take up more than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=None, ttl=None, snapshot_tag=''):
+        """
+        Initialises the QueryCache object.
+
+        :param directory: The directory holding the entries. Created if it does not exist
+        :param max_bytes: The maximum total size of the entries, or None for no limit
+        :param ttl: The maximum age of an entry in seconds, or None for no limit
+        :param snapshot_tag: A String naming the state of the database (e.g. the date it was
+        loaded). Entries made with a different tag are never returned
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.snapshot_tag = snapshot_tag
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def key(self, query, parameters=None):
+        """
+        Computes the key of a query. Runs of whitespace in the query are collapsed, so the
+        indentation of a query does not change its key.
+
+        :param query: A String
+        :param parameters: An optional Dictionary of query parameters
+        :return: A hex String
+        """
+
+        normalised = ' '.join(query.split())
+        payload = json.dumps([normalised, parameters or {}, self.snapshot_tag],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, query, parameters=None):
+        """
+        Looks up the result of a query.
+
+        :param query: A String
+        :param parameters: An optional Dictionary of query parameters
+        :return: A LocalResult, or None if the result is not cached
+        """
+
+        path = self._path(self.key(query, parameters))
+
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                self._count(False)
+                return None
+
+            encoded = read_encoded(path)
+        except (OSError, IOError):
+            self._count(False)
+            return None
+
+        # Reading an entry makes it the most recently used; the mtime is kept for the ttl.
+        # The entry may have been evicted by another process since it was read
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            pass
+        self._count(True)
+        return decode_result(encoded)
+
+    def put(self, query, parameters, results):
+        """
+        Fetches every record of a query result and stores it.
+
+        :param query: A String
+        :param parameters: A Dictionary of query parameters, or None
+        :param results: A BoltStatementResult
+        :return: A LocalResult with the same records, to be used instead of results (which
+        has been consumed)
+        """
+
+        encoded = encode_result(results)
+        write_encoded(self._path(self.key(query, parameters)), encoded)
+
+        self.evict()
+        return decode_result(encoded)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((status.st_atime, status.st_mtime, status.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Removes expired entries, then the least recently used entries until the total size is
+        at most max_bytes.
+
+        :return: The number of entries removed
+        """
+
+        now = time.time()
+        removed = 0
+        kept = []
+
+        for entry in self._entries():
+            if self.ttl is not None and now - entry[1] > self.ttl:
+                removed += self._remove(entry[3])
+            else:
+                kept.append(entry)
+
+        if self.max_bytes is not None:
+            total = sum(entry[2] for entry in kept)
+            for entry in sorted(kept):
+                if total <= self.max_bytes:
+                    break
+                removed += self._remove(entry[3])
+                total -= entry[2]
+
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def stats(self):
+        """
+        :return: A Dictionary with the number of hits, misses and evictions, and the number and
+        total size (bytes) of the entries
+        """
+
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'bytes': sum(entry[2] for entry in entries),
+        }
+
+    def clear(self):
+        """
+        Removes every entry.
+
+        :return: nothing
+        """
+
+        for entry in self._entries():
+            self._remove(entry[3])
+
+
+_cache = None
+
+
+def configure_query_cache(directory, max_bytes=None, ttl=None, snapshot_tag=''):
+    """
+    Enables caching of query results, see QueryCache.
+
+    :param directory: The directory holding the entries
+    :param max_bytes: The maximum total size of the entries, or None for no limit
+    :param ttl: The maximum age of an entry in seconds, or None for no limit
+    :param snapshot_tag: A String naming the state of the database
+    :return: The new QueryCache
+    """
+
+    global _cache
+    _cache = QueryCache(directory, max_bytes, ttl, snapshot_tag)
+    return _cache
+
+
+def get_query_cache():
+    """
+    :return: The QueryCache in use, or None if caching is disabled
+    """
+
+    return _cache
+
+
+def disable_query_cache():
+    """
+    Disables caching of query results. The entries on disk are kept.
+
+    :return: nothing
+    """
+
+    global _cache
+    _cache = None
@@ -0,0 +1,261 @@
+"""
+Contains plain Python stand-ins for the objects returned by the neo4j driver (nodes,
+relationships, paths and results), and functions to convert a query result to and from a
+compact form that can be stored (e.g. by the query cache) without the driver.
+"""
+
+import os
+import pickle
+import tempfile
+import zlib
+
+
+class LocalNode:
+    """
+    A node with the same attributes as a neo4j Node.
+    """
+
+    def __init__(self, node_id, labels, properties):
+        self.id = node_id
+        self.labels = labels
+        self.properties = properties
+
+
+class LocalEdge:
+    """
+    An edge with the same attributes as a neo4j Relationship.
+    """
+
+    def __init__(self, edge_id, start, end, edge_type, properties):
+        self.id = edge_id
+        self.start = start
+        self.end = end
+        self.type = edge_type
+        self.properties = properties
+
+
+class LocalPath:
+    """
+    A path with the same attributes as a neo4j Path.
+    """
+
+    def __init__(self, nodes, relationships):
+        self.nodes = nodes
+        self.relationships = relationships
+
+
+class LocalResult:
+    """
+    A fully fetched query result which can be used in place of a BoltStatementResult.
+    Unlike a BoltStatementResult it can be iterated more than once.
+    """
+
+    def __init__(self, keys, records):
+        """
+        Initialises the LocalResult object.
+
+        :param keys: A list of the column names
+        :param records: A list of records, each a Dictionary of column name -> value
+        """
+
+        self._keys = keys
+        self.records = records
+
+    def keys(self):
+        return list(self._keys)
+
+    def data(self):
+        return [dict(record) for record in self.records]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+def is_path(value):
+    return hasattr(value, 'relationships') and hasattr(value, 'nodes')
+
+
+def is_edge(value):
+    return hasattr(value, 'start') and hasattr(value, 'end') and hasattr(value, 'type')
+
+
+def is_node(value):
+    return hasattr(value, 'id') and hasattr(value, 'properties')
+
+
+class _Encoder:
+    """
+    Encodes the values of a result. Every distinct node and edge is stored once in a table and
+    referred to by its position in the table.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.edges = []
+        self._node_index = {}
+        self._edge_index = {}
+
+    def node(self, node):
+        index = self._node_index.get(node.id)
+        if index is None:
+            index = len(self.nodes)
+            self._node_index[node.id] = index
+            self.nodes.append((node.id, tuple(getattr(node, 'labels', ())),
+                               dict(node.properties)))
+        return index
+
+    def edge(self, edge):
+        index = self._edge_index.get(edge.id)
+        if index is None:
+            index = len(self.edges)
+            self._edge_index[edge.id] = index
+            self.edges.append((edge.id, edge.start, edge.end, edge.type,
+                               dict(getattr(edge, 'properties', {}))))
+        return index
+
+    def value(self, value):
+        if is_path(value):
+            return ('p', tuple(self.node(node) for node in value.nodes),
+                    tuple(self.edge(edge) for edge in value.relationships))
+        if is_edge(value):
+            return ('r', self.edge(value))
+        if is_node(value):
+            return ('n', self.node(value))
+        if isinstance(value, (list, tuple)):
+            return ('l', [self.value(item) for item in value])
+        if isinstance(value, dict):
+            return ('d', {key: self.value(item) for key, item in value.items()})
+        return ('v', value)
+
+
+def encode_result(results):
+    """
+    Fetches every record of a query result and converts it into plain, picklable Python data.
+
+    :param results: A BoltStatementResult (or LocalResult)
+    :return: A Dictionary with the keys 'keys', 'nodes', 'edges' and 'records'
+    """
+
+    encoder = _Encoder()
+    keys = None
+    records = []
+
+    for record in results:
+        if keys is None:
+            keys = list(record.keys())
+        records.append(tuple(encoder.value(record[key]) for key in keys))
+
+    if keys is None:
+        keys = list(results.keys()) if hasattr(results, 'keys') else []
+
+    return {'keys': keys, 'nodes': encoder.nodes, 'edges': encoder.edges, 'records': records}
+
+
+def encode_chunks(results, max_bytes, max_records=None):
+    """
+    Like encode_result, but streams the records of a query result into several encoded
+    results, starting a new one whenever the pickled size of the current one reaches
+    max_bytes. Only one chunk is held in memory at a time, however large the result is. A node
+    or edge appearing in several chunks is stored in each of them.
+
+    :param results: A BoltStatementResult (or LocalResult)
+    :param max_bytes: The size (pickled, uncompressed, in bytes) at which a chunk is complete
+    :param max_records: The maximum number of records encoded, or None for all of them
+    :return: A generator of Dictionaries as returned by encode_result, none of them empty
+    """
+
+    encoder = _Encoder()
+    keys = None
+    records = []
+    size = 0
+
+    for record in results:
+        if max_records is not None and max_records <= 0:
+            break
+        if keys is None:
+            keys = list(record.keys())
+
+        node_count, edge_count = len(encoder.nodes), len(encoder.edges)
+        records.append(tuple(encoder.value(record[key]) for key in keys))
+        size += len(pickle.dumps((encoder.nodes[node_count:], encoder.edges[edge_count:],
+                                  records[-1]), protocol=pickle.HIGHEST_PROTOCOL))
+        if max_records is not None:
+            max_records -= 1
+
+        if size >= max_bytes:
+            yield {'keys': keys, 'nodes': encoder.nodes, 'edges': encoder.edges,
+                   'records': records}
+            encoder = _Encoder()
+            records = []
+            size = 0
+
+    if records:
+        yield {'keys': keys, 'nodes': encoder.nodes, 'edges': encoder.edges, 'records': records}
+
+
+def decode_result(encoded):
+    """
+    Converts the output of encode_result back into a result. Each distinct node and edge is
+    decoded into one LocalNode or LocalEdge, shared by every record it appears in.
+
+    :param encoded: A Dictionary returned by encode_result
+    :return: A LocalResult object
+    """
+
+    nodes = [LocalNode(node_id, set(labels), properties)
+             for (node_id, labels, properties) in encoded['nodes']]
+    edges = [LocalEdge(edge_id, start, end, edge_type, properties)
+             for (edge_id, start, end, edge_type, properties) in encoded['edges']]
+
+    def decode(value):
+        kind = value[0]
+        if kind == 'p':
+            return LocalPath([nodes[idx] for idx in value[1]], [edges[idx] for idx in value[2]])
+        if kind == 'r':
+            return edges[value[1]]
+        if kind == 'n':
+            return nodes[value[1]]
+        if kind == 'l':
+            return [decode(item) for item in value[1]]
+        if kind == 'd':
+            return {key: decode(item) for key, item in value[1].items()}
+        return value[1]
+
+    keys = encoded['keys']
+    records = [dict(zip(keys, (decode(value) for value in record)))
+               for record in encoded['records']]
+    return LocalResult(keys, records)
+
+
+def write_encoded(path, encoded):
+    """
+    Writes the output of encode_result to a file, pickled and compressed. The file is written
+    under a temporary name and then renamed, so readers never see a partial file.
+
+    :param path: The path of the file
+    :param encoded: A Dictionary returned by encode_result
+    :return: The size of the file in bytes
+    """
+
+    data = zlib.compress(pickle.dumps(encoded, protocol=pickle.HIGHEST_PROTOCOL))
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(handle, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(temp_path, path)
+    return len(data)
+
+
+def read_encoded(path):
+    """
+    Reads a file written by write_encoded.
+
+    :param path: The path of the file
+    :return: A Dictionary as returned by encode_result
+    """
+
+    with open(path, 'rb') as input_file:
+        return pickle.loads(zlib.decompress(input_file.read()))
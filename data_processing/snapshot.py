@@ -0,0 +1,375 @@
+"""
+Contains functions to export a provenance graph (e.g. the whole database) to a local, columnar
+snapshot, and an offline store which serves the queries the pipeline needs from a snapshot
+instead of from Neo4j.
+
+A snapshot is a directory of .npy arrays and one JSON file of tables:
+
+- node_ids, edge_ids: the sorted node and edge ids. The position of an id is its index.
+- node_labels: the code of the label set of every node, into the 'labels' table.
+- edge_start, edge_end: the node index of the ends of every edge.
+- edge_type, edge_state: codes into the 'types' and 'states' tables (MISSING_CODE if none).
+- in_indptr, in_indices, in_edges, out_indptr, out_indices, out_edges: the CSR adjacency,
+  as in CompactGraph.
+- node_<property>, edge_<property>: the property columns (see columns.py), with the
+  description of each column in the 'node_columns' and 'edge_columns' tables. Numbers (e.g.
+  timestamps) are stored in typed arrays, and values with many distinct values (e.g. uuids) in
+  a byte array; only the distinct values of low-cardinality columns are kept in the JSON file.
+
+The arrays are loaded memory-mapped, so opening a snapshot is cheap and only the parts used
+are read from disk. Node and edge objects are only created for the nodes and edges returned.
+"""
+
+import json
+import os
+import re
+import numpy as np
+import patchy_san.parameters as params
+from data_processing.columns import ColumnBuilder, load_array, load_column
+from data_processing.graphs import CompactGraph, MISSING_CODE, build_csr, lookup_indices
+from data_processing.projection import BASE_NODE_PROPERTIES, BASE_EDGE_PROPERTIES, \
+    projected_properties
+from data_processing.neighbourhood import bounded_bfs, graph_expander, induced_subgraph, \
+    path_union_ids
+from data_processing.preprocessing import clean_data, get_graph_from_entities
+
+SNAPSHOT_FORMAT = 2
+TABLES_FILE = 'tables.json'
+
+STRUCTURE_ARRAYS = ['node_ids', 'node_labels', 'edge_ids', 'edge_start', 'edge_end',
+                    'edge_type', 'edge_state']
+CSR_ARRAYS = ['in_indptr', 'in_indices', 'in_edges', 'out_indptr', 'out_indices', 'out_edges']
+
+
+class _Table:
+    """
+    A list of distinct JSON-serialisable values, each referred to by its position.
+    """
+
+    def __init__(self):
+        self.values = []
+        self._code_of = {}
+
+    def encode(self, value):
+        key = json.dumps(value, sort_keys=True)
+        code = self._code_of.get(key)
+        if code is None:
+            code = len(self.values)
+            self._code_of[key] = code
+            self.values.append(value)
+        return code
+
+
+class SnapshotWriter:
+    """
+    Builds a snapshot from nodes and edges added one at a time (e.g. page by page from the
+    database). Only ids, codes and the property columns being built (see
+    columns.ColumnBuilder) are kept in memory until close() writes the arrays.
+    """
+
+    def __init__(self, directory, node_properties=None, edge_properties=None):
+        """
+        Initialises the SnapshotWriter object.
+
+        :param directory: The directory to write the snapshot to. Created if it does not exist
+        :param node_properties: The node properties stored. Defaults to the ones the pipeline
+        reads (see projection.project_query)
+        :param edge_properties: The edge properties stored besides 'state', which is always
+        stored as edge_state. Defaults to projection.BASE_EDGE_PROPERTIES
+        """
+
+        if node_properties is None:
+            node_properties = projected_properties(BASE_NODE_PROPERTIES, params.HASH_PROPERTIES)
+        if edge_properties is None:
+            edge_properties = [name for name in BASE_EDGE_PROPERTIES if name != 'state']
+
+        self.directory = directory
+        self.node_properties = list(node_properties)
+        self.edge_properties = list(edge_properties)
+
+        self._labels = _Table()
+        self._types = _Table()
+        self._states = _Table()
+
+        self._node_ids = []
+        self._node_labels = []
+        self._node_columns = {name: ColumnBuilder() for name in self.node_properties}
+        self._edge_ids = []
+        self._edge_starts = []
+        self._edge_ends = []
+        self._edge_types = []
+        self._edge_states = []
+        self._edge_columns = {name: ColumnBuilder() for name in self.edge_properties}
+
+    def add_node(self, node):
+        self._node_ids.append(node.id)
+        self._node_labels.append(self._labels.encode(sorted(getattr(node, 'labels', ()))))
+        for name, column in self._node_columns.items():
+            column.append(node.properties.get(name))
+
+    def add_edge(self, edge):
+        properties = getattr(edge, 'properties', {})
+        state = properties.get('state')
+
+        self._edge_ids.append(edge.id)
+        self._edge_starts.append(edge.start)
+        self._edge_ends.append(edge.end)
+        self._edge_types.append(self._types.encode(edge.type))
+        self._edge_states.append(MISSING_CODE if state is None else self._states.encode(state))
+        for name, column in self._edge_columns.items():
+            column.append(properties.get(name))
+
+    def _save_columns(self, prefix, builders, order):
+        specs = {}
+        for name, builder in builders.items():
+            column = builder.finish().take(order)
+            specs[name] = column.save(os.path.join(self.directory, prefix + name))
+        return specs
+
+    def close(self):
+        """
+        Writes the snapshot.
+
+        :return: The directory of the snapshot
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {}
+
+        node_ids = np.asarray(self._node_ids, dtype=np.int64)
+        node_order = np.argsort(node_ids, kind='stable')
+        arrays['node_ids'] = node_ids[node_order]
+        arrays['node_labels'] = np.asarray(self._node_labels, dtype=np.int32)[node_order]
+
+        edge_ids = np.asarray(self._edge_ids, dtype=np.int64)
+        edge_order = np.argsort(edge_ids, kind='stable')
+        edge_start = lookup_indices(arrays['node_ids'],
+                                    np.asarray(self._edge_starts, dtype=np.int64)[edge_order])
+        edge_end = lookup_indices(arrays['node_ids'],
+                                  np.asarray(self._edge_ends, dtype=np.int64)[edge_order])
+
+        dangling = np.flatnonzero((edge_start < 0) | (edge_end < 0))
+        if len(dangling) > 0:
+            raise ValueError("Edge %s references a node which is not in the snapshot"
+                             % edge_ids[edge_order][dangling[0]])
+
+        arrays['edge_ids'] = edge_ids[edge_order]
+        arrays['edge_start'] = edge_start.astype(np.int32)
+        arrays['edge_end'] = edge_end.astype(np.int32)
+        arrays['edge_type'] = np.asarray(self._edge_types, dtype=np.int16)[edge_order]
+        arrays['edge_state'] = np.asarray(self._edge_states, dtype=np.int16)[edge_order]
+
+        node_count = len(arrays['node_ids'])
+        arrays['in_indptr'], arrays['in_indices'], arrays['in_edges'] = \
+            build_csr(arrays['edge_end'], arrays['edge_start'], node_count)
+        arrays['out_indptr'], arrays['out_indices'], arrays['out_edges'] = \
+            build_csr(arrays['edge_start'], arrays['edge_end'], node_count)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(self.directory, name + '.npy'), array)
+
+        tables = {
+            'format': SNAPSHOT_FORMAT,
+            'labels': self._labels.values,
+            'types': self._types.values,
+            'states': self._states.values,
+            'node_columns': self._save_columns('node_', self._node_columns, node_order),
+            'edge_columns': self._save_columns('edge_', self._edge_columns, edge_order),
+        }
+        with open(os.path.join(self.directory, TABLES_FILE), 'w') as tables_file:
+            json.dump(tables, tables_file)
+
+        return self.directory
+
+
+def export_graph(graph, directory, node_properties=None, edge_properties=None):
+    """
+    Writes the nodes and edges of a Graph (or CompactGraph) to a snapshot.
+
+    :param graph: A Graph object
+    :param directory: The directory to write the snapshot to
+    :param node_properties: See SnapshotWriter
+    :param edge_properties: See SnapshotWriter
+    :return: The directory of the snapshot
+    """
+
+    writer = SnapshotWriter(directory, node_properties, edge_properties)
+    for node in graph.nodes.values():
+        writer.add_node(node)
+    for edge in graph.edges.values():
+        writer.add_edge(edge)
+    return writer.close()
+
+
+class SnapshotGraph(CompactGraph):
+    """
+    A CompactGraph whose arrays and property columns are memory-mapped from a snapshot. As
+    with any CompactGraph, its nodes and edges are LocalNodes and LocalEdges built from the
+    columns on every access, so the Graphs built from it can be modified (e.g. cleaned)
+    without changing the snapshot or each other.
+    """
+
+    def __init__(self, directory):
+        """
+        Initialises the SnapshotGraph object.
+
+        :param directory: The directory of a snapshot written by SnapshotWriter
+        """
+
+        with open(os.path.join(directory, TABLES_FILE)) as tables_file:
+            tables = json.load(tables_file)
+        if tables['format'] != SNAPSHOT_FORMAT:
+            raise ValueError("Unsupported snapshot format %s" % tables['format'])
+
+        def load(name):
+            return load_array(os.path.join(directory, name + '.npy'))
+
+        def load_columns(prefix, specs):
+            return {name: load_column(os.path.join(directory, prefix + name), spec)
+                    for name, spec in specs.items()}
+
+        node_ids, node_labels, edge_ids, edge_start, edge_end, edge_type, edge_state = \
+            [load(name) for name in STRUCTURE_ARRAYS]
+
+        super().__init__(node_ids, node_labels, tables['labels'], edge_ids, edge_start, edge_end,
+                         edge_type, edge_state, tables['types'], tables['states'],
+                         load_columns('node_', tables['node_columns']),
+                         load_columns('edge_', tables['edge_columns']),
+                         tuple(load(name) for name in CSR_ARRAYS))
+        self.directory = directory
+
+
+class OfflineStore:
+    """
+    Serves the graph queries of the pipeline from a snapshot, with the same results as the
+    corresponding functions of neo4j_interface_fns and utility.db_exploration.
+    """
+
+    def __init__(self, directory):
+        """
+        Initialises the OfflineStore object.
+
+        :param directory: The directory of a snapshot written by SnapshotWriter
+        """
+
+        self.graph = SnapshotGraph(directory)
+
+    def expander(self, direction='in'):
+        """
+        Creates an expand function for neighbourhood.bounded_bfs which reads the CSR arrays
+        directly, without creating node or edge objects.
+
+        :param direction: 'in', 'out' or 'both', see neighbourhood.graph_expander
+        :return: A function taking a list of node ids and returning a list of node ids
+        """
+
+        return graph_expander(self.graph, direction)
+
+    def get_graph_by_ids(self, node_ids):
+        """
+        Offline version of neo4j_interface_fns.get_graph_by_ids.
+
+        :param node_ids: An iterable of node ids
+        :return: A Graph object of the nodes and every edge between them
+        """
+
+        node_ids = [node_id for node_id in node_ids if node_id in self.graph.nodes]
+        return induced_subgraph(self.graph, node_ids)
+
+    def get_neighborhood_bounded(self, start_id, max_depth, max_nodes, direction='in'):
+        """
+        Offline version of neo4j_interface_fns.get_neighborhood_bounded.
+
+        :return: A Graph object
+        """
+
+        node_ids = bounded_bfs(self.expander(direction), [start_id], max_depth, max_nodes)
+        return self.get_graph_by_ids(node_ids)
+
+    def get_path_union(self, root_id, end_id, max_depth=None):
+        """
+        Offline version of neo4j_interface_fns.get_path_union.
+
+        :return: A Graph object
+        """
+
+        node_ids = path_union_ids(self.expander('out'), self.expander('in'), root_id, end_id,
+                                  max_depth)
+        return self.get_graph_by_ids(node_ids)
+
+    def get_all_successor_nodes(self, root_id, max_depth=None):
+        """
+        Offline version of db_exploration.get_all_successor_nodes: the nodes with a path to
+        the root node.
+
+        :return: A Graph object
+        """
+
+        node_ids = bounded_bfs(self.expander('in'), [root_id], max_depth, None)
+        return self.get_graph_by_ids(node_ids)
+
+    def find_nodes(self, prop, pattern):
+        """
+        Finds the nodes with a String property fully matching a regular expression, as the
+        Cypher =~ operator. Each distinct value is only matched once.
+
+        :param prop: A node property name
+        :param pattern: A regular expression
+        :return: A 1D ndarray of the ids of the matching nodes
+        """
+
+        regex = re.compile(pattern)
+        matched = {}
+
+        def matches(value):
+            if not isinstance(value, str):
+                return False
+            if value not in matched:
+                matched[value] = regex.fullmatch(value) is not None
+            return matched[value]
+
+        return self.graph.node_ids[self.graph.node_columns[prop].mask(matches)]
+
+    def get_attack_nodes(self):
+        """
+        Offline version of db_exploration.get_attack_nodes.
+
+        :return: A tuple of (nodes, edges). nodes is a Dictionary of node_id -> node, edges
+        is a Dictionary of edge_id -> edge
+        """
+
+        graph = get_graph_from_entities(
+            [self.graph.nodes[node_id] for node_id in self.find_nodes('cmdline', '.*attack.*')], [])
+        clean_data(graph)
+        return graph.nodes, graph.edges
+
+    def get_attack_paths(self, nodes, max_depth=params.ATTACK_PATHS_MAX_DEPTH):
+        """
+        Offline version of db_exploration.get_attack_paths.
+
+        :param nodes: A Dictionary of node_id -> node
+        :param max_depth: The maximum length of the paths searched, a positive integer
+        :return: A list of sets of paths (String), in the same order as nodes
+        """
+
+        if max_depth is None or max_depth < 1:
+            raise ValueError("max_depth must be a positive integer, not %s" % max_depth)
+
+        name_column = self.graph.node_columns['name']
+        expand = self.expander('in')
+        path_sets = []
+
+        for node_id in nodes:
+            # The attack node itself only counts if it is on a cycle, as in the Cypher query
+            ancestors = set(bounded_bfs(expand, expand([nodes[node_id].id]), max_depth - 1, None))
+            indices = self.graph.indices_of(sorted(ancestors))
+
+            paths = set()
+            for index in indices[indices >= 0].tolist():
+                value = name_column.get(index)
+                if value:
+                    paths.add(value[0])
+            path_sets.append(paths)
+
+        return path_sets
+
@@ -0,0 +1,107 @@
+"""
+Contains an index of the canonical (oldest) name of every uuid, used to rename symlinked files
+consistently across all the graphs of a dataset.
+"""
+
+import pickle
+
+
+class UuidIndex:
+    """
+    A persistent map of uuid -> (oldest timestamp, canonical name). The name of a uuid is the
+    name of the node with the smallest timestamp seen so far which has that uuid and a name.
+
+    The index is built once per dataset or snapshot and updated incrementally as graphs stream
+    in. Note that a graph renamed before an older node with the same uuid has been seen keeps
+    the name that was canonical at the time; update the index with every graph first if that
+    matters.
+    """
+
+    def __init__(self, entries=None):
+        """
+        Initialises the UuidIndex object.
+
+        :param entries: An optional Dictionary of uuid -> (timestamp, name) to start with
+        """
+
+        self.entries = {} if entries is None else entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, graph):
+        """
+        Adds the nodes of a graph to the index. Nodes without a uuid, a timestamp or a name are
+        ignored. If several nodes have the same timestamp, the first one seen wins.
+
+        :param graph: A Graph object
+        :return: nothing
+        """
+
+        entries = self.entries
+
+        for node in graph.nodes.values():
+            node_prop = node.properties
+            if 'uuid' in node_prop and 'timestamp' in node_prop and 'name' in node_prop:
+                uuid = node_prop['uuid']
+                timestamp = node_prop['timestamp']
+                entry = entries.get(uuid)
+                if entry is None or timestamp < entry[0]:
+                    # A copy, so later changes to the node's names do not change the index
+                    name = node_prop['name']
+                    entries[uuid] = (timestamp, list(name) if isinstance(name, list) else name)
+
+    def canonical_name(self, uuid):
+        """
+        :param uuid: A uuid
+        :return: The canonical name of the uuid, or None if it is not in the index
+        """
+
+        entry = self.entries.get(uuid)
+        return None if entry is None else entry[1]
+
+    def rename(self, graph):
+        """
+        Renames every node in a graph which has a uuid and a name with the canonical name of
+        its uuid, one lookup per node.
+
+        :param graph: A Graph object
+        :return: The number of nodes renamed
+        """
+
+        renamed = 0
+
+        for node in graph.nodes.values():
+            node_prop = node.properties
+            if 'uuid' in node_prop and 'name' in node_prop:
+                entry = self.entries.get(node_prop['uuid'])
+                if entry is not None and node_prop['name'] != entry[1]:
+                    # Every name of the canonical node is used, copied per renamed node
+                    name = entry[1]
+                    node_prop['name'] = list(name) if isinstance(name, list) else name
+                    renamed += 1
+
+        return renamed
+
+    def save(self, path):
+        """
+        Saves the index to a file, e.g. next to the cached graphs it was built from.
+
+        :param path: The path of the file
+        :return: nothing
+        """
+
+        with open(path, 'wb') as index_file:
+            pickle.dump(self.entries, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_uuid_index(path):
+    """
+    Loads an index saved by UuidIndex.save.
+
+    :param path: The path of the file
+    :return: A UuidIndex object
+    """
+
+    with open(path, 'rb') as index_file:
+        return UuidIndex(pickle.load(index_file))
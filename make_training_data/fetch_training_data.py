@@ -2,8 +2,82 @@
 This module contains functions to fetch data from the database according to particular rules
 (e.g. process downloaded a file from the internet, then executed it).
 Each function corresponds to one rule.
+
+The queries of each rule are run concurrently; their results keep the order of the queries,
+since label_and_process_data labels the results by position.
+
+get_train_paginated fetches every match of a rule instead of the first LIMIT matches, by
+paging through them into a spool directory.
+
+If params.PROJECT_PROPERTIES is set, the queries only fetch the ids, labels and properties
+the pipeline reads, and the results yield paths of LocalNodes and LocalEdges. If
+params.LAZY_PROPERTIES is also set, they only fetch the structure of the matches; the other
+properties are fetched later by the PropertyHydrator from get_property_hydrator().
 """
-from data_processing.neo4j_interface_fns import execute_query
+import os
+import patchy_san.parameters as params
+from data_processing.neo4j_interface_fns import execute_query, execute_queries, fetch_paginated
+from data_processing.projection import project_query, ProjectedResult
+from data_processing.hydration import structure_query, PropertyHydrator
+from data_processing.pattern_matching import Pattern, tree_pattern, find_matches, \
+    iter_match_records
+
+# The patterns of the get_train_*_general functions (and get_train_4_node_simple), as lists of
+# (start, end) edges, for matching in a local snapshot with get_train_local
+GENERAL_PATTERN_EDGES = {
+    4: [('node2', 'node1'), ('node3', 'node1'), ('node4', 'node1')],
+    6: [('node2', 'node1'), ('node3', 'node1'), ('node4', 'node1'), ('node5', 'node3'),
+        ('node6', 'node3')],
+    8: [('node2', 'node1'), ('node3', 'node1'), ('node4', 'node1'), ('node5', 'node3'),
+        ('node6', 'node3'), ('node7', 'node5'), ('node8', 'node6')],
+    10: [('node2', 'node1'), ('node3', 'node1'), ('node4', 'node1'), ('node5', 'node3'),
+         ('node6', 'node3'), ('node7', 'node5'), ('node8', 'node6'), ('node6', 'node9'),
+         ('node9', 'node10')],
+    12: [('node2', 'node1'), ('node3', 'node1'), ('node4', 'node1'), ('node5', 'node3'),
+         ('node6', 'node3'), ('node7', 'node5'), ('node8', 'node6'), ('node6', 'node9'),
+         ('node9', 'node10'), ('node2', 'node11'), ('node4', 'node12')],
+    16: [('node2', 'node1'), ('node3', 'node1'), ('node4', 'node1'), ('node5', 'node3'),
+         ('node6', 'node3'), ('node7', 'node5'), ('node8', 'node6'), ('node6', 'node9'),
+         ('node9', 'node10'), ('node11', 'node6'), ('node12', 'node6'), ('node13', 'node6'),
+         ('node14', 'node6')],
+}
+
+
+def rule_query(query):
+    """
+    :param query: A pattern query
+    :return: The query as it is run, according to params.PROJECT_PROPERTIES and
+    params.LAZY_PROPERTIES
+    """
+
+    if params.LAZY_PROPERTIES:
+        return structure_query(query)
+    return project_query(query)
+
+
+def get_property_hydrator():
+    """
+    :return: A PropertyHydrator fetching the node properties left out when
+    params.LAZY_PROPERTIES is set
+    """
+
+    return PropertyHydrator(execute_query)
+
+
+def run_rule_queries(queries):
+    """
+    Executes the queries of a rule concurrently, projected if params.PROJECT_PROPERTIES is set.
+    A query repeated in the list is only run once, see neo4j_interface_fns.iter_queries.
+
+    :param queries: A list of query Strings
+    :return: A list of results, in the same order as the queries
+    """
+
+    if not params.PROJECT_PROPERTIES:
+        return execute_queries(queries)
+
+    results = execute_queries([rule_query(query) for query in queries])
+    return [ProjectedResult(result) for result in results]
 
 
 def get_train_3_node_simple():
@@ -36,9 +110,7 @@ def get_train_3_node_simple():
     RETURN path1, path2 LIMIT 2000
     """
 
-    return [execute_query(download_file_write),
-            execute_query(proc_proc_soc),
-            execute_query(negative_data)]
+    return run_rule_queries([download_file_write, proc_proc_soc, negative_data])
 
 
 def get_train_4_node_diff_name():
@@ -77,12 +149,9 @@ def get_train_4_node_diff_name():
 
     names = ['/etc/libmap.conf', '/lib/libc.so.7', '/lib/libcrypto.so.8']
 
-    results = []
-    for name in names:
-        results.append(execute_query(general_pattern % name))
-
-    results.append(execute_query(negative_data))
-    return results
+    queries = [general_pattern % name for name in names]
+    queries.append(negative_data)
+    return run_rule_queries(queries)
 
 
 def get_train_4_node_test_cmdline():
@@ -109,7 +178,7 @@ def get_train_4_node_test_cmdline():
     RETURN path1,path2,path3 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(negative_data)]
+    return run_rule_queries([pattern, negative_data])
 
 
 def get_train_4_node_simple():
@@ -128,7 +197,7 @@ def get_train_4_node_simple():
     RETURN path1,path2,path3 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(pattern)]
+    return run_rule_queries([pattern, pattern])
 
 
 def get_train_6_node_general():
@@ -147,7 +216,7 @@ def get_train_6_node_general():
     RETURN path1,path2,path3,path4,path5 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(pattern)]
+    return run_rule_queries([pattern, pattern])
 
 
 def get_train_8_nodes_general():
@@ -163,7 +232,7 @@ def get_train_8_nodes_general():
     RETURN path1,path2,path3,path4,path5,path6,path7 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(pattern)]
+    return run_rule_queries([pattern, pattern])
 
 
 def get_train_10_nodes_general():
@@ -181,7 +250,7 @@ def get_train_10_nodes_general():
     RETURN path1,path2,path3,path4,path5,path6,path7,path8,path9 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(pattern)]
+    return run_rule_queries([pattern, pattern])
 
 
 def get_train_12_nodes_general():
@@ -201,7 +270,7 @@ def get_train_12_nodes_general():
     RETURN path1,path2,path3,path4,path5,path6,path7,path8,path9,path10,path11 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(pattern)]
+    return run_rule_queries([pattern, pattern])
 
 
 def get_train_16_nodes_general():
@@ -223,4 +292,81 @@ def get_train_16_nodes_general():
     RETURN path1,path2,path3,path4,path5,path6,path7,path8,path9,path10,path11,path12,path13 LIMIT 1000
     """
 
-    return [execute_query(pattern), execute_query(pattern)]
\ No newline at end of file
+    return run_rule_queries([pattern, pattern])
+
+
+def get_train_paginated(queries, spool_dir, max_matches=None):
+    """
+    Fetches every match of the queries of a rule, page by page, instead of the first LIMIT
+    matches. The matches of each query are spooled to a subdirectory of spool_dir and read back
+    one page at a time, so a dataset can be larger than memory. Rerunning with the same
+    spool_dir resumes an interrupted fetch.
+
+    For example, get_train_paginated([(pattern, 'node1'), (pattern, 'node1')], spool_dir)
+    fetches the data of get_train_4_node_simple without its limit.
+
+    :param queries: A list of tuples (query, anchor), where anchor is the name of the node
+    variable of the query to paginate on
+    :param spool_dir: The directory the pages are written to
+    :param max_matches: The maximum number of matches fetched per query, or None for all
+    :return: A list of SpooledResult objects (wrapped in ProjectedResults if
+    params.PROJECT_PROPERTIES is set), in the same order as the queries
+    """
+
+    results = []
+    for idx, (query, anchor) in enumerate(queries):
+        if params.PROJECT_PROPERTIES:
+            query = rule_query(query)
+
+        result = fetch_paginated(query, anchor, os.path.join(spool_dir, 'query_%d' % idx),
+                                 max_matches=max_matches)
+        results.append(ProjectedResult(result) if params.PROJECT_PROPERTIES else result)
+
+    return results
+
+
+def general_pattern(node_count):
+    """
+    :param node_count: 4, 6, 8, 10, 12 or 16
+    :return: The Pattern of the get_train_*_general function with that many nodes
+    """
+
+    return tree_pattern(GENERAL_PATTERN_EDGES[node_count])
+
+
+def download_file_write_pattern():
+    """
+    :return: The Pattern of the first query of get_train_3_node_simple: a process written to by
+    a file, and connected to a socket. As in the query, each edge is in its own MATCH clause
+    """
+
+    pattern = Pattern()
+    pattern.node('process', ['Process'])
+    pattern.node('file', ['File'])
+    pattern.node('socket', ['Socket'])
+    pattern.edge('file', 'process', states=['RaW', 'WRITE'])
+    pattern.new_clause()
+    pattern.edge('socket', 'process')
+    return pattern
+
+
+def get_train_local(graph, patterns, limit=1000, seed=None, workers=None):
+    """
+    Local version of the get_train_* functions: finds the matches of each pattern in a graph
+    in memory, e.g. the SnapshotGraph of an OfflineStore, instead of querying the database.
+
+    For example, get_train_local(graph, [general_pattern(8), general_pattern(8)]) gives the
+    data of get_train_8_nodes_general.
+
+    :param graph: A CompactGraph object
+    :param patterns: A list of Pattern objects, one per class
+    :param limit: The maximum number of matches per pattern, or None for all of them
+    :param seed: If given, the matches are drawn in an order randomised by this seed
+    :param workers: The number of worker processes used to find the matches of each pattern,
+    or None to find them in this process
+    :return: A list of results (iterables of records), in the same order as the patterns, which
+    can be given to label_and_process_data
+    """
+
+    return [iter_match_records(graph, find_matches(graph, pattern, limit, seed, workers))
+            for pattern in patterns]
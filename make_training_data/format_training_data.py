@@ -5,42 +5,143 @@ model.
 import patchy_san.make_cnn_input as make_input
 import patchy_san.parameters as params
 import data_processing.preprocessing as preprocess
+import data_processing.parallel as parallel
+from data_processing.uuid_index import UuidIndex
 
 import numpy as np
 
 
-def label_and_process_data(results):
+def iter_label_and_process_data(results, uuid_index=None, workers=None):
+    """
+    Generator version of label_and_process_data. Graphs are built from each
+    BoltStatementResult lazily and yielded as soon as they are ready, so every graph does not
+    have to be held at once. The results themselves are read in full by the driver unless they
+    are streamed, e.g. by neo4j_interface_fns.stream_query.
+
+    :param results An iterable of BoltStatementResults.
+    :param uuid_index: An optional UuidIndex used to rename symlinked files when the data is
+    cleaned. By default one index is built for the whole dataset as the graphs stream in.
+    :param workers: If given, the graphs of each result are built first, then cleaned by this
+    many worker processes (see preprocessing.get_graphs_by_result)
+    :return: A generator of tuples of (label, graph). label is an integer, graph is a Graph object.
+    """
+
+    label = 0
+    if uuid_index is None:
+        uuid_index = UuidIndex()
+
+    for result in results:
+        if workers is None:
+            result_graphs = preprocess.iter_graphs_by_result(result, uuid_index=uuid_index)
+        else:
+            result_graphs = preprocess.get_graphs_by_result(result, workers, uuid_index)
+        for graph in result_graphs:
+            yield label, graph
+
+        label += 1
+
+    print("Raw data has been formatted into Graph objects.")
+
+
+def label_and_process_data(results, uuid_index=None, workers=None):
     """
     Given a list of BoltStatementResults, each of which corresponds to training data for
     one class, process it by labelling it correctly and creating graphs for each training
     example (e.g one BoltStatementResult has many training examples).
 
     :param results A list of BoltstatementResults.
+    :param uuid_index: An optional UuidIndex, see iter_label_and_process_data
+    :param workers: The number of worker processes used to clean the graphs, or None, see
+    iter_label_and_process_data
     :return: A list of tuplesof (label, graph). label is an integer, graph is a Graph object/
     """
 
-    training_graphs = []
-    label = 0
+    return list(iter_label_and_process_data(results, uuid_index, workers))
 
-    for result in results:
-        graph_list = preprocess.get_graphs_by_result(result)
 
-        for graph in graph_list:
+def label_and_hydrate_data(results, hydrator, uuid_index=None):
+    """
+    Version of label_and_process_data for results fetched with params.LAZY_PROPERTIES set,
+    which only hold the structure of each match. The graphs are built and their structure
+    cleaned, the graphs create_balanced_training_set would drop are dropped, and only then are
+    the other node properties fetched (and symlinked files renamed) for the graphs kept.
+
+    :param results: A list of results of structure-only queries
+    :param hydrator: A PropertyHydrator, e.g. from fetch_training_data.get_property_hydrator()
+    :param uuid_index: An optional UuidIndex, see iter_label_and_process_data
+    :return: A list of tuples of (label, graph)
+    """
+
+    training_graphs = []
+    for label, result in enumerate(results):
+        for graph in preprocess.iter_graphs_by_result(result, structure_only=True):
             training_graphs.append((label, graph))
 
-        label += 1
+    labels = np.asarray([label for label, _ in training_graphs], dtype=np.int32)
+    if len(labels) > 0:
+        _, counts = np.unique(labels, return_counts=True)
+        training_graphs = [training_graphs[i] for i in balanced_indices(labels, np.amin(counts))]
+    hydrator.hydrate([graph for _, graph in training_graphs])
+    print("Properties fetched for %s graphs in %s queries." % (len(training_graphs),
+                                                               hydrator.queries))
+
+    if params.CLEAN_TRAIN_DATA:
+        if uuid_index is None:
+            uuid_index = UuidIndex()
+        for _, graph in training_graphs:
+            preprocess.rename_symlinked_files_timestamp(graph, uuid_index)
 
-    print("Raw data has been formatted into Graph objects.")
     return training_graphs
 
 
-def format_all_training_data(training_graphs):
+def featurise_graph(graph):
+    """
+    Builds the three model inputs for one training graph.
+
+    :param graph: A Graph object
+    :return: A tuple of ndarrays (nodes_tensor, edges_tensor, embedding)
+    """
+
+    receptive_fields_groups = make_input.build_groups_of_receptive_fields(graph)
+
+    # For training data there will only be one receptive field group, so assume
+    # that length of receptive_field_groups is 1
+    if len(receptive_fields_groups) != 1:
+        msg = "More or less than one receptive field group exists in the training example."
+        msg += " %s groups exist" % len(receptive_fields_groups)
+        print("Field count " + str(params.FIELD_COUNT))
+        raise ValueError(msg)
+
+    nodes_tensor = make_input.build_tensor_naive_hashing(receptive_fields_groups[0])
+    edges_tensor = make_input.build_edges_tensor(receptive_fields_groups[0])
+    embedding = make_input.build_embedding(graph)
+    return nodes_tensor, edges_tensor, embedding
+
+
+def _featurise_shard(training_graphs, start, end, outputs):
+    """
+    Featurises training_graphs[start:end] in a worker process, writing each graph's tensors
+    straight into its row of the shared output arrays.
+    """
+
+    x_patchy_nodes, x_patchy_edges, x_embedding_input = outputs
+    for idx in range(start, end):
+        x_patchy_nodes[idx], x_patchy_edges[idx], x_embedding_input[idx] = \
+            featurise_graph(training_graphs[idx][1])
+
+
+def format_all_training_data(training_graphs, workers=None):
     """
     Queries the database for data according to several predefined rules, then processes
     them into two ndarrays.
 
-    :param training_graphs:A list of tuples (label, graph). label is an integer,
-    graph is a Graph object.
+    If workers is given, the graphs are sharded across a pool of that many forked worker
+    processes, which write into shared-memory output arrays. Every graph is written to its own
+    row, so the output is the same, and in the same order, as the serial path.
+
+    :param training_graphs:A list (or any iterable, which is consumed once) of tuples
+    (label, graph). label is an integer, graph is a Graph object.
+    :param workers: The number of worker processes, or None to process the graphs serially
     :return: A tuple (x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target).
     The first argument is the input ndarray created by patchy_san for nodes, the second is
     the ndarray created by patchy_san for edges, and the third is the ndarray created by word
@@ -53,25 +154,26 @@ def format_all_training_data(training_graphs):
     """
     import time
     start = time.time()
+
+    print("Processing training graphs into tensors...")
+    if workers is None:
+        x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target = \
+            _format_serial(training_graphs)
+    else:
+        x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target = \
+            _format_parallel(list(training_graphs), workers)
+
+    end = time.time()
+    print("Time elapsed to process training graphs into tensors (seconds): "+str(end-start))
+    return x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target
+
+
+def _format_serial(training_graphs):
     x_data_list = []
     y_target_list = []
 
-    print("Processing training graphs into tensors...")
     for (label, graph) in training_graphs:
-        receptive_fields_groups = make_input.build_groups_of_receptive_fields(graph)
-
-        # For training data there will only be one receptive field group, so assume
-        # that length of receptive_field_groups is 1
-        if len(receptive_fields_groups) != 1:
-            msg = "More or less than one receptive field group exists in the training example."
-            msg += " %s groups exist" % len(receptive_fields_groups)
-            print("Field count " + str(params.FIELD_COUNT))
-            raise ValueError(msg)
-
-        nodes_tensor = make_input.build_tensor_naive_hashing(receptive_fields_groups[0])
-        edges_tensor = make_input.build_edges_tensor(receptive_fields_groups[0])
-        embedding = make_input.build_embedding(graph)
-        x_data_list.append((nodes_tensor, edges_tensor, embedding))
+        x_data_list.append(featurise_graph(graph))
         y_target_list.append(label)
 
     training_examples = len(x_data_list)
@@ -106,11 +208,53 @@ def format_all_training_data(training_graphs):
         x_embedding_input[idx] = x_data_list[idx][2]
         idx += 1
 
-    end = time.time()
-    print("Time elapsed to process training graphs into tensors (seconds): "+str(end-start))
     return x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target
 
 
+def _format_parallel(training_graphs, workers):
+    training_examples = len(training_graphs)
+
+    assert(training_examples > 0)
+
+    # The shapes of the outputs are taken from the first graph, as in the serial path. Its
+    # tensors fill row 0, and the workers featurise the other graphs into the rows after it
+    first = featurise_graph(training_graphs[0][1])
+    outputs = tuple(
+        parallel.shared_array((training_examples,) + tensor.shape) for tensor in first)
+    for output, tensor in zip(outputs, first):
+        output[0] = tensor
+
+    parallel.run_sharded(_featurise_shard, training_graphs[1:], workers,
+                         tuple(output[1:] for output in outputs))
+
+    # Copy out of shared memory so the arrays outlive the pool
+    x_patchy_nodes, x_patchy_edges, x_embedding_input = (np.array(output) for output in outputs)
+    y_target = np.asarray([label for (label, _) in training_graphs], dtype=np.int32)
+    return x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target
+
+
+def balanced_indices(y_target, limit):
+    """
+    Selects the training examples kept by create_balanced_training_set: the first limit
+    examples of each class.
+
+    :param y_target: A 1D NumPy ndarray (training_examples,)
+    :param limit: An integer which represents the max training examples for each class.
+    :return: A list of the indices of the examples kept, in ascending order
+    """
+
+    class_counts = [0 for _ in range(params.CLASS_COUNT)]
+    indices = []
+
+    for i in range(len(y_target)):
+        label = y_target[i]
+        if class_counts[label] < limit:
+            class_counts[label] += 1
+            indices.append(i)
+
+    return indices
+
+
 def create_balanced_training_set(x_patchy_nodes, x_patchy_edges, x_embedding_input, y_target, limit):
     """
     Ensure that training set contains equal numbers of training examples for each class.
@@ -140,22 +284,16 @@ def create_balanced_training_set(x_patchy_nodes, x_patchy_edges, x_embedding_inp
     # )
     # embedding_shape = (limit*params.CLASS_COUNT, params.EMBEDDING_LENGTH*params.MAX_NODES*2)
 
-    class_counts = [0 for _ in range(params.CLASS_COUNT)]
     new_x_patchy_nodes = np.zeros(patchy_nodes_shape)
     new_x_patchy_edges = np.zeros(patchy_edges_shape)
     new_x_embedding_input = np.zeros(embedding_shape)
     new_y = np.ndarray((limit*params.CLASS_COUNT,))
-    idx = 0
 
-    for i in range(len(y_target)):
-        label = y_target[i]
-        if class_counts[label] < limit:
-            class_counts[label] += 1
-            new_x_patchy_nodes[idx] = x_patchy_nodes[i]
-            new_x_patchy_edges[idx] = x_patchy_edges[i]
-            new_x_embedding_input[idx] = x_embedding_input[i]
-            new_y[idx] = y_target[i]
-            idx += 1
+    for idx, i in enumerate(balanced_indices(y_target, limit)):
+        new_x_patchy_nodes[idx] = x_patchy_nodes[i]
+        new_x_patchy_edges[idx] = x_patchy_edges[i]
+        new_x_embedding_input[idx] = x_embedding_input[i]
+        new_y[idx] = y_target[i]
 
     return new_x_patchy_nodes, new_x_patchy_edges, new_x_embedding_input, new_y
 
@@ -176,12 +314,14 @@ def shuffle_datasets(x_patchy_nodes, x_patchy_edges, x_embedding, y_train):
     return x_patchy_nodes[permutation], x_patchy_edges[permutation], x_embedding[permutation], y_train[permutation]
 
 
-def process_training_examples(training_graphs):
+def process_training_examples(training_graphs, workers=None):
     """
     Gets and formats the datasets into a form ready to be fed to the model.
 
     :param training_graphs:A list of tuples (label, graph). label is an integer,
     graph is a Graph object.
+    :param workers: The number of worker processes used to featurise the graphs, or None to
+    featurise them serially
     :return: A tuple of ndarrays (x_patchy_nodes, x_patchy_edges, x_embedding, y_new).
     x_patchy_nodes has dimensions (training_samples, field_count*max_field_size, channel_count)
     x_patchy_edges has dimensions (training_samples, field_count*max_field_size*max_field_size, EDGE_PROP_COUNT)
@@ -189,7 +329,7 @@ def process_training_examples(training_graphs):
     y_new has dimensions (training_samples, number_of_classes)
     """
 
-    x_patchy_nodes, x_patchy_edges, x_embedding, y = format_all_training_data(training_graphs)
+    x_patchy_nodes, x_patchy_edges, x_embedding, y = format_all_training_data(training_graphs, workers)
     _, counts = np.unique(y, return_counts=True)
 
     if len(counts) == 1:
@@ -206,12 +346,16 @@ def process_training_examples(training_graphs):
     return shuffle_datasets(x_patchy_nodes, x_patchy_edges, x_embedding, y_new)
 
 
-def get_final_datasets(results):
+def get_final_datasets(results, workers=None, hydrator=None):
     """
     Given a list of BoltStatementResults, each corresponding to training data for one
     training pattern, generates training data and formats it properly.
 
     :param results: A list of BoltStatementResults
+    :param workers: The number of worker processes used to clean and featurise the graphs, or
+    None to process them serially
+    :param hydrator: A PropertyHydrator, if the results only hold the structure of the
+    matches (params.LAZY_PROPERTIES), see label_and_hydrate_data
     :return: A tuple of ndarrays (x_patchy_nodes, x_patchy_edges, x_embedding, y_new).
     x_patchy_nodes has dimensions (training_samples, field_count*max_field_size, channel_count)
     x_patchy_edges has dimensions (training_samples, field_count*max_field_size*max_field_size, EDGE_PROP_COUNT)
@@ -219,5 +363,8 @@ def get_final_datasets(results):
     y_new has dimensions (training_samples, number_of_classes)
     """
 
-    training_graphs = label_and_process_data(results)
-    return process_training_examples(training_graphs)
+    if hydrator is None:
+        training_graphs = iter_label_and_process_data(results, workers=workers)
+    else:
+        training_graphs = label_and_hydrate_data(results, hydrator)
+    return process_training_examples(training_graphs, workers)
@@ -4,18 +4,32 @@ have nodes ordered similarly (relative ordering of nodes) after being normalised
 """
 
 from patchy_san.parameters import HASH_PROPERTIES, NODE_TYPE_HASH, PROPERTY_CARDINALITY, RECEPTIVE_FIELD_HASH
+from data_processing.graphs import CompactGraph
+from data_processing.property_store import build_property_store
 
 
-def normalise_receptive_field(graph):
+def normalise_receptive_field(graph, hashes=None):
     """
     Builds a list of nodes and orders them in ascending order using the hash function
     provided.
 
-    :param graph: A Graph object
-    :return: A list of nodes ordered using the hash fn.
+    :param graph: A Graph object, or a ReceptiveField
+    :param hashes: An optional Dictionary of node_id -> hash value, as returned by
+    compute_hashes(), to use instead of hashing each node again
+    :return: A list of nodes ordered using the hash fn. For a ReceptiveField, a ReceptiveField
+    with its nodes in that order
     """
 
+    if hasattr(graph, 'reorder'):
+        if hashes is None:
+            keys = [compute_hash(node) for node in graph]
+        else:
+            keys = [hashes[node_id] for node_id in graph.node_ids().tolist()]
+        return graph.reorder(sorted(range(len(keys)), key=lambda position: keys[position]))
+
     node_list = list(graph.nodes.values())
+    if hashes is not None:
+        return sorted(node_list, key=lambda node: hashes[node.id])
     return sorted(node_list, key=lambda node: compute_hash(node))
 
 
@@ -38,10 +52,58 @@ def compute_hash(node):
         if properties.__contains__(prop) and properties[prop] != []:
             if prop == 'name':
                 # A node may have multiple names, use only the first
-                prop_hash = RECEPTIVE_FIELD_HASH(properties[prop][0])
+                hash_value += property_digits(prop, properties[prop][0])
             else:
-                prop_hash = RECEPTIVE_FIELD_HASH(properties[prop])
-            # Take the 4 most significant digits
-            hash_value += int(str(abs(prop_hash))[:PROPERTY_CARDINALITY[prop]])
+                hash_value += property_digits(prop, properties[prop])
 
     return hash_value
+
+
+def property_digits(prop, value):
+    """
+    Computes the contribution of one property value to the hash value of a node.
+
+    :param prop: The property name
+    :param value: The property value
+    :return: An integer
+    """
+
+    prop_hash = RECEPTIVE_FIELD_HASH(value)
+    # Take the 4 most significant digits
+    return int(str(abs(prop_hash))[:PROPERTY_CARDINALITY[prop]])
+
+
+def compute_hashes(graph):
+    """
+    Computes the same value as compute_hash for every node in a graph. The property values are
+    read from a columnar PropertyStore, so each distinct value (e.g. a cmdline shared by many
+    processes) is hashed once instead of once per node.
+
+    :param graph: A Graph or CompactGraph object
+    :return: A Dictionary of node_id -> hash value
+    """
+
+    nodes = list(graph.nodes.values())
+    if isinstance(graph, CompactGraph):
+        store = graph.get_property_store()
+    else:
+        store = build_property_store(nodes, HASH_PROPERTIES)
+
+    digits = {}
+    for prop in HASH_PROPERTIES:
+        digits[prop] = store.map_unique(prop, lambda value, prop=prop: property_digits(prop, value))
+
+    hashes = {}
+    for idx, node in enumerate(nodes):
+        hash_value = 0
+        for label in node.labels:
+            hash_value += NODE_TYPE_HASH[label]
+
+        for prop in HASH_PROPERTIES:
+            hash_value *= PROPERTY_CARDINALITY[prop]
+            if digits[prop][idx] is not None:
+                hash_value += digits[prop][idx]
+
+        hashes[node.id] = hash_value
+
+    return hashes
@@ -6,8 +6,12 @@ import numpy as np
 from patchy_san.parameters import MAX_FIELD_SIZE, STRIDE, FIELD_COUNT, CHANNEL_COUNT, HASH_PROPERTIES
 from patchy_san.parameters import HASH_FN, DEFAULT_TENSOR_VAL, MAX_NODES, NODE_TYPE_HASH, VOCAB_SIZE, NO_PROP
 from patchy_san.parameters import EMBEDDING_LENGTH, EDGE_PROPERTIES, EDGE_PROP_COUNT
-from patchy_san.neighborhood_assembly import label_and_order_nodes, get_receptive_field
-from patchy_san.graph_normalisation import normalise_receptive_field
+from patchy_san.parameters import LABELING_FN
+from patchy_san.neighborhood_assembly import label_and_order_nodes, get_receptive_field_matrix, \
+    receptive_fields_from_matrix, select_roots
+from optimisable_functions.labeling_fns import get_ts
+from data_processing.graphs import to_compact_graph
+from patchy_san.graph_normalisation import normalise_receptive_field, compute_hashes
 from optimisable_functions.hashes import hash_labels_only
 from keras.preprocessing.text import hashing_trick
 from keras.preprocessing.sequence import pad_sequences
@@ -60,16 +64,21 @@ def build_groups_of_receptive_fields(graph):
     Extracts as many groups of receptive fields as possible. Each group of fields is considered
     complete once it reaches the maximum field size.
 
-    First the nodes are ordered by a given labeling function. Starting with the first node
-    in this list, receptive fields are built using nodes in the ordered list as root nodes,
-    with distance stride between root nodes in the ordered list (e.g if stride is 1 then
+    First the nodes are ordered by a given labeling function (for get_ts, select_roots orders
+    them by timestamp then id, without a full sort). Starting with the first node in this list,
+    receptive fields are built using nodes in the ordered list as root nodes, with distance
+    stride between root nodes in the ordered list (e.g if stride is 1 then
     all nodes in the ordered list will be root nodes). The receptive fields are built in the form
     of lists, which are built (and ordered) using a given function.
 
     Each list of receptive fields makes a group. This function returns all groups that could be
     constructed.
 
-    :param graph: A Graph object
+    The receptive fields are ReceptiveField and FieldEdges views into a CompactGraph of the
+    graph, built once, rather than a Graph per field. The fields of all the roots are
+    extracted together by get_receptive_field_matrix.
+
+    :param graph: A Graph or CompactGraph object
     :return: A list of lists of tuples of (list of nodes, list of edges), or a list of lists of tuples of
     receptive fields for nodes and edges.
     Each tuple of lists corresponds to a receptive field, and contains all the nodes and edges in it.
@@ -77,26 +86,32 @@ def build_groups_of_receptive_fields(graph):
     The list of lists of tuples of lists corresponds to all the groups of receptive fields found.
     """
 
-    nodes_list = label_and_order_nodes(graph)
+    # Only whole groups are kept, so only the roots of whole groups are selected
+    root_count = -(-len(graph.nodes) // STRIDE) // FIELD_COUNT * FIELD_COUNT
+    if LABELING_FN is get_ts:
+        root_nodes = select_roots(graph, root_count)
+    else:
+        root_nodes = label_and_order_nodes(graph)[::STRIDE][:root_count]
+
+    if not hasattr(graph, 'in_indptr'):
+        graph = to_compact_graph(graph)
+
+    # Hash every node of the graph once, rather than once per receptive field it appears in
+    node_hashes = compute_hashes(graph)
     groups_of_receptive_fields = []
-    receptive_field = []
-    nodes_iter = iter(nodes_list)
-    root_node = next(nodes_iter, None)
-    receptive_field_count = 0
 
-    while root_node is not None:
-        receptive_field_graph = get_receptive_field(root_node.id, graph)
-        r_field_nodes_list = normalise_receptive_field(receptive_field_graph)
-        edges_list = get_related_edges(r_field_nodes_list, graph)
+    node_matrix, edge_matrix = get_receptive_field_matrix(
+        graph.indices_of(np.asarray([node.id for node in root_nodes], dtype=np.int64)), graph)
 
+    receptive_field = []
+    for receptive_field_view in receptive_fields_from_matrix(graph, node_matrix, edge_matrix):
+        r_field_nodes_list = normalise_receptive_field(receptive_field_view, node_hashes)
+        edges_list = get_related_edges(r_field_nodes_list, graph)
         receptive_field.append((r_field_nodes_list, edges_list))
-        root_node = iterate(nodes_iter, STRIDE)
-        receptive_field_count += 1
 
-        if receptive_field_count == FIELD_COUNT:
+        if len(receptive_field) == FIELD_COUNT:
             groups_of_receptive_fields.append(receptive_field)
             receptive_field = []
-            receptive_field_count = 0
     # only whole groups? or partial groups also
     # if norm_fields_list:
     #     groups_of_receptive_fields.append(norm_fields_list)
@@ -109,11 +124,14 @@ def get_related_edges(nodes_list, graph):
     Returns all edges between nodes in a given list. All the nodes and edges are part of a graph
     which is given as a Graph object.
 
-    :param nodes_list: A list of nodes
+    :param nodes_list: A list of nodes, or a ReceptiveField of graph
     :param graph: A Graph object
-    :return: A list of edges
+    :return: A list of edges, or a FieldEdges object for a ReceptiveField
     """
 
+    if hasattr(nodes_list, 'related_edges'):
+        return nodes_list.related_edges()
+
     node_id_list = map(lambda x: x.id, nodes_list)
     node_id_set = set(node_id_list)
     edges = []
@@ -248,6 +266,52 @@ def build_embedding(graph):
     return np.asarray(combined_embedding, dtype=np.int16)
 
 
+def fill_field_edges(field_tensor, field, field_edges):
+    """
+    Index version of the loop of build_edges_tensor for a ReceptiveField and its FieldEdges:
+    the positions, type hashes and state hashes of all the edges are looked up as arrays.
+
+    :param field_tensor: A NumPy ndarray with dimensions (MAX_NODES, MAX_NODES, EDGE_PROP_COUNT)
+    :param field: A ReceptiveField object
+    :param field_edges: A FieldEdges object of the same graph
+    :return: nothing
+    """
+
+    graph = field.graph
+    edge_indices = field_edges.indices
+    if len(edge_indices) == 0:
+        return
+
+    position = np.full(graph.node_count(), -1, dtype=np.int64)
+    position[field.indices] = np.arange(len(field.indices))
+    start_pos = position[graph.edge_start[edge_indices]]
+    end_pos = position[graph.edge_end[edge_indices]]
+
+    # Only the codes used by the field's edges are hashed, so as in build_edges_tensor an
+    # unknown name only raises if one of these edges has it
+    codes, inverse = np.unique(graph.edge_type[edge_indices], return_inverse=True)
+    type_hashes = np.asarray([EDGE_TYPE_HASH[graph.type_names[code]] for code in codes.tolist()],
+                             dtype=np.int64)
+    field_tensor[start_pos, end_pos, 0] = type_hashes[inverse]
+
+    edge_prop_idx = 1
+    for prop in EDGE_PROPERTIES:
+        if prop == 'state':
+            codes, inverse = np.unique(graph.edge_state[edge_indices], return_inverse=True)
+            # MISSING_CODE (-1) hashes to 0, as for edges without a state
+            state_hashes = np.asarray([EDGE_STATE_HASH[graph.state_names[code]] if code >= 0 else 0
+                                       for code in codes.tolist()], dtype=np.int64)
+            values = state_hashes[inverse]
+        else:
+            values = []
+            for idx in edge_indices.tolist():
+                properties = graph.edge(idx).properties
+                values.append(EDGE_STATE_HASH[properties[prop]] if prop in properties else 0)
+            values = np.asarray(values, dtype=np.int64)
+        field_tensor[start_pos, end_pos, edge_prop_idx] = values
+        edge_prop_idx += 1
+
+
 def build_edges_tensor(norm_fields_list):
     """
     Given a list of tuples of (list of nodes, list of edges), builds the input tensor for the
@@ -277,6 +341,10 @@ def build_edges_tensor(norm_fields_list):
         # The normalised list of edges is the second item in the tuple
         recept_field_edges = norm_fields_list[fields_idx][1]
 
+        if hasattr(recept_field_nodes, 'indices') and hasattr(recept_field_edges, 'indices'):
+            fill_field_edges(tensor[fields_idx], recept_field_nodes, recept_field_edges)
+            continue
+
         node_id_to_position = {}
 
         # Record the position of each node in the adjacency matrix
@@ -2,8 +2,13 @@
 This module contains functions to process graph data into a form usable by the Patchy-San
 algorithm.
 """
-import queue
-from patchy_san.parameters import MAX_FIELD_SIZE as SIZE
+from bisect import bisect_left, bisect_right
+from collections import deque
+from collections.abc import Sequence
+import numpy as np
+from patchy_san.parameters import MAX_FIELD_SIZE as SIZE, STRIDE, ROOT_BATCH_SIZE
+from patchy_san.parameters import MAX_FANOUT, FANOUT_SEED, CAUSAL_WINDOW
+from optimisable_functions.labeling_fns import get_ts
 from data_processing.graphs import Graph
 from data_processing.preprocessing import build_in_out_edges
 
@@ -27,7 +32,245 @@ def label_and_order_nodes(graph, transform_fn=None):
     return nodes_list
 
 
-def get_receptive_field(root_id, graph):
+def node_timestamps(graph):
+    """
+    Reads the id and timestamp (see get_ts) of every node. For a CompactGraph they are read
+    from the arrays, without building the nodes.
+
+    :param graph: A Graph or CompactGraph object
+    :return: A tuple (node_at, ids, timestamps): a function returning the node at a position,
+    and 1D ndarrays of the ids and timestamps of the nodes, in the same order
+    """
+
+    if hasattr(graph, 'node_values'):
+        timestamps = graph.node_values('timestamp')
+        if None in timestamps:
+            raise RuntimeError('timestamp does not exist in properties dict of node')
+        return graph.node, graph.node_ids, np.asarray(timestamps)
+
+    nodes = list(graph.nodes.values())
+    ids = np.asarray([node.id for node in nodes], dtype=np.int64)
+    timestamps = np.asarray([get_ts(node) for node in nodes])
+    return nodes.__getitem__, ids, timestamps
+
+
+def first_by_timestamp(timestamps, ids, candidates, count):
+    """
+    Finds the first candidates in order of timestamp, then id, without sorting all of them:
+    argpartition finds the count-th smallest timestamp, and only the candidates up to it are
+    sorted.
+
+    :param timestamps: A 1D ndarray of timestamps
+    :param ids: A 1D ndarray of ids, in the same order
+    :param candidates: A 1D ndarray of positions in timestamps
+    :param count: The number of positions to return
+    :return: A 1D ndarray of at most count positions, in order
+    """
+
+    if count < len(candidates):
+        candidate_timestamps = timestamps[candidates]
+        kth = candidate_timestamps[np.argpartition(candidate_timestamps, count-1)[count-1]]
+        candidates = candidates[candidate_timestamps <= kth]
+
+    order = np.lexsort((ids[candidates], timestamps[candidates]))
+    return candidates[order[:count]]
+
+
+def select_roots(graph, count=None, stride=STRIDE):
+    """
+    Selects the root nodes of the receptive fields: every stride-th node in order of timestamp,
+    as label_and_order_nodes with get_ts and iterate, but with ties broken by id and without
+    sorting the nodes after the last root.
+
+    :param graph: A Graph or CompactGraph object
+    :param count: The maximum number of roots, or None for all of them
+    :param stride: The distance between roots in the order
+    :return: A list of nodes, in order
+    """
+
+    node_at, ids, timestamps = node_timestamps(graph)
+    total = -(-len(ids) // stride)
+    count = total if count is None else min(count, total)
+    if count == 0:
+        return []
+
+    positions = first_by_timestamp(timestamps, ids, np.arange(len(ids)), (count-1)*stride + 1)
+    return [node_at(pos) for pos in positions[::stride].tolist()]
+
+
+def iter_roots(graph, stride=STRIDE, batch_size=ROOT_BATCH_SIZE):
+    """
+    Generator version of select_roots, for scoring a large graph root by root. Each pass
+    selects the next batch_size roots from the nodes after the last one selected, so the
+    nodes are never sorted all at once.
+
+    :param graph: A Graph or CompactGraph object
+    :param stride: The distance between roots in the order
+    :param batch_size: The number of roots selected per pass
+    :return: A generator of nodes, in order
+    """
+
+    node_at, ids, timestamps = node_timestamps(graph)
+    remaining = np.arange(len(ids))
+
+    while len(remaining) > 0:
+        chosen = first_by_timestamp(timestamps, ids, remaining, batch_size * stride)
+        for pos in chosen[::stride].tolist():
+            yield node_at(pos)
+
+        last = chosen[-1]
+        later = (timestamps[remaining] > timestamps[last]) | \
+                ((timestamps[remaining] == timestamps[last]) & (ids[remaining] > ids[last]))
+        remaining = remaining[later]
+
+
+def new_fanout_stats():
+    """
+    Creates the counts of how often the fan-out cap was applied, which the receptive field
+    searches add to when given them: 'capped' is the number of nodes whose incoming edges were
+    sampled, 'skipped' the number of incoming edges not followed because of it. The counts are
+    kept by the caller (e.g. returned with the results of a worker process), not globally.
+
+    :return: A Dictionary of count name -> 0
+    """
+
+    return {'capped': 0, 'skipped': 0}
+
+
+def edge_priorities(edge_ids, seed):
+    """
+    Computes a pseudo-random priority for every edge from its id and a seed (with the splitmix64
+    mixing function), so the edges sampled from a node do not depend on the order they are
+    visited in.
+
+    :param edge_ids: A 1D ndarray (or list) of edge ids
+    :param seed: An integer
+    :return: A 1D uint64 ndarray
+    """
+
+    z = np.asarray(edge_ids, dtype=np.int64).astype(np.uint64)
+    z = z + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) % (1 << 64))
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def sample_fanout(edge_ids, max_fanout, seed, stats=None):
+    """
+    Selects the incoming edges of a node to follow: all of them up to max_fanout, otherwise
+    the max_fanout edges with the lowest priorities (see edge_priorities).
+
+    :param edge_ids: A list of the ids of the incoming edges, in edge id order
+    :param max_fanout: The maximum number of edges, or None for no limit
+    :param seed: An integer
+    :param stats: An optional Dictionary from new_fanout_stats() to count the sampling in
+    :return: A list of the positions in edge_ids to follow, in ascending order, or None to
+    follow every edge
+    """
+
+    if max_fanout is None or len(edge_ids) <= max_fanout:
+        return None
+
+    if stats is not None:
+        stats['capped'] += 1
+        stats['skipped'] += len(edge_ids) - max_fanout
+    order = np.argsort(edge_priorities(edge_ids, seed), kind='stable')
+    return np.sort(order[:max_fanout]).tolist()
+
+
+def edge_timestamp(edge):
+    return getattr(edge, 'properties', {}).get('timestamp')
+
+
+class TimestampIndex:
+    """
+    The incoming edges of every node of a graph, sorted by timestamp, so the edges of a node
+    within a time window are found with a binary search. Edges without a timestamp are never
+    in a window.
+
+    For a CompactGraph, the index is a permutation of the incoming CSR positions of each row,
+    with the matching timestamps. For a Graph, it is a Dictionary of node_id -> (timestamps,
+    edges).
+    """
+
+    def __init__(self, graph):
+        """
+        Initialises the TimestampIndex object.
+
+        :param graph: A Graph or CompactGraph object
+        """
+
+        if hasattr(graph, 'in_indptr'):
+            values = graph.edge_values('timestamp')
+            missing = np.asarray([value is None for value in values], dtype=bool)
+            timestamps = np.asarray([0 if value is None else value for value in values])
+            row_timestamps = timestamps[graph.in_edges]
+            row_missing = missing[graph.in_edges]
+            rows = np.repeat(np.arange(graph.node_count()), np.diff(graph.in_indptr))
+
+            # Within a row, edges without a timestamp come last and are outside every window
+            self.indptr = graph.in_indptr
+            self.order = np.lexsort((row_timestamps, row_missing, rows))
+            self.timestamps = row_timestamps[self.order]
+            self.ends = graph.in_indptr[:-1] + np.bincount(rows[~row_missing],
+                                                           minlength=graph.node_count())
+            self.edges = None
+        else:
+            self.edges = {}
+            for node_id, node_edges in graph.incoming_edges.items():
+                stamped = sorted((edge_timestamp(edge), edge.id, edge) for edge in node_edges
+                                 if edge_timestamp(edge) is not None)
+                self.edges[node_id] = ([item[0] for item in stamped],
+                                       [item[2] for item in stamped])
+
+    def edges_in_window(self, node_id, lower, upper):
+        """
+        :param node_id: The id of a node of the Graph
+        :param lower: The earliest timestamp in the window
+        :param upper: The latest timestamp in the window
+        :return: A list of the incoming edges of the node in the window, in edge id order
+        """
+
+        timestamps, node_edges = self.edges.get(node_id, ([], []))
+        window = node_edges[bisect_left(timestamps, lower):bisect_right(timestamps, upper)]
+        return sorted(window, key=lambda edge: edge.id)
+
+    def ranges(self, indices, lowers, uppers):
+        """
+        Finds the window of each node in the sorted order, see positions.
+
+        :param indices: A 1D ndarray of node indices of the CompactGraph
+        :param lowers: A 1D ndarray of the earliest timestamp of the window of each node
+        :param uppers: A 1D ndarray of the latest timestamp of the window of each node
+        :return: A tuple (starts, lengths) of 1D int64 ndarrays, indexing self.order
+        """
+
+        starts = np.empty(len(indices), dtype=np.int64)
+        ends = np.empty(len(indices), dtype=np.int64)
+        for pos, (index, lower, upper) in enumerate(zip(indices.tolist(), lowers.tolist(),
+                                                         uppers.tolist())):
+            start, end = self.indptr[index], self.ends[index]
+            row = self.timestamps[start:end]
+            starts[pos] = start + row.searchsorted(lower, 'left')
+            ends[pos] = start + row.searchsorted(upper, 'right')
+        return starts, ends - starts
+
+    def positions(self, index, lower, upper):
+        """
+        :param index: A node index of the CompactGraph
+        :param lower: The earliest timestamp in the window
+        :param upper: The latest timestamp in the window
+        :return: A 1D ndarray of the incoming CSR positions of the node's edges in the window,
+        in ascending (edge id) order
+        """
+
+        starts, lengths = self.ranges(np.asarray([index]), np.asarray([lower]),
+                                      np.asarray([upper]))
+        return np.sort(self.order[starts[0]:starts[0]+lengths[0]])
+
+
+def get_receptive_field(root_id, graph, max_fanout=MAX_FANOUT, seed=FANOUT_SEED,
+                        window=CAUSAL_WINDOW, ts_index=None, stats=None):
     """
     Given a root node, performs breadth-first search, adding explored nodes to a Set.
     If number of reachable nodes is less than size, no padding is done.
@@ -40,8 +283,20 @@ def get_receptive_field(root_id, graph):
 
     TODO: Find way to implement ordering such that nodes will not be selected arbitrarily.
 
+    No more nodes are queued once the field is full, and at most max_fanout incoming edges of
+    a node are followed (see sample_fanout), so the work per field does not grow with the
+    degree of the nodes in it.
+
+    In causal mode (window not None), only edges whose timestamp is at most window before the
+    root's timestamp, and not after it, are followed.
+
     :param root_id: The id of the start node
     :param graph: A Graph object
+    :param max_fanout: The maximum number of incoming edges followed per node, or None
+    :param seed: The seed of the edge sampling
+    :param window: The length of the causal time window, or None to follow every edge
+    :param ts_index: A TimestampIndex of the graph, built if needed in causal mode
+    :param stats: An optional Dictionary from new_fanout_stats() to count the sampling in
     :return: A tuple of (node_id -> node, edge_id -> edge) which represents the
     receptive field (which is a subgraph)
     """
@@ -53,18 +308,24 @@ def get_receptive_field(root_id, graph):
     nodes = graph.nodes
     incoming_edges = graph.incoming_edges
 
+    if window is not None:
+        if ts_index is None:
+            ts_index = TimestampIndex(graph)
+        upper = get_ts(nodes[root_id])
+        lower = upper - window
+
     # A queue that contains a tuple of (node, edge) where edge is the edge to the previous
     # explored node
-    node_edge_q = queue.Queue()
-    node_edge_q.put((nodes[root_id], None))
+    node_edge_q = deque()
+    node_edge_q.append((nodes[root_id], None))
     marked_set.add(nodes[root_id])
 
     while neighborhood_size < SIZE:
-        if node_edge_q.empty():
+        if not node_edge_q:
             # No padding if size of graph smaller than desired receptive field
             break
         else:
-            item = node_edge_q.get(block=False)
+            item = node_edge_q.popleft()
             node = item[0]
             edge = item[1]
             nodes_dict[node.id] = node
@@ -74,12 +335,289 @@ def get_receptive_field(root_id, graph):
 
             neighborhood_size += 1
 
-            if node.id in incoming_edges.keys():
-                for edge in incoming_edges[node.id]:
+            if node.id in incoming_edges.keys() and len(marked_set) < SIZE:
+                if window is None:
+                    node_edges = incoming_edges[node.id]
+                else:
+                    node_edges = ts_index.edges_in_window(node.id, lower, upper)
+                kept = sample_fanout([edge.id for edge in node_edges], max_fanout, seed, stats)
+                if kept is not None:
+                    node_edges = [node_edges[pos] for pos in kept]
+
+                for edge in node_edges:
                     neighbor_node = nodes[edge.start]
                     if neighbor_node not in marked_set:
-                        node_edge_q.put((neighbor_node, edge))
+                        node_edge_q.append((neighbor_node, edge))
                         marked_set.add(neighbor_node)
+                        if len(marked_set) == SIZE:
+                            break
 
     new_incoming_edges, new_outgoing_edges = build_in_out_edges(edges_dict)
     return Graph(nodes_dict, edges_dict, new_incoming_edges, new_outgoing_edges)
+
+
+class ReceptiveField(Sequence):
+    """
+    A receptive field as a view into a CompactGraph: the indices of its nodes, in order, and
+    the indices of the edges by which the breadth-first search reached them. No nodes, edges or
+    Graph are built for the field; indexing the field returns the node at that position.
+    """
+
+    def __init__(self, graph, indices, edge_indices):
+        """
+        Initialises the ReceptiveField object.
+
+        :param graph: The CompactGraph the field is part of
+        :param indices: A 1D ndarray of node indices, in field order
+        :param edge_indices: A 1D ndarray of edge indices
+        """
+
+        self.graph = graph
+        self.indices = indices
+        self.edge_indices = edge_indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        return self.graph.node(self.indices[position])
+
+    def node_ids(self):
+        return self.graph.node_ids[self.indices]
+
+    def reorder(self, order):
+        """
+        :param order: A list of positions
+        :return: A ReceptiveField with the nodes at those positions, in that order
+        """
+
+        return ReceptiveField(self.graph, self.indices[np.asarray(order, dtype=np.int64)],
+                              self.edge_indices)
+
+    def related_edges(self):
+        """
+        Finds every edge between nodes of the field, reading the incoming CSR rows of its
+        nodes. Edges are ordered as by make_cnn_input.get_related_edges: by the position of
+        their end node in the field, then by edge id.
+
+        :return: A FieldEdges object
+        """
+
+        graph = self.graph
+        members = set(self.indices.tolist())
+        edge_indices = []
+
+        for index in self.indices.tolist():
+            start, end = graph.in_indptr[index], graph.in_indptr[index+1]
+            for pos in range(start, end):
+                if int(graph.in_indices[pos]) in members:
+                    edge_indices.append(int(graph.in_edges[pos]))
+
+        return FieldEdges(graph, np.asarray(edge_indices, dtype=np.int64))
+
+
+class FieldEdges(Sequence):
+    """
+    The edges of a receptive field as a view into a CompactGraph. Indexing returns the edge at
+    that position.
+    """
+
+    def __init__(self, graph, indices):
+        self.graph = graph
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        return self.graph.edge(self.indices[position])
+
+
+def get_receptive_field_indices(root_index, graph, max_fanout=MAX_FANOUT, seed=FANOUT_SEED,
+                                window=CAUSAL_WINDOW, ts_index=None, stats=None):
+    """
+    Index version of get_receptive_field for a CompactGraph. The breadth-first search reads the
+    incoming CSR rows directly and visits nodes in the same order.
+
+    :param root_index: The node index of the root node
+    :param graph: A CompactGraph object
+    :param max_fanout: The maximum number of incoming edges followed per node, or None
+    :param seed: The seed of the edge sampling
+    :param window: The length of the causal time window, or None, see get_receptive_field
+    :param ts_index: A TimestampIndex of the graph, built if needed in causal mode
+    :param stats: An optional Dictionary from new_fanout_stats() to count the sampling in
+    :return: A ReceptiveField object
+    """
+
+    indptr = graph.in_indptr
+    neighbours = graph.in_indices
+    in_edges = graph.in_edges
+
+    indices = []
+    edge_indices = []
+    marked = {root_index}
+    queue = deque([(root_index, -1)])
+
+    if window is not None:
+        if ts_index is None:
+            ts_index = TimestampIndex(graph)
+        upper = get_ts(graph.node(root_index))
+        lower = upper - window
+
+    while queue and len(indices) < SIZE:
+        index, edge_index = queue.popleft()
+        indices.append(index)
+        if edge_index >= 0:
+            edge_indices.append(edge_index)
+
+        if len(marked) >= SIZE:
+            continue
+
+        if window is None:
+            row = np.arange(indptr[index], indptr[index+1])
+        else:
+            row = ts_index.positions(index, lower, upper)
+        kept = sample_fanout(graph.edge_ids[in_edges[row]], max_fanout, seed, stats)
+        if kept is not None:
+            row = row[kept]
+
+        for pos in row.tolist():
+            neighbour = int(neighbours[pos])
+            if neighbour not in marked:
+                marked.add(neighbour)
+                queue.append((neighbour, int(in_edges[pos])))
+                if len(marked) == SIZE:
+                    break
+
+    return ReceptiveField(graph, np.asarray(indices, dtype=np.int64),
+                          np.asarray(edge_indices, dtype=np.int64))
+
+
+def get_receptive_field_matrix(root_indices, graph, max_fanout=MAX_FANOUT, seed=FANOUT_SEED,
+                               window=CAUSAL_WINDOW, ts_index=None, stats=None):
+    """
+    Batched get_receptive_field_indices: extracts the receptive fields of many roots at once.
+    The searches advance one level at a time for all the roots together, each level being
+    gathered from the incoming CSR rows with array operations. Within a root, the new nodes of
+    a level are ordered as a FIFO queue would visit them (by the position of the node they were
+    reached from, then by edge id), so each row is the same as get_receptive_field_indices.
+
+    :param root_indices: A 1D ndarray (or list) of the node indices of the roots
+    :param graph: A CompactGraph object
+    :param max_fanout: The maximum number of incoming edges followed per node, or None
+    :param seed: The seed of the edge sampling
+    :param window: The length of the causal time window, or None, see get_receptive_field
+    :param ts_index: A TimestampIndex of the graph, built if needed in causal mode
+    :param stats: An optional Dictionary from new_fanout_stats() to count the sampling in
+    :return: A tuple of two (len(root_indices), MAX_FIELD_SIZE) int64 ndarrays, padded with -1:
+    the node indices of each field, in field order, and the index of the edge each node was
+    reached by (-1 for the root)
+    """
+
+    root_indices = np.asarray(root_indices, dtype=np.int64)
+    root_count = len(root_indices)
+    node_count = graph.node_count()
+
+    node_matrix = np.full((root_count, SIZE), -1, dtype=np.int64)
+    edge_matrix = np.full((root_count, SIZE), -1, dtype=np.int64)
+    if root_count == 0 or SIZE == 0:
+        return node_matrix, edge_matrix
+
+    indptr = graph.in_indptr.astype(np.int64)
+    if window is not None:
+        if ts_index is None:
+            ts_index = TimestampIndex(graph)
+        # Only the roots need a timestamp, as in get_receptive_field_indices
+        uppers = np.asarray([get_ts(graph.node(index)) for index in root_indices.tolist()])
+        lowers = uppers - window
+    counts = np.ones(root_count, dtype=np.int64)
+    node_matrix[:, 0] = root_indices
+
+    # Nodes marked by each root, as the keys root * node_count + node index
+    rows = np.arange(root_count, dtype=np.int64)
+    marked = np.sort(rows * node_count + root_indices)
+    frontier_rows, frontier_nodes = rows, root_indices
+
+    while len(frontier_rows) > 0:
+        # Gather the incoming CSR rows of every frontier node, in frontier order
+        if window is None:
+            starts = indptr[frontier_nodes]
+            lengths = indptr[frontier_nodes + 1] - starts
+        else:
+            starts, lengths = ts_index.ranges(frontier_nodes, lowers[frontier_rows],
+                                              uppers[frontier_rows])
+        total = int(lengths.sum())
+        if total == 0:
+            break
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(starts, lengths) + np.arange(total) - offsets
+        if window is not None:
+            # Back to CSR positions, in edge id order within each frontier node
+            positions = ts_index.order[positions]
+            segments = np.repeat(np.arange(len(lengths)), lengths)
+            positions = positions[np.lexsort((positions, segments))]
+        cand_rows = np.repeat(frontier_rows, lengths)
+        cand_nodes = graph.in_indices[positions].astype(np.int64)
+        cand_edges = graph.in_edges[positions].astype(np.int64)
+        segments = np.repeat(np.arange(len(lengths)), lengths)
+
+        capped = None
+        if max_fanout is not None and np.any(lengths > max_fanout):
+            # Keep the max_fanout edges of lowest priority of each node, as sample_fanout does
+            capped = lengths > max_fanout
+            priorities = edge_priorities(graph.edge_ids[cand_edges], seed)
+            order = np.lexsort((priorities, segments))
+            ranks = np.empty(total, dtype=np.int64)
+            ranks[order] = np.arange(total) - (np.cumsum(lengths) - lengths)[segments[order]]
+            sampled = ranks < max_fanout
+
+            cand_rows, cand_nodes = cand_rows[sampled], cand_nodes[sampled]
+            cand_edges, segments = cand_edges[sampled], segments[sampled]
+
+        # Drop marked nodes, then repeats within the level, keeping the first
+        keys = cand_rows * node_count + cand_nodes
+        fresh = ~np.isin(keys, marked)
+        _, first = np.unique(keys[fresh], return_index=True)
+        keep = np.flatnonzero(fresh)[np.sort(first)]
+        cand_rows, cand_nodes, cand_edges = cand_rows[keep], cand_nodes[keep], cand_edges[keep]
+
+        if stats is not None and capped is not None:
+            # Count only the nodes a FIFO search expands: those reached while their field still
+            # has room, including the nodes found from the frontier nodes before them
+            found = np.cumsum(np.bincount(segments[keep], minlength=len(lengths)))
+            found_before = np.concatenate(([0], found[:-1]))
+            row_start = np.searchsorted(frontier_rows, frontier_rows, side='left')
+            expanded = counts[frontier_rows] + found_before - found_before[row_start] < SIZE
+            stats['capped'] += int(np.count_nonzero(capped & expanded))
+            stats['skipped'] += int((lengths - max_fanout)[capped & expanded].sum())
+
+        # Rank the new nodes within each root and keep those within the field budget
+        group_start = np.searchsorted(cand_rows, cand_rows, side='left')
+        columns = counts[cand_rows] + np.arange(len(cand_rows)) - group_start
+        within = columns < SIZE
+        cand_rows, cand_nodes = cand_rows[within], cand_nodes[within]
+        cand_edges, columns = cand_edges[within], columns[within]
+
+        node_matrix[cand_rows, columns] = cand_nodes
+        edge_matrix[cand_rows, columns] = cand_edges
+        counts += np.bincount(cand_rows, minlength=root_count)
+        marked = np.union1d(marked, cand_rows * node_count + cand_nodes)
+
+        open_rows = counts[cand_rows] < SIZE
+        frontier_rows, frontier_nodes = cand_rows[open_rows], cand_nodes[open_rows]
+
+    return node_matrix, edge_matrix
+
+
+def receptive_fields_from_matrix(graph, node_matrix, edge_matrix):
+    """
+    :param graph: A CompactGraph object
+    :param node_matrix: A node index matrix returned by get_receptive_field_matrix
+    :param edge_matrix: The matching edge index matrix
+    :return: A list of ReceptiveField objects, one per row
+    """
+
+    fields = []
+    for node_row, edge_row in zip(node_matrix, edge_matrix):
+        fields.append(ReceptiveField(graph, node_row[node_row >= 0], edge_row[edge_row >= 0]))
+    return fields
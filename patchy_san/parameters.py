@@ -13,6 +13,22 @@ MAX_FIELD_SIZE = 4
 # s
 STRIDE = 4
 
+# The number of roots selected per pass by neighborhood_assembly.iter_roots
+ROOT_BATCH_SIZE = 1024
+
+# The maximum number of incoming edges of a node followed when building a receptive field, or
+# None for no limit. The edges of nodes above it are sampled, see neighborhood_assembly
+MAX_FANOUT = None
+FANOUT_SEED = 0
+
+# The maximum length of the paths searched by get_attack_paths (db_exploration and snapshot).
+# Unbounded variable-length patterns can enumerate an exponential number of paths
+ATTACK_PATHS_MAX_DEPTH = 10
+
+# If not None, receptive fields are causal: only edges with a timestamp in
+# [root timestamp - CAUSAL_WINDOW, root timestamp] are followed
+CAUSAL_WINDOW = None
+
 # input channels
 HASH_PROPERTIES = ['cmdline', 'name', 'ips', 'client_port', 'meta_login']
 # HASH_PROPERTIES = ['cmdline', 'name']
@@ -61,6 +77,22 @@ DEFAULT_TENSOR_VAL = 0
 # Clean the data (remove anomalous nodes, consolidate node versions etc) or not
 CLEAN_TRAIN_DATA = False
 
+# Which of a set of parallel edges (same start, end and type) is kept when cleaning the data:
+# 'earliest' or 'latest' by edge timestamp
+DUPLICATE_EDGE_KEEP = 'earliest'
+
+# Fetch training data as compact projections instead of whole paths, see
+# data_processing.projection. Projected nodes only have the properties timestamp, uuid,
+# anomalous and those in HASH_PROPERTIES, and projected edges only timestamp and those in
+# EDGE_PROPERTIES: any other property is dropped
+PROJECT_PROPERTIES = False
+
+# Fetch training data in two phases: the pattern queries fetch only the structure of the
+# matches, and the other node properties are fetched for the graphs kept after cleaning and
+# balancing, see data_processing.hydration and format_training_data.label_and_hydrate_data.
+# Only used if PROJECT_PROPERTIES is set
+LAZY_PROPERTIES = False
+
 # The length of embedding for each name
 EMBEDDING_LENGTH = 20
 
@@ -0,0 +1,406 @@
+"""
+Tests for graph representations
+"""
+
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+import data_processing.preprocessing as pre
+from data_processing.graphs import Graph, to_compact_graph
+from data_processing.columns import build_column, ArrayColumn, CodedColumn, HeapColumn
+from data_processing.property_store import build_property_store
+from data_processing.neighbourhood import bounded_bfs, graph_expander, get_local_neighbourhood, \
+    get_local_path_union
+from patchy_san.graph_normalisation import compute_hash, compute_hashes
+from data_processing.snapshot import export_graph, OfflineStore
+from data_processing.pattern_matching import Pattern, tree_pattern, find_matches, iter_match_records
+from patchy_san.neighborhood_assembly import get_receptive_field, get_receptive_field_indices, \
+    get_receptive_field_matrix, new_fanout_stats, TimestampIndex, select_roots, \
+    iter_roots
+from patchy_san.graph_normalisation import normalise_receptive_field
+from tests.test_preprocessing import MockNode, MockEdge
+
+
+def make_graph():
+    nodes = {1: MockNode(1), 2: MockNode(2), 3: MockNode(3), 4: MockNode(4)}
+    edges = {5: MockEdge(5, 2, 1, 'PROC_OBJ'), 3: MockEdge(3, 3, 1, 'COMM'),
+             4: MockEdge(4, 4, 2, 'PROC_OBJ')}
+    edges[5].properties = {'state': 'READ'}
+    incoming_edges, outgoing_edges = pre.build_in_out_edges(edges)
+    return Graph(nodes, edges, incoming_edges, outgoing_edges)
+
+
+def make_random_graph(node_count, edge_count):
+    rng = np.random.RandomState(0)
+    nodes = {node_id: MockNode(node_id) for node_id in range(node_count)}
+    edges = {}
+    for edge_id in range(100, 100 + edge_count):
+        start, end = rng.randint(0, node_count, 2).tolist()
+        edges[edge_id] = MockEdge(edge_id, start, end, 'PROC_OBJ')
+    incoming_edges, outgoing_edges = pre.build_in_out_edges(edges)
+    return to_compact_graph(Graph(nodes, edges, incoming_edges, outgoing_edges))
+
+
+def make_causal_graph():
+    graph = make_graph()
+    graph.nodes[1].properties = {'timestamp': 100}
+    graph.edges[3].properties = {'timestamp': 95}
+    graph.edges[5].properties = {'state': 'READ', 'timestamp': 40}
+    graph.edges[4].properties = {'timestamp': 99}
+    return graph
+
+
+class TestCompactGraph(unittest.TestCase):
+    def test_adapter_matches_graph(self):
+        graph = make_graph()
+        compact = to_compact_graph(graph)
+
+        self.assertEqual(sorted(compact.nodes.keys()), sorted(graph.nodes.keys()))
+        self.assertEqual(sorted(compact.edges.keys()), sorted(graph.edges.keys()))
+        self.assertEqual(set(compact.incoming_edges.keys()), set(graph.incoming_edges.keys()))
+        self.assertEqual(set(compact.outgoing_edges.keys()), set(graph.outgoing_edges.keys()))
+
+        for node_id in graph.incoming_edges:
+            self.assertEqual([e.id for e in compact.incoming_edges[node_id]],
+                             [e.id for e in graph.incoming_edges[node_id]])
+        self.assertFalse(3 in compact.incoming_edges)
+        self.assertEqual(compact.nodes[3].properties, graph.nodes[3].properties)
+        self.assertEqual(compact.edges[5].properties, {'state': 'READ'})
+
+    def test_adapter_nodes_are_copies(self):
+        compact = to_compact_graph(make_graph())
+        compact.nodes[3].properties['timestamp'] = 0
+        self.assertEqual(compact.nodes[3].properties['timestamp'], 1003)
+        self.assertEqual(compact.node_values('timestamp'), [1001, 1002, 1003, 1004])
+
+    def test_csr_arrays(self):
+        compact = to_compact_graph(make_graph())
+        node_one = compact.index_of(1)
+
+        row = slice(compact.in_indptr[node_one], compact.in_indptr[node_one+1])
+        self.assertEqual(compact.edge_ids[compact.in_edges[row]].tolist(), [3, 5])
+        self.assertEqual(compact.node_ids[compact.in_indices[row]].tolist(), [3, 2])
+        self.assertEqual(compact.in_degree().tolist(), [2, 1, 0, 0])
+        self.assertEqual(compact.index_of(42), -1)
+
+        edge_five = compact.edge_ids.tolist().index(5)
+        self.assertEqual(compact.state_names[compact.edge_state[edge_five]], 'READ')
+        self.assertTrue(np.all(compact.edge_state[compact.edge_ids != 5] < 0))
+
+    def test_property_columns(self):
+        timestamps = build_column([2 ** 62 + 1, None, 2 ** 62])
+        self.assertTrue(isinstance(timestamps, ArrayColumn))
+        self.assertEqual(timestamps.get_all(), [2 ** 62 + 1, None, 2 ** 62])
+
+        names = build_column([['/bin/sh'], None, ['/bin/sh'], 'x'])
+        self.assertTrue(isinstance(names, CodedColumn))
+        self.assertEqual(names.get_all(), [['/bin/sh'], None, ['/bin/sh'], 'x'])
+        self.assertEqual(names.mask(lambda value: value == 'x').tolist(),
+                         [False, False, False, True])
+
+        uuids = build_column(['a', 'b', None, 'c'], max_coded=2)
+        self.assertTrue(isinstance(uuids, HeapColumn))
+        self.assertEqual(uuids.take([3, 2, 0]).get_all(), ['c', None, 'a'])
+
+    def test_to_graph_round_trip(self):
+        graph = to_compact_graph(make_graph()).to_graph()
+
+        self.assertEqual(sorted(graph.edges.keys()), [3, 4, 5])
+        self.assertEqual([e.id for e in graph.incoming_edges[1]], [3, 5])
+
+
+class TestBulkRemoval(unittest.TestCase):
+    def test_graph_remove_nodes(self):
+        graph = make_graph()
+        removed_edges = graph.remove_nodes({2})
+
+        self.assertEqual(removed_edges, 2)
+        self.assertEqual(sorted(graph.nodes.keys()), [1, 3, 4])
+        self.assertEqual(sorted(graph.edges.keys()), [3])
+        self.assertEqual([e.id for e in graph.incoming_edges[1]], [3])
+        self.assertFalse(4 in graph.outgoing_edges)
+
+    def test_compact_graph_remove_nodes_mask(self):
+        compact = to_compact_graph(make_graph())
+        smaller = compact.remove_nodes(compact.node_ids == 2)
+
+        self.assertEqual(smaller.node_ids.tolist(), [1, 3, 4])
+        self.assertEqual(smaller.edge_ids.tolist(), [3])
+        self.assertEqual(smaller.node_ids[smaller.edge_start].tolist(), [3])
+        self.assertEqual([e.id for e in smaller.incoming_edges[1]], [3])
+        self.assertEqual(compact.remove_nodes([2, 3]).edge_count(), 0)
+
+
+class TestPropertyStore(unittest.TestCase):
+    def test_dictionary_encoding(self):
+        nodes = [MockNode(1, {'cmdline': 'sh -c', 'name': ['/bin/sh', '/bin/dash']}),
+                 MockNode(2, {'cmdline': 'sh -c', 'name': []}),
+                 MockNode(3, {'name': ['/bin/sh']})]
+        store = build_property_store(nodes, ['cmdline', 'name'])
+
+        self.assertEqual(len(store.table), 2)
+        self.assertEqual(store.has('cmdline').tolist(), [True, True, False])
+        self.assertEqual(store.has('name').tolist(), [True, False, True])
+        self.assertEqual(store.get('name', 2), '/bin/sh')
+        self.assertIsNone(store.get('cmdline', 2))
+
+        calls = []
+        lengths = store.map_unique('cmdline', lambda value: calls.append(value) or len(value))
+        self.assertEqual(lengths, [5, 5, None])
+        self.assertEqual(calls, ['sh -c'])
+
+    def test_compute_hashes_matches_compute_hash(self):
+        graph = make_graph()
+        graph.nodes[1].properties.update({'cmdline': '/usr/bin/ssh', 'name': ['/a/b']})
+        graph.nodes[2].properties.update({'cmdline': '/usr/bin/ssh'})
+        graph.nodes[3].properties.update({'name': '/abc'})
+        for node in graph.nodes.values():
+            node.labels = {'Process'}
+
+        hashes = compute_hashes(to_compact_graph(graph))
+        for node_id, node in graph.nodes.items():
+            self.assertEqual(hashes[node_id], compute_hash(node))
+
+
+class TestNeighbourhood(unittest.TestCase):
+    def test_bounded_bfs_levels_and_cap(self):
+        graph = make_graph()
+        expand = graph_expander(graph, 'in')
+
+        self.assertEqual(bounded_bfs(expand, [1], 1, 10), [1, 2, 3])
+        self.assertEqual(bounded_bfs(expand, [1], 2, 10), [1, 2, 3, 4])
+        self.assertEqual(bounded_bfs(expand, [1], 5, 2), [1, 2])
+        self.assertEqual(bounded_bfs(graph_expander(graph, 'out'), [4], 5, 10), [4, 2, 1])
+
+    def test_local_neighbourhood(self):
+        for graph in [make_graph(), to_compact_graph(make_graph())]:
+            neighbourhood = get_local_neighbourhood(graph, 1, 1, 10)
+
+            self.assertEqual(sorted(neighbourhood.nodes.keys()), [1, 2, 3])
+            self.assertEqual(sorted(neighbourhood.edges.keys()), [3, 5])
+            self.assertEqual([e.id for e in neighbourhood.incoming_edges[1]], [3, 5])
+
+    def test_local_path_union(self):
+        graph = make_graph()
+        graph.nodes[6] = MockNode(6)
+        graph.edges[7] = MockEdge(7, 2, 6, 'PROC_OBJ')
+        graph.edges[8] = MockEdge(8, 6, 1, 'PROC_OBJ')
+        graph.edges[9] = MockEdge(9, 4, 3, 'PROC_OBJ')
+        graph.rebuild_adjacency()
+
+        union = get_local_path_union(graph, 4, 1)
+        self.assertEqual(sorted(union.nodes.keys()), [1, 2, 3, 4, 6])
+        self.assertEqual(sorted(union.edges.keys()), [3, 4, 5, 7, 8, 9])
+
+        union = get_local_path_union(graph, 2, 1)
+        self.assertEqual(sorted(union.edges.keys()), [5, 7, 8])
+        self.assertEqual(len(get_local_path_union(graph, 1, 4).nodes), 0)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.graph = make_graph()
+        self.graph.nodes[2].properties.update({'name': ['/bin/sh'], 'cmdline': 'sh attack.sh'})
+        self.graph.nodes[4].properties['name'] = ['/tmp/x']
+        self.graph.nodes[4].labels = {'File'}
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        export_graph(self.graph, self.directory)
+        self.store = OfflineStore(self.directory)
+
+    def test_offline_store_matches_graph(self):
+        store_graph = self.store.graph
+        self.assertEqual(store_graph.nodes[2].properties, self.graph.nodes[2].properties)
+        self.assertEqual(store_graph.nodes[4].labels, {'File'})
+        self.assertEqual(store_graph.edges[5].properties, {'state': 'READ'})
+        self.assertEqual([e.id for e in store_graph.incoming_edges[1]], [3, 5])
+
+    def test_timestamps_are_memory_mapped(self):
+        # Timestamps are a memory-mapped typed column, not values in the JSON tables
+        timestamps = self.store.graph.node_columns['timestamp']
+        self.assertIsInstance(timestamps, ArrayColumn)
+        self.assertIsInstance(timestamps.values, np.memmap)
+        self.assertEqual(self.store.graph.node_values('timestamp'), [1001, 1002, 1003, 1004])
+        with open(os.path.join(self.directory, 'tables.json')) as tables_file:
+            self.assertNotIn('values', json.load(tables_file))
+
+    def test_offline_neighbourhoods(self):
+        neighbourhood = self.store.get_neighborhood_bounded(1, 1, 10)
+        self.assertEqual(sorted(neighbourhood.edges.keys()), [3, 5])
+        self.assertEqual(sorted(self.store.get_path_union(4, 1).nodes.keys()), [1, 2, 4])
+
+    def test_offline_find_nodes(self):
+        self.assertEqual(self.store.find_nodes('cmdline', '.*attack.*').tolist(), [2])
+
+    def test_offline_attack_paths(self):
+        nodes = {1: self.graph.nodes[1], 2: self.graph.nodes[2]}
+        self.assertEqual(self.store.get_attack_paths(nodes), [{'/bin/sh', '/tmp/x'}, {'/tmp/x'}])
+        self.assertEqual(self.store.get_attack_paths(nodes, max_depth=1),
+                         [{'/bin/sh'}, {'/tmp/x'}])
+        with self.assertRaises(ValueError):
+            self.store.get_attack_paths(nodes, max_depth=None)
+
+
+class TestPatternMatching(unittest.TestCase):
+    def setUp(self):
+        self.compact = to_compact_graph(make_graph())
+
+    def match_ids(self, pattern, **kwargs):
+        node_ids = self.compact.node_ids.tolist()
+        edge_ids = self.compact.edge_ids.tolist()
+        return sorted((tuple(node_ids[i] for i in nodes), tuple(edge_ids[i] for i in edges))
+                      for nodes, edges in find_matches(self.compact, pattern, **kwargs))
+
+    def test_star(self):
+        star = tree_pattern([('a', 'centre'), ('b', 'centre')])
+        self.assertEqual(self.match_ids(star), [((2, 1, 3), (5, 3)), ((3, 1, 2), (3, 5))])
+
+    def test_edge_states(self):
+        star = tree_pattern([('a', 'centre'), ('b', 'centre')])
+        star.edge('a', 'centre', states=['READ'])
+        self.assertEqual(self.match_ids(star), [])
+
+    def test_edge_types_and_node_predicate(self):
+        read_star = Pattern()
+        read_star.edge('a', 'centre', states=['READ'])
+        read_star.edge('b', 'centre', types=['COMM'])
+        read_star.node('a', predicate=lambda node: node.id == 2)
+        self.assertEqual(self.match_ids(read_star), [((2, 1, 3), (5, 3))])
+
+    def test_chain(self):
+        chain = tree_pattern([('a', 'b'), ('b', 'c')])
+        self.assertEqual(self.match_ids(chain), [((4, 2, 1), (4, 5))])
+
+    def test_triangle(self):
+        triangle = tree_pattern([('a', 'b'), ('b', 'c'), ('a', 'c')])
+        self.assertEqual(self.match_ids(triangle), [])
+
+    def test_clauses_may_share_edges(self):
+        # Edges of separate MATCH clauses may match the same graph edge
+        clauses = Pattern()
+        clauses.edge('a', 'centre', states=['READ'])
+        clauses.new_clause()
+        clauses.edge('b', 'centre')
+        self.assertEqual(self.match_ids(clauses), [((2, 1, 2), (5, 5)), ((2, 1, 3), (5, 3))])
+
+    def test_parallel_matches(self):
+        star = tree_pattern([('a', 'centre'), ('b', 'centre')])
+        self.assertEqual(self.match_ids(star, seed=3, workers=2), self.match_ids(star, seed=3))
+
+    def test_match_limit(self):
+        star = tree_pattern([('a', 'centre'), ('b', 'centre')])
+        self.assertEqual(len(find_matches(self.compact, star, limit=1)), 1)
+
+    def test_match_records(self):
+        star = tree_pattern([('a', 'centre'), ('b', 'centre')])
+        matches = find_matches(self.compact, star, seed=3)
+        graph_list = list(pre.iter_graphs_by_result(iter_match_records(self.compact, matches)))
+        self.assertEqual([sorted(g.nodes.keys()) for g in graph_list], [[1, 2, 3], [1, 2, 3]])
+        self.assertEqual([e.id for e in graph_list[0].incoming_edges[1]], [3, 5])
+
+
+class TestReceptiveField(unittest.TestCase):
+    def test_index_view_matches_graph_field(self):
+        graph = make_graph()
+        compact = to_compact_graph(graph)
+        hashes = {1: 3, 2: 2, 3: 1, 4: 0}
+
+        field_graph = get_receptive_field(1, graph)
+        field = get_receptive_field_indices(compact.index_of(1), compact)
+        self.assertEqual(field.node_ids().tolist(), list(field_graph.nodes.keys()))
+        self.assertEqual(sorted(compact.edge_ids[field.edge_indices].tolist()),
+                         sorted(field_graph.edges.keys()))
+
+        normalised = normalise_receptive_field(field, hashes)
+        self.assertEqual([node.id for node in normalised],
+                         [node.id for node in normalise_receptive_field(field_graph, hashes)])
+        self.assertEqual(normalised[0].id, normalised.node_ids()[0])
+
+        edges = field.related_edges()
+        self.assertEqual([edge.id for edge in edges], [3, 5, 4])
+
+    def test_batched_fields_match_single_fields(self):
+        compact = make_random_graph(40, 120)
+        roots = np.arange(0, 40, 3)
+        node_matrix, edge_matrix = get_receptive_field_matrix(roots, compact)
+        for row, root in enumerate(roots.tolist()):
+            field = get_receptive_field_indices(root, compact)
+            self.assertEqual(node_matrix[row][node_matrix[row] >= 0].tolist(), field.indices.tolist())
+            self.assertEqual(edge_matrix[row][1:len(field)].tolist(), field.edge_indices.tolist())
+
+    def test_batched_fanout_stats_match_single_fields(self):
+        compact = make_random_graph(20, 200)
+        roots = np.arange(20)
+        stats = new_fanout_stats()
+        get_receptive_field_matrix(roots, compact, max_fanout=2, seed=3, stats=stats)
+
+        expected = new_fanout_stats()
+        for root in roots.tolist():
+            get_receptive_field_indices(root, compact, max_fanout=2, seed=3, stats=expected)
+        self.assertEqual(stats, expected)
+
+    def test_fanout_cap(self):
+        graph = make_graph()
+        compact = to_compact_graph(graph)
+        stats = new_fanout_stats()
+
+        field_graph = get_receptive_field(1, graph, max_fanout=1, seed=7, stats=stats)
+        field = get_receptive_field_indices(compact.index_of(1), compact, max_fanout=1, seed=7,
+                                            stats=stats)
+        self.assertEqual(field.node_ids().tolist(), list(field_graph.nodes.keys()))
+        self.assertEqual(len(field_graph.edges), 2)
+        self.assertEqual(stats, {'capped': 2, 'skipped': 2})
+
+    def test_fanout_sampling_is_seeded(self):
+        graph = make_graph()
+        self.assertEqual(list(get_receptive_field(1, graph, max_fanout=1, seed=7).nodes.keys()),
+                         list(get_receptive_field(1, graph, max_fanout=1, seed=7).nodes.keys()))
+
+    def test_batched_fanout_cap(self):
+        compact = to_compact_graph(make_graph())
+        stats = new_fanout_stats()
+        get_receptive_field_matrix([compact.index_of(1)], compact, max_fanout=1, seed=7, stats=stats)
+        self.assertEqual(stats, {'capped': 1, 'skipped': 1})
+
+    def test_timestamp_index_positions(self):
+        compact = to_compact_graph(make_causal_graph())
+        ts_index = TimestampIndex(compact)
+        self.assertEqual(compact.edge_ids[compact.in_edges[ts_index.positions(0, 0, 100)]].tolist(),
+                         [3, 5])
+
+    def test_causal_window(self):
+        graph = make_causal_graph()
+        compact = to_compact_graph(graph)
+        ts_index = TimestampIndex(compact)
+
+        for window, node_ids in [(10, [1, 3]), (60, [1, 3, 2, 4]), (None, [1, 3, 2, 4])]:
+            field_graph = get_receptive_field(1, graph, window=window)
+            field = get_receptive_field_indices(0, compact, window=window, ts_index=ts_index)
+            node_matrix, _ = get_receptive_field_matrix([0], compact, window=window)
+            self.assertEqual(list(field_graph.nodes.keys()), node_ids)
+            self.assertEqual(field.node_ids().tolist(), node_ids)
+            self.assertEqual(compact.node_ids[node_matrix[0][node_matrix[0] >= 0]].tolist(), node_ids)
+
+    def test_causal_window_needs_only_root_timestamps(self):
+        graph = make_graph()
+        del graph.nodes[4].properties['timestamp']
+        compact = to_compact_graph(graph)
+
+        field = get_receptive_field_indices(0, compact, window=60)
+        node_matrix, _ = get_receptive_field_matrix([0], compact, window=60)
+        self.assertEqual(node_matrix[0][node_matrix[0] >= 0].tolist(), field.indices.tolist())
+
+    def test_select_roots(self):
+        graph = make_graph()
+        for node_id, timestamp in [(1, 30), (2, 10), (3, 10), (4, 20)]:
+            graph.nodes[node_id].properties = {'timestamp': timestamp}
+
+        self.assertEqual([node.id for node in select_roots(graph, stride=1)], [2, 3, 4, 1])
+        self.assertEqual([node.id for node in select_roots(graph, count=1, stride=2)], [2])
+        self.assertEqual([node.id for node in select_roots(graph, stride=3)], [2, 1])
+        self.assertEqual([node.id for node in iter_roots(graph, stride=1, batch_size=1)],
+                         [2, 3, 4, 1])
@@ -2,9 +2,16 @@
 Tests for preprocessing functions
 """
 
+import os
+import tempfile
 import unittest
 import data_processing.preprocessing as pre
-from data_processing.graphs import Graph
+from data_processing.graphs import Graph, EntityPool
+from data_processing.uuid_index import UuidIndex, load_uuid_index
+from data_processing.query_cache import QueryCache
+from data_processing import pagination
+from data_processing.projection import project_query, ProjectedResult
+from data_processing.hydration import PropertyHydrator
 
 
 class MockNode:
@@ -40,6 +47,76 @@ class MockBoltStatementResult:
     def data(self):
         return [{'path': MockPath(self.nodes, self.edges)}]
 
+    def __iter__(self):
+        return iter(self.data())
+
+
+class MockMultiRecordResult:
+    def __init__(self, records):
+        self.records = records
+        self.consumed = 0
+
+    def __iter__(self):
+        for nodes, edges in self.records:
+            self.consumed += 1
+            yield {'path': MockPath(nodes, edges)}
+
+
+CACHED_QUERY = "MATCH path=(n)<-[]-(m)\n    RETURN path"
+CACHED_RECORDS = [([MockNode(1), MockNode(2)], [MockEdge(1, 2, 1)]),
+                  ([MockNode(2), MockNode(3)], [MockEdge(2, 3, 2)])]
+
+
+def make_anchor_matches():
+    """
+    :return: A tuple (matches, run_query): matches of a pattern, keyed by the id of their
+    anchor node, and a fake query runner serving the anchor and page queries of spool_pages
+    """
+
+    matches = [(anchor, [MockNode(anchor), MockNode(anchor+100+idx)],
+                [MockEdge(anchor*10+idx, anchor+100+idx, anchor)])
+               for anchor in [3, 5, 8, 9, 12] for idx in range(anchor % 3 + 1)]
+
+    def run_query(query, parameters):
+        if 'after' in parameters:
+            anchors = sorted(set(m[0] for m in matches if m[0] > parameters['after']))
+            return [{'anchor_id': anchor} for anchor in anchors[:parameters['page_size']]]
+        return MockMultiRecordResult([(m[1], m[2]) for m in matches
+                                      if m[0] in parameters['anchor_ids']])
+
+    return matches, run_query
+
+
+def make_parallel_edges_graph(first_timestamp, second_timestamp):
+    nodes = {1: MockNode(1), 2: MockNode(2)}
+    edges = {1: MockEdge(1, 1, 2, 'PROC_OBJ'), 2: MockEdge(2, 1, 2, 'PROC_OBJ'),
+             3: MockEdge(3, 1, 2, 'PROC_OBJ'), 4: MockEdge(4, 1, 2, 'COMM'),
+             5: MockEdge(5, 2, 1, 'PROC_OBJ')}
+    edges[1].properties = {'timestamp': first_timestamp}
+    edges[2].properties = {'timestamp': second_timestamp}
+    edges[3].properties = {}
+    incoming_edges, outgoing_edges = pre.build_in_out_edges(edges)
+    return Graph(nodes, edges, incoming_edges, outgoing_edges)
+
+
+def make_structure_graphs():
+    records = [{'p_nodes': [[1, ['Process'], {'timestamp': 5}], [2, ['File'], {'timestamp': 6}]],
+                'p_edges': [[7, 2, 1, 'PROC_OBJ', {'state': 'READ'}]]},
+               {'p_nodes': [[2, ['File'], {'timestamp': 6}], [3, ['File'], {'timestamp': 7}]],
+                'p_edges': [[8, 3, 2, 'PROC_OBJ', {}]]}]
+    return list(pre.iter_graphs_by_result(ProjectedResult(records)))
+
+
+def make_hydration_query(fetched):
+    names = {1: ['/bin/sh'], 2: ['/etc/passwd'], 3: None}
+
+    def run_query(query, parameters):
+        fetched.extend(parameters['ids'])
+        return [{'node_id': node_id, 'properties': {'name': names[node_id], 'cmdline': None}}
+                for node_id in parameters['ids']]
+
+    return run_query
+
 
 class TestPreprocessingFns(unittest.TestCase):
     def test_get_nodes_edges(self):
@@ -52,6 +129,38 @@ class TestPreprocessingFns(unittest.TestCase):
             self.assertEquals(node_id, graph.nodes[node_id].id)
             self.assertEquals(node_id, graph.edges[node_id].id)
 
+    def test_iter_graphs_by_result(self):
+        records = [([MockNode(1), MockNode(2)], [MockEdge(1, 2, 1)]),
+                   ([MockNode(3)], [])]
+        data = MockMultiRecordResult(records)
+        graph_iter = pre.iter_graphs_by_result(data)
+
+        first = next(graph_iter)
+        self.assertEqual(data.consumed, 1)
+        self.assertEqual(sorted(first.nodes.keys()), [1, 2])
+        self.assertEqual(first.incoming_edges[1][0].id, 1)
+
+        rest = list(graph_iter)
+        self.assertEqual(len(rest), 1)
+        self.assertEqual(list(rest[0].nodes.keys()), [3])
+
+    def test_graphs_share_pooled_nodes_copy_on_write(self):
+        hub = MockNode(1, {'cmdline': 'init'})
+        records = [([hub, MockNode(2)], [MockEdge(1, 2, 1)]),
+                   ([hub, MockNode(3)], [MockEdge(2, 3, 1)])]
+        pool = EntityPool()
+        first, second = pre.iter_graphs_by_result(MockMultiRecordResult(records), pool)
+
+        self.assertEqual(pool.node_count(), 3)
+        first.nodes[1].properties['cmdline'] = 'bash'
+        first.nodes[1].labels = {'Process'}
+        first.edges[1].type = 'COMM'
+
+        self.assertEqual(first.nodes[1].properties['cmdline'], 'bash')
+        self.assertEqual(second.nodes[1].properties['cmdline'], 'init')
+        self.assertEqual(second.nodes[1].labels, frozenset())
+        self.assertEqual(pool.edge_types[0], 'NoType')
+
     def test_consolidate_node_versions(self):
         nodes = {1: MockNode(1), 2: MockNode(2), 3: MockNode(3), 4: MockNode(4)}
         edges = {1: MockEdge(1, 1, 2, 'PROC_OBJ_PREV'),
@@ -65,6 +174,25 @@ class TestPreprocessingFns(unittest.TestCase):
         self.assertTrue(graph.nodes[1].id == 1)
         self.assertTrue(len(graph.edges) == 0)
 
+    def test_consolidate_version_chain_rewires_edges(self):
+        nodes = {1: MockNode(1), 2: MockNode(2), 3: MockNode(3), 5: MockNode(5)}
+        edges = {1: MockEdge(1, 1, 2, 'PROC_OBJ_PREV'),
+                 2: MockEdge(2, 2, 3, 'META_PREV'),
+                 3: MockEdge(3, 3, 1, 'PROC_OBJ'),
+                 10: MockEdge(10, 5, 3, 'PROC_OBJ'),
+                 11: MockEdge(11, 2, 5, 'COMM')}
+        incoming_edges, outgoing_edges = pre.build_in_out_edges(edges)
+        graph = Graph(nodes, edges, incoming_edges, outgoing_edges)
+        collapsed = pre.consolidate_node_versions(graph)
+
+        self.assertEqual(collapsed, (2, 3))
+        self.assertEqual(sorted(graph.nodes.keys()), [1, 5])
+        self.assertEqual(sorted(graph.edges.keys()), [10, 11])
+        self.assertEqual((graph.edges[10].start, graph.edges[10].end), (5, 1))
+        self.assertEqual((graph.edges[11].start, graph.edges[11].end), (1, 5))
+        self.assertEqual([e.id for e in graph.incoming_edges[1]], [10])
+        self.assertEqual([e.id for e in graph.outgoing_edges[1]], [11])
+
     def test_build_in_out_edges(self):
         edges = {1: MockEdge(1, 1, 2), 2: MockEdge(2, 1, 3), 3: MockEdge(3, 1, 4)}
         incoming_edges, outgoing_edges = pre.build_in_out_edges(edges)
@@ -89,6 +217,28 @@ class TestPreprocessingFns(unittest.TestCase):
         self.assertTrue(graph.edges[3].start == 3 and edges[3].end == 4)
         self.assertTrue(graph.nodes[3].id == 3 and nodes[4].id == 4)
 
+    def test_remove_duplicate_edges_keeps_earliest(self):
+        graph = make_parallel_edges_graph(50, 10)
+        self.assertEqual(pre.remove_duplicate_edges(graph, 'earliest'), 2)
+        self.assertEqual(sorted(graph.edges.keys()), [2, 4, 5])
+        self.assertEqual([e.id for e in graph.outgoing_edges[1]], [2, 4])
+
+    def test_remove_duplicate_edges_keeps_latest(self):
+        graph = make_parallel_edges_graph(50, 10)
+        pre.remove_duplicate_edges(graph, 'latest')
+        self.assertEqual(sorted(graph.edges.keys()), [1, 4, 5])
+
+    def test_remove_duplicate_edges_nanosecond_timestamps(self):
+        # Timestamps which are equal as floats
+        graph = make_parallel_edges_graph(10**18 + 1, 10**18)
+        pre.remove_duplicate_edges(graph, 'latest')
+        self.assertEqual(sorted(graph.edges.keys()), [1, 4, 5])
+
+    def test_remove_duplicate_edges_string_timestamps(self):
+        graph = make_parallel_edges_graph('2018-01-02', '2018-01-01')
+        pre.remove_duplicate_edges(graph, 'earliest')
+        self.assertEqual(sorted(graph.edges.keys()), [2, 4, 5])
+
     def test_rename_symlinked_files_timestamp(self):
         nodes = {1: MockNode(1, {'uuid': 10, 'timestamp': 100, 'name': '/etc/lib.so.6'}),
                  2: MockNode(2, {'uuid': 10, 'timestamp': 101, 'name': '/etc/lib.so.1234'}),
@@ -101,6 +251,198 @@ class TestPreprocessingFns(unittest.TestCase):
         self.assertTrue(graph.nodes[2].properties['name'] == '/etc/lib.so.6')
         self.assertTrue(graph.nodes[3].properties['name'] == '/var/test')
 
+    def test_uuid_index_across_graphs(self):
+        old = Graph({1: MockNode(1, {'uuid': 10, 'timestamp': 100, 'name': ['/etc/lib.so.6']})}, {}, {}, {})
+        new = Graph({2: MockNode(2, {'uuid': 10, 'timestamp': 101, 'name': ['/etc/lib.so.1234']}),
+                     3: MockNode(3, {'uuid': 11, 'timestamp': 99, 'name': ['/var/test']})}, {}, {}, {})
+        index = UuidIndex()
+        pre.rename_symlinked_files_timestamp(old, index)
+        pre.rename_symlinked_files_timestamp(new, index)
+
+        self.assertEqual(new.nodes[2].properties['name'], ['/etc/lib.so.6'])
+        self.assertEqual(new.nodes[3].properties['name'], ['/var/test'])
+
+        old.nodes[1].properties['name'].append('/lib/changed')
+        self.assertEqual(index.canonical_name(10), ['/etc/lib.so.6'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'uuid_index.pkl')
+            index.save(path)
+            loaded = load_uuid_index(path)
+        self.assertEqual(loaded.entries, index.entries)
+        self.assertEqual(loaded.canonical_name(11), ['/var/test'])
+
+    def test_clean_graphs_parallel_matches_serial(self):
+        def make_graphs():
+            graph_list = []
+            for offset in range(0, 50, 10):
+                anomalous = offset == 20
+                nodes = {offset+1: MockNode(offset+1), offset+2: MockNode(offset+2, {'anomalous': anomalous})}
+                edges = {offset+1: MockEdge(offset+1, offset+1, offset+2, 'PROC_OBJ'),
+                         offset+2: MockEdge(offset+2, offset+1, offset+2, 'PROC_OBJ')}
+                incoming_edges, outgoing_edges = pre.build_in_out_edges(edges)
+                graph_list.append(Graph(nodes, edges, incoming_edges, outgoing_edges))
+            return graph_list
+
+        serial = pre.clean_graphs(make_graphs())
+        parallel = pre.clean_graphs(make_graphs(), workers=3)
+
+        self.assertEqual([sorted(g.nodes.keys()) for g in serial], [sorted(g.nodes.keys()) for g in parallel])
+        self.assertEqual([sorted(g.edges.keys()) for g in parallel], [[1], [11], [31], [41]])
+        self.assertEqual([e.id for e in parallel[1].outgoing_edges[11]], [11])
+
+    def test_query_cache_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = QueryCache(directory, snapshot_tag='test')
+            self.assertIsNone(cache.get(CACHED_QUERY))
+
+            stored = cache.put(CACHED_QUERY, None, MockMultiRecordResult(CACHED_RECORDS))
+            cached = cache.get("MATCH path=(n)<-[]-(m) RETURN path")
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 1)
+            for result in [stored, cached]:
+                graph = pre.get_graph(result)
+                self.assertEqual(sorted(graph.nodes.keys()), [1, 2, 3])
+                self.assertEqual(graph.edges[2].start, 3)
+                self.assertEqual(graph.nodes[3].properties['timestamp'], 1003)
+
+    def test_query_cache_snapshot_tag(self):
+        with tempfile.TemporaryDirectory() as directory:
+            QueryCache(directory, snapshot_tag='test').put(
+                CACHED_QUERY, None, MockMultiRecordResult(CACHED_RECORDS))
+            self.assertIsNone(QueryCache(directory, snapshot_tag='other').get(CACHED_QUERY))
+
+    def test_query_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = QueryCache(directory, snapshot_tag='test')
+            cache.put(CACHED_QUERY, None, MockMultiRecordResult(CACHED_RECORDS))
+            cache.max_bytes = 0
+            self.assertEqual(cache.evict(), 1)
+            self.assertIsNone(cache.get(CACHED_QUERY))
+
+    def test_keyset_queries(self):
+        query = "MATCH path=(n)<-[r]-(m)\n    WHERE r.state = 'READ' OR n.x = 1\n    RETURN path LIMIT 10"
+        anchor_query, page_query = pagination.keyset_queries(query, 'n')
+        self.assertTrue(anchor_query.startswith("MATCH (n)\nWHERE Id(n) > $after\n"))
+        self.assertTrue(page_query.endswith(
+            "WHERE (r.state = 'READ' OR n.x = 1) AND Id(n) IN $anchor_ids\nRETURN path"))
+
+    def test_paginated_fetch_resumes(self):
+        matches, run_query = make_anchor_matches()
+        query = "MATCH path=(n)<-[r]-(m)\n    RETURN path LIMIT 10"
+
+        with tempfile.TemporaryDirectory() as directory:
+            pages = pagination.spool_pages(run_query, query, 'n', directory, page_size=2)
+            first = next(pages)
+            self.assertEqual(sorted(pre.get_graph(first).nodes.keys()), [3, 5, 103, 105, 106, 107])
+            pages.close()
+
+            resumed = list(pagination.spool_pages(run_query, query, 'n', directory, page_size=2))
+            self.assertEqual(len(resumed), 2)
+
+            result = pagination.SpooledResult(directory)
+            self.assertEqual(len(list(result)), len(matches))
+            self.assertEqual(len(result.page_paths()), 3)
+
+    def test_large_pages_are_split(self):
+        # Pages larger than max_page_bytes are split over several files while they stream
+        matches, run_query = make_anchor_matches()
+        query = "MATCH path=(n)<-[r]-(m)\n    RETURN path LIMIT 10"
+
+        with tempfile.TemporaryDirectory() as directory:
+            files = list(pagination.spool_pages(run_query, query, 'n', directory, page_size=4,
+                                                max_page_bytes=1))
+            self.assertEqual([len(page) for page in files], [1] * len(matches))
+            self.assertEqual(pagination.load_checkpoint(directory)['page_size'], 2)
+
+    def test_spooled_pages_hold_one_streamed_record(self):
+        # A lazy result records how many of its records were read but not yet spooled
+        matches = [(anchor, [MockNode(anchor)], []) for anchor in range(6)]
+        held = []
+
+        def run_query(query, parameters):
+            if 'after' in parameters:
+                anchors = [m[0] for m in matches if m[0] > parameters['after']]
+                return [{'anchor_id': anchor} for anchor in anchors[:parameters['page_size']]]
+            return stream(parameters['anchor_ids'])
+
+        def stream(anchor_ids):
+            for anchor, nodes, edges in matches:
+                if anchor in anchor_ids:
+                    spooled = [name for name in os.listdir(directory)
+                               if name.startswith(pagination.PAGE_PREFIX)]
+                    held.append(len(held) - len(spooled))
+                    yield from MockMultiRecordResult([(nodes, edges)])
+
+        query = "MATCH path=(n)\n    RETURN path"
+        with tempfile.TemporaryDirectory() as directory:
+            list(pagination.spool_pages(run_query, query, 'n', directory, page_size=3,
+                                        max_page_bytes=1))
+        self.assertEqual(held, [0] * len(matches))
+
+    def test_add_condition_stops_at_next_clause(self):
+        match_part = "MATCH (n:Process)<-[r]-(m)\n    WHERE r.state = 'WITH' OR m.name ENDS WITH 'x'\n" \
+                     "    WITH n, count(m) AS degree\n    OPTIONAL MATCH (n)-[]->(o)"
+        self.assertEqual(pagination.add_condition(match_part, 'Id(n) > $after'),
+                         "MATCH (n:Process)<-[r]-(m)\n    WHERE (r.state = 'WITH' OR m.name ENDS WITH "
+                         "'x') AND Id(n) > $after\n    WITH n, count(m) AS degree\n"
+                         "    OPTIONAL MATCH (n)-[]->(o)")
+        self.assertEqual(pagination.add_condition("MATCH (n)\nWITH n", 'Id(n) > 1'),
+                         "MATCH (n)\nWHERE Id(n) > 1\nWITH n")
+
+        anchor_query, _ = pagination.keyset_queries(match_part + "\nRETURN n", 'n')
+        self.assertTrue(anchor_query.startswith("MATCH (n:Process)\n"))
+
+    def test_project_query(self):
+        query = "MATCH path1=(n)<-[r]-(m)\n    RETURN path1, path2 LIMIT 1000"
+        projected = project_query(query, ['timestamp', 'name'], ['state'])
+
+        self.assertTrue(projected.startswith("MATCH path1=(n)<-[r]-(m)\n    RETURN "))
+        self.assertIn("[n IN nodes(path1) | [Id(n), labels(n), n{.timestamp, .name}]] AS path1_nodes",
+                      projected)
+        self.assertIn("type(r), r{.state}]] AS path2_edges", projected)
+        self.assertTrue(projected.endswith(" LIMIT 1000"))
+
+    def test_project_query_needs_paths(self):
+        self.assertRaises(ValueError, project_query, "MATCH (n) RETURN n.name")
+
+    def test_projected_result_decodes_to_paths(self):
+        records = [{'path1_nodes': [[1, ['Process'], {'timestamp': 5, 'name': None}],
+                                    [2, ['File'], {'timestamp': 6, 'name': ['/bin/ls']}]],
+                    'path1_edges': [[7, 2, 1, 'PROC_OBJ', {'state': 'READ'}]]},
+                   {'path1_nodes': [[2, ['File'], {'timestamp': 6, 'name': ['/bin/ls']}]],
+                    'path1_edges': []}]
+        graphs = list(pre.iter_graphs_by_result(ProjectedResult(records)))
+
+        self.assertEqual(sorted(graphs[0].nodes.keys()), [1, 2])
+        self.assertEqual(graphs[0].nodes[1].properties, {'timestamp': 5})
+        self.assertEqual(graphs[0].nodes[2].labels, {'File'})
+        self.assertEqual(graphs[0].edges[7].properties['state'], 'READ')
+        self.assertEqual([e.id for e in graphs[0].incoming_edges[1]], [7])
+        self.assertEqual(graphs[1].nodes[2].properties['name'], ['/bin/ls'])
+
+    def test_property_hydrator_fetches_each_node_once(self):
+        fetched = []
+        graph_list = make_structure_graphs()
+        hydrator = PropertyHydrator(make_hydration_query(fetched), ['name', 'cmdline'],
+                                    batch_size=2)
+        self.assertIn("n{.name, .cmdline}", hydrator.query())
+        hydrator.hydrate(graph_list[:1])
+        hydrator.hydrate(graph_list)
+
+        self.assertEqual(sorted(fetched), [1, 2, 3])
+        self.assertEqual(hydrator.queries, 2)
+        self.assertEqual(graph_list[1].nodes[2].properties, {'timestamp': 6, 'name': ['/etc/passwd']})
+        self.assertEqual(graph_list[1].nodes[3].properties, {'timestamp': 7})
+
+    def test_property_hydrator_without_properties(self):
+        # With no properties to fetch, no query is run
+        fetched = []
+        hydrator = PropertyHydrator(make_hydration_query(fetched), [])
+        hydrator.hydrate(make_structure_graphs())
+        self.assertEqual(hydrator.queries, 0)
+        self.assertEqual(fetched, [])
+
 
 def main():
     unittest.main()
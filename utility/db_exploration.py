@@ -2,9 +2,13 @@
 This file contains functions to help me explore the Neo4j database.
 """
 
-from neo4j.v1 import GraphDatabase, basic_auth
+import numpy as np
+from data_processing.neo4j_interface_fns import session, execute_queries
 from data_processing.preprocessing import clean_data_raw
-# TODO: Put code creating and destroying sessions into separate optimisable_functions
+from patchy_san.parameters import ATTACK_PATHS_MAX_DEPTH
+
+# The number of attack nodes per query of get_attack_paths
+ATTACK_PATHS_CHUNK_SIZE = 500
 
 
 def get_all_successor_nodes(root_id):
@@ -15,16 +19,14 @@ def get_all_successor_nodes(root_id):
     :return: A BoltStatementResult describing the raw result returned by Neo4j
     """
 
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=basic_auth("neo4j", "neo4j"))
-    session = driver.session()
-
     query = """
     MATCH path=(n)-[r*]->(m) 
     WHERE Id(m) = $root_id
     RETURN path
     """
-    results = session.run(query, {"root_id": root_id})
-    session.close()
+
+    with session() as db_session:
+        results = db_session.run(query, {"root_id": root_id})
     return results
 
 
@@ -36,49 +38,51 @@ def get_attack_nodes():
     is a Dictionary of edge_id -> edge
     """
 
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=basic_auth("neo4j", "neo4j"))
-    session = driver.session()
-
     query = """
     MATCH path=(n) WHERE n.cmdline =~ '.*attack.*' RETURN path
     """
-    results = session.run(query)
-    session.close()
+
+    with session() as db_session:
+        results = db_session.run(query)
 
     nodes, edges = clean_data_raw(results)
     return nodes, edges
 
 
-def get_attack_paths(nodes):
+def get_attack_paths(nodes, max_depth=ATTACK_PATHS_MAX_DEPTH, chunk_size=ATTACK_PATHS_CHUNK_SIZE):
     """
     Given a list of nodes from which an attack is launched, returns a list of sets of paths
     accessed by each attack node.
 
-    :param nodes: A list of nodes
-    :return: A list of sets of paths (String)
+    The attack nodes are sent in chunks of chunk_size ids, one UNWIND query per chunk, and the
+    queries run concurrently. The distinct names are collected on the server, so only one row
+    per attack node is returned.
+
+    :param nodes: A Dictionary of node_id -> node
+    :param max_depth: The maximum length of the paths searched, a positive integer
+    :param chunk_size: The number of attack nodes per query
+    :return: A list of sets of paths (String), in the same order as nodes
     """
 
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=basic_auth("neo4j", "neo4j"))
-    session = driver.session()
+    if max_depth is None or max_depth < 1:
+        raise ValueError("max_depth must be a positive integer, not %s" % max_depth)
 
-    path_sets = []
-    for node_id in nodes:
-        node = nodes[node_id]
-        query = """
-        MATCH (n)-[r*]->(m) 
-        WHERE Id(m) = $node_id
-        RETURN n
-        """
-        results = session.run(query, {"node_id": node.id})
-        paths = set()
+    query = """
+    UNWIND $ids AS node_id
+    MATCH (n)-[*1..%d]->(m)
+    WHERE Id(m) = node_id AND size(n.name) > 0
+    RETURN node_id, collect(DISTINCT n.name[0]) AS names
+    """ % max_depth
 
-        for result in results:
-            if 'name' in result['n'].properties and len(result['n'].properties['name']) > 0:
-                paths.add(result['n'].properties['name'][0])
+    node_ids = [nodes[node_id].id for node_id in nodes]
+    chunks = [node_ids[start:start+chunk_size] for start in range(0, len(node_ids), chunk_size)]
 
-        path_sets.append(paths)
-    session.close()
-    return path_sets
+    names = {}
+    for results in execute_queries([(query, {'ids': chunk}) for chunk in chunks]):
+        for record in results:
+            names[record['node_id']] = set(record['names'])
+
+    return [names.get(node_id, set()) for node_id in node_ids]
 
 
 def get_path_counts(path_sets):
@@ -89,15 +93,12 @@ def get_path_counts(path_sets):
     :return: A Dictionary of path (String) -> count
     """
 
-    counts = {}
-
-    for set in path_sets:
-        for path in set:
-            if path not in counts.keys():
-                counts[path] = 0
-            counts[path] += 1
+    all_paths = [path for path_set in path_sets for path in path_set]
+    if not all_paths:
+        return {}
 
-    return counts
+    paths, counts = np.unique(np.array(all_paths), return_counts=True)
+    return dict(zip(paths.tolist(), counts.tolist()))
 
 
 def print_paths_by_freq(counts):